@@ -0,0 +1,168 @@
+"""Synthetic model families for benchmarking network generation.
+
+Each family makes a model from a few size parameters and has an analytic count of the states and edges in the generated network.
+"""
+
+import bikipy.bikicore.components as bkcc
+import bikipy.bikicore.model as bkcm
+
+
+# Family: n drugs that each bind their own independent site on a protein with m conformations in a chain (R0 <-> R1 <-> ... )
+def independent_sites_model(n_sites, n_conformations = 1):
+    model = _new_model('Independent sites')
+    drug_list = [_new_drug('L{}'.format(i)) for i in range(n_sites)]
+    protein = _new_protein('R', n_conformations)
+    model.drug_list = drug_list
+    model.protein_list = [protein]
+
+    # Each drug binds the protein in any conformation, the protein converts along the chain of conformations
+    rule_list = [_new_rule(model, [x], [None], ' reversibly associates with ', [protein], [[]]) for x in drug_list]
+    rule_list += _conformation_chain_rules(model, protein, n_conformations)
+    model.rule_list = rule_list
+    return model
+
+def independent_sites_counts(n_sites, n_conformations = 1):
+    # Free drugs plus each subset of bound drugs in each conformation
+    number_of_states = n_sites + n_conformations * 2**n_sites
+
+    # Each drug in each complex has 4 association/dissociation edges, each subset of drugs has a chain of 2-way conversions
+    number_of_edges = 4 * n_conformations * n_sites * 2**(n_sites - 1) + 2**(n_sites + 1) * (n_conformations - 1)
+    return number_of_states, number_of_edges
+
+# Family: one drug binding a protein with m conformations that can all convert into each other
+def conformations_model(n_conformations):
+    model = _new_model('Conformations')
+    drug = _new_drug('L')
+    protein = _new_protein('R', n_conformations)
+    model.drug_list = [drug]
+    model.protein_list = [protein]
+
+    # Drug binds any conformation, each pair of conformations is connected
+    rule_list = [_new_rule(model, [drug], [None], ' reversibly associates with ', [protein], [[]])]
+    for first_conf in range(n_conformations):
+        for second_conf in range(first_conf + 1, n_conformations):
+            rule_list.append(_new_rule(model, [protein], [[first_conf]], ' reversibly converts to ', [protein], [[second_conf]]))
+    model.rule_list = rule_list
+    return model
+
+def conformations_counts(n_conformations):
+    # Free drug, plus the free and bound protein in each conformation
+    number_of_states = 1 + 2 * n_conformations
+
+    # 4 association/dissociation edges for each conformation, all pairs of conformations are connected for the free and bound protein
+    number_of_edges = 4 * n_conformations + 2 * n_conformations * (n_conformations - 1)
+    return number_of_states, number_of_edges
+
+# Family: a protein with m conformations in a chain that can form dimers in any combination of conformations
+def dimer_model(n_conformations):
+    model = _new_model('Dimers')
+    protein = _new_protein('R', n_conformations)
+    model.protein_list = [protein]
+
+    # Protein dimerizes in any conformation and converts along the chain of conformations
+    rule_list = [_new_rule(model, [protein], [[]], ' reversibly associates with ', [protein], [[]])]
+    rule_list += _conformation_chain_rules(model, protein, n_conformations)
+    model.rule_list = rule_list
+    return model
+
+def dimer_counts(n_conformations):
+    # Monomers, and dimers for each unordered pair of conformations
+    number_of_states = n_conformations + n_conformations * (n_conformations + 1) // 2
+
+    # Homodimers have 2 association/dissociation edges and heterodimers 4, monomers have a chain of 2-way conversions,
+    # and each dimer conversion changes one protein by one step while the other stays in place
+    number_of_edges = 2 * n_conformations**2 + 2 * (n_conformations - 1) + 2 * n_conformations * (n_conformations - 1)
+    return number_of_states, number_of_edges
+
+# Family: n drugs binding the same site on a protein, all competitive with each other
+def competition_model(n_drugs):
+    model = _new_model('Competition')
+    drug_list = [_new_drug('L{}'.format(i)) for i in range(n_drugs)]
+    protein = _new_protein('R', 1)
+    model.drug_list = drug_list
+    model.protein_list = [protein]
+
+    # Each drug binds the protein, and each pair of drugs is competitive
+    rule_list = [_new_rule(model, [x], [None], ' reversibly associates with ', [protein], [[]]) for x in drug_list]
+    for first_index, first_drug in enumerate(drug_list):
+        for second_drug in drug_list[first_index + 1:]:
+            rule_list.append(_new_rule(model, [first_drug], [None], ' is competitive with ', [second_drug], [None]))
+    model.rule_list = rule_list
+    return model
+
+def competition_counts(n_drugs):
+    # Free drugs, free protein, and one complex for each drug
+    number_of_states = 2 * n_drugs + 1
+    number_of_edges = 4 * n_drugs
+    return number_of_states, number_of_edges
+
+# Family: the Drosophila dopamine transporter model of dDAT_example_model.py, without the plots
+def ddat_model():
+    model = _new_model('dDAT Model')
+    sodium_1, sodium_2, chloride, cft = [_new_drug(x) for x in ['Na1', 'Na2', 'Cl', '[3H]B']]
+    protein = _new_protein('DAT', 4) # Outward open, outward closed, inward closed, inward open
+    model.drug_list = [sodium_1, sodium_2, chloride, cft]
+    model.protein_list = [protein]
+
+    # The ions bind the outward and inward open conformations, beta-CFT binds the outward conformations
+    rule_list = [_new_rule(model, [x], [None], ' reversibly associates with ', [protein], [[y]]) for x in [sodium_1, sodium_2, chloride] for y in [0, 3]]
+    rule_list += [_new_rule(model, [cft], [None], ' reversibly associates with ', [protein], [[y]]) for y in [0, 1]]
+    rule_list += _conformation_chain_rules(model, protein, 4)
+    model.rule_list = rule_list
+    return model
+
+def ddat_counts():
+    # Free drugs plus each subset of the 4 drugs bound in each of the 4 conformations
+    number_of_states = 4 + 4 * 2**4
+
+    # Each drug binds in 2 conformations to each subset of the other drugs with 4 association/dissociation edges, and each subset
+    # of drugs has a chain of 2-way conversions between the 4 conformations
+    number_of_edges = 4 * 2 * 2**3 * 4 + 2**4 * 3 * 2
+    return number_of_states, number_of_edges
+
+# Lookup of family name -> (model function, count function)
+FAMILIES = {'independent_sites': (independent_sites_model, independent_sites_counts),
+            'conformations': (conformations_model, conformations_counts),
+            'dimer': (dimer_model, dimer_counts),
+            'competition': (competition_model, competition_counts),
+            'ddat': (ddat_model, ddat_counts)}
+
+def make_model(family, parameters):
+    # Make a model from the family name and a dictionary of parameters
+    return FAMILIES[family][0](**parameters)
+
+def expected_counts(family, parameters):
+    # Return the expected (number of states, number of edges) of the generated network for the family and parameters
+    return FAMILIES[family][1](**parameters)
+
+# Helper functions for making the model pieces
+def _new_model(name):
+    return bkcm.Model(1, name, None)
+
+def _new_drug(symbol):
+    new_drug = bkcc.Drug()
+    new_drug.name = symbol
+    new_drug.symbol = symbol
+    return new_drug
+
+def _new_protein(symbol, n_conformations):
+    new_protein = bkcc.Protein()
+    new_protein.name = symbol
+    new_protein.symbol = symbol
+    new_protein.conformation_names = ['Conformation {}'.format(i) for i in range(n_conformations)]
+    new_protein.conformation_symbols = ['c{}'.format(i) for i in range(n_conformations)]
+    return new_protein
+
+def _new_rule(model, rule_subject, subject_conf, rule, rule_object, object_conf):
+    new_rule = bkcc.Rule(model)
+    new_rule.rule_subject = rule_subject
+    new_rule.subject_conf = subject_conf
+    new_rule.rule = rule
+    new_rule.rule_object = rule_object
+    new_rule.object_conf = object_conf
+    new_rule.check_rule_traits()
+    return new_rule
+
+def _conformation_chain_rules(model, protein, n_conformations):
+    # Rules for R(0) <-> R(1) <-> ... <-> R(m-1)
+    return [_new_rule(model, [protein], [[i]], ' reversibly converts to ', [protein], [[i + 1]]) for i in range(n_conformations - 1)]
@@ -0,0 +1,301 @@
+"""Time network generation for the synthetic model families, package import times and parameter ensemble throughput, and store the results as JSON.
+
+Usage:
+    python -m bikipy.benchmarks.run_benchmarks --output results.json
+    python -m bikipy.benchmarks.run_benchmarks --output new.json --compare old.json
+"""
+
+import sys
+import json
+import time
+import platform
+import argparse
+import subprocess
+import os.path
+import numpy as np
+import bikipy.bikicore.model as bkcm
+import bikipy.bikicore.solver as bkcs
+import bikipy.benchmarks.model_families as bkbf
+
+
+# Default benchmark cases, (family, parameters)
+DEFAULT_CASES = [('independent_sites', {'n_sites': 3, 'n_conformations': 2}),
+                 ('independent_sites', {'n_sites': 5, 'n_conformations': 2}),
+                 ('independent_sites', {'n_sites': 6, 'n_conformations': 2}),
+                 ('independent_sites', {'n_sites': 4, 'n_conformations': 4}),
+                 ('conformations', {'n_conformations': 8}),
+                 ('conformations', {'n_conformations': 16}),
+                 ('dimer', {'n_conformations': 4}),
+                 ('dimer', {'n_conformations': 8}),
+                 ('competition', {'n_drugs': 4}),
+                 ('competition', {'n_drugs': 8}),
+                 ('ddat', {})]
+
+# Cases to generate with and without the bulk construction mode of generate_network, (family, parameters)
+BULK_CASES = [('ddat', {})]
+QUICK_BULK_CASES = [('competition', {'n_drugs': 2})]
+
+# Modules to time the import of in a fresh interpreter, and slow optional dependencies they should not load on import
+IMPORT_MODULES = ['bikipy.bikicore.components', 'bikipy.bikicore.model']
+HEAVY_MODULES = ['matplotlib', 'sympy', 'scipy', 'traitsui']
+
+# Small cases for a quick check
+QUICK_CASES = [('independent_sites', {'n_sites': 2, 'n_conformations': 2}),
+               ('conformations', {'n_conformations': 3}),
+               ('dimer', {'n_conformations': 2}),
+               ('competition', {'n_drugs': 2})]
+
+# Parameter ensemble cases, (family, parameters, number of parameter sets), and the ways of simulating them
+ENSEMBLE_CASES = [('competition', {'n_drugs': 3}, 200),
+                  ('independent_sites', {'n_sites': 3, 'n_conformations': 2}, 100),
+                  ('conformations', {'n_conformations': 8}, 100)]
+QUICK_ENSEMBLE_CASES = [('competition', {'n_drugs': 2}, 20)]
+ENSEMBLE_MODES = ['loop', 'lockstep', 'grouped']
+
+def run_case(family, parameters, repeats = 3):
+    # Generate the network for one case several times and keep the best time for each step
+    # Returns a dictionary with the case, the network size, and the times in seconds
+    best_times = {}
+    for repeat in range(repeats):
+        model = bkbf.make_model(family, parameters)
+        stats = bkcm.GenerationStats()
+        start_time = time.perf_counter()
+        model.generate_network(stats = stats)
+        step_times = {'generate_network': time.perf_counter() - start_time,
+                      'apply_rules': sum(x.wall_time for x in stats.records)}
+        step_times.update(stats.labeling_times)
+        for step, step_time in step_times.items():
+            best_times[step] = min(step_time, best_times.get(step, step_time))
+
+    # Check the network against the analytic counts
+    graph = model.network.main_graph
+    expected_states, expected_edges = bkbf.expected_counts(family, parameters)
+    return {'family': family,
+            'parameters': parameters,
+            'states': graph.number_of_nodes(),
+            'edges': graph.number_of_edges(),
+            'expected_states': expected_states,
+            'expected_edges': expected_edges,
+            'correct': graph.number_of_nodes() == expected_states and graph.number_of_edges() == expected_edges,
+            'cycles': stats.current_cycle,
+            'times': best_times}
+
+def time_bulk_build(family, parameters, repeats = 3):
+    # Generate the network for one case with and without bkcc.bulk_build() and keep the best time of each
+    # Returns a dictionary with the case, the network size, the times in seconds, and the speedup of the bulk mode
+    best_times = {}
+    for repeat in range(repeats):
+        for bulk in [True, False]:
+            model = bkbf.make_model(family, parameters)
+            start_time = time.perf_counter()
+            model.generate_network(bulk = bulk)
+            run_time = time.perf_counter() - start_time
+            mode = 'bulk' if bulk else 'no_bulk'
+            best_times[mode] = min(run_time, best_times.get(mode, run_time))
+    graph = model.network.main_graph
+    return {'family': family,
+            'parameters': parameters,
+            'states': graph.number_of_nodes(),
+            'edges': graph.number_of_edges(),
+            'times': best_times,
+            'speedup': best_times['no_bulk'] / best_times['bulk'] if best_times['bulk'] > 0 else float('inf')}
+
+def time_import(module, repeats = 3):
+    # Import a module in fresh interpreters and keep the best time
+    # Returns a dictionary with the module, the time in seconds, and which of the heavy modules were loaded by the import
+    script = ('import sys, time, json\n'
+              'start_time = time.perf_counter()\n'
+              'import {}\n'
+              'import_time = time.perf_counter() - start_time\n'
+              'print(json.dumps([import_time, [x for x in {!r} if x in sys.modules]]))').format(module, HEAVY_MODULES)
+    environment = dict(os.environ, PYTHONPATH = os.pathsep.join(x for x in sys.path if x != ''))
+    best_time = None
+    for repeat in range(repeats):
+        output = subprocess.run([sys.executable, '-c', script], env = environment, stdout = subprocess.PIPE, universal_newlines = True, check = True)
+        import_time, heavy_modules = json.loads(output.stdout.strip().splitlines()[-1])
+        best_time = import_time if best_time == None else min(best_time, import_time)
+    return {'module': module, 'time': best_time, 'heavy_modules': heavy_modules}
+
+def time_ensemble(family, parameters, number_of_sets, repeats = 3):
+    # Simulate an ensemble of random rate constants one set at a time and with each of the Solver ensemble modes
+    # Returns a dictionary with the case, the network size, the best times in seconds, and the throughputs in sets per second
+    model = bkbf.make_model(family, parameters)
+    model.generate_network()
+    solver = bkcs.Solver(model)
+    system = solver.get_system()
+    random_generator = np.random.default_rng(0)
+    parameter_sets = 10**random_generator.uniform(-1., 2., (number_of_sets, len(system.parameters)))
+    initial_concentrations = {x: 1. for x in system.species if len(x.required_drug_list) + len(x.required_protein_list) == 1}
+    time_points = np.linspace(0., 10., 11)
+
+    best_times = {}
+    for repeat in range(repeats):
+        for mode in ENSEMBLE_MODES:
+            start_time = time.perf_counter()
+            if mode == 'loop':
+                for current_set in parameter_sets:
+                    solver.simulate(initial_concentrations, current_set, time_points)
+            else:
+                solver.simulate_ensemble(parameter_sets, initial_concentrations, time_points, mode = mode)
+            run_time = time.perf_counter() - start_time
+            best_times[mode] = min(run_time, best_times.get(mode, run_time))
+    return {'family': family,
+            'parameters': parameters,
+            'species': len(system.species),
+            'reactions': len(system.parameters),
+            'sets': number_of_sets,
+            'times': best_times,
+            'throughput': {x: number_of_sets / y if y > 0 else float('inf') for x, y in best_times.items()}}
+
+def run_suite(cases = None, repeats = 3, bulk_cases = None, ensemble_cases = None):
+    # Run all the cases and return a dictionary with the results and a description of where they were run
+    if cases == None:
+        cases = DEFAULT_CASES
+    if bulk_cases == None:
+        bulk_cases = BULK_CASES
+    if ensemble_cases == None:
+        ensemble_cases = ENSEMBLE_CASES
+    return {'commit': _git_commit(),
+            'python': platform.python_version(),
+            'machine': platform.machine(),
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'repeats': repeats,
+            'imports': [time_import(x, repeats) for x in IMPORT_MODULES],
+            'results': [run_case(family, parameters, repeats) for family, parameters in cases],
+            'bulk_builds': [time_bulk_build(family, parameters, repeats) for family, parameters in bulk_cases],
+            'ensembles': [time_ensemble(family, parameters, number_of_sets, repeats) for family, parameters, number_of_sets in ensemble_cases]}
+
+def compare_results(old_suite, new_suite, step = 'generate_network', threshold = 1.2):
+    # Compare the times of one step for the cases found in both suites
+    # Returns a list of (family, parameters, old time, new time, ratio, regressed) tuples, regressed is True when new/old > threshold
+    old_times = {_case_key(x): x['times'][step] for x in old_suite['results'] if step in x['times']}
+    comparison = []
+    for current_result in new_suite['results']:
+        current_key = _case_key(current_result)
+        if current_key not in old_times or step not in current_result['times']:
+            continue # Nothing to compare against
+        old_time = old_times[current_key]
+        new_time = current_result['times'][step]
+        ratio = new_time / old_time if old_time > 0 else float('inf')
+        comparison.append((current_result['family'], current_result['parameters'], old_time, new_time, ratio, ratio > threshold))
+    return comparison
+
+def compare_import_times(old_suite, new_suite, threshold = 1.2):
+    # Compare the import times of the modules found in both suites
+    # Returns a list of (module, old time, new time, ratio, regressed) tuples, regressed is True when new/old > threshold
+    old_times = {x['module']: x['time'] for x in old_suite.get('imports', [])}
+    comparison = []
+    for current_import in new_suite.get('imports', []):
+        if current_import['module'] not in old_times:
+            continue # Nothing to compare against
+        old_time = old_times[current_import['module']]
+        ratio = current_import['time'] / old_time if old_time > 0 else float('inf')
+        comparison.append((current_import['module'], old_time, current_import['time'], ratio, ratio > threshold))
+    return comparison
+
+def compare_ensemble_throughputs(old_suite, new_suite, mode = 'lockstep', threshold = 1.2):
+    # Compare the ensemble throughputs of one mode for the cases found in both suites
+    # Returns a list of (family, parameters, old throughput, new throughput, ratio, regressed) tuples, regressed is True when old/new > threshold
+    old_throughputs = {_case_key(x) + (x['sets'],): x['throughput'][mode] for x in old_suite.get('ensembles', []) if mode in x['throughput']}
+    comparison = []
+    for current_ensemble in new_suite.get('ensembles', []):
+        current_key = _case_key(current_ensemble) + (current_ensemble['sets'],)
+        if current_key not in old_throughputs or mode not in current_ensemble['throughput']:
+            continue # Nothing to compare against
+        old_throughput = old_throughputs[current_key]
+        new_throughput = current_ensemble['throughput'][mode]
+        ratio = old_throughput / new_throughput if new_throughput > 0 else float('inf')
+        comparison.append((current_ensemble['family'], current_ensemble['parameters'], old_throughput, new_throughput, ratio, ratio > threshold))
+    return comparison
+
+def format_suite(suite):
+    # Returns a text table of the results in a suite
+    steps = ['generate_network', 'apply_rules', 'autosymbol', 'autonumber', 'autoname', 'autovariable']
+    lines = ['\t'.join(['family', 'parameters', 'states', 'edges', 'correct'] + steps)]
+    for current_result in suite['results']:
+        line = [current_result['family'], _format_parameters(current_result['parameters']), str(current_result['states']),
+                str(current_result['edges']), str(current_result['correct'])]
+        line += ['{:.4f}'.format(current_result['times'][x]) if x in current_result['times'] else '-' for x in steps]
+        lines.append('\t'.join(line))
+    
+    # Import times
+    if suite.get('imports'):
+        lines.append('')
+        lines.append('\t'.join(['module', 'import_time', 'heavy_modules']))
+        for current_import in suite['imports']:
+            lines.append('\t'.join([current_import['module'], '{:.4f}'.format(current_import['time']), ','.join(current_import['heavy_modules']) or '-']))
+    
+    # Network generation with and without the bulk construction mode
+    if suite.get('bulk_builds'):
+        lines.append('')
+        lines.append('\t'.join(['family', 'parameters', 'states', 'edges', 'bulk', 'no_bulk', 'speedup']))
+        for current_build in suite['bulk_builds']:
+            lines.append('\t'.join([current_build['family'], _format_parameters(current_build['parameters']), str(current_build['states']), str(current_build['edges']),
+                                    '{:.4f}'.format(current_build['times']['bulk']), '{:.4f}'.format(current_build['times']['no_bulk']), 
+                                    '{:.2f}x'.format(current_build['speedup'])]))
+    
+    # Ensemble throughputs in sets per second
+    if suite.get('ensembles'):
+        lines.append('')
+        lines.append('\t'.join(['family', 'parameters', 'species', 'sets'] + ['{}_sets_per_s'.format(x) for x in ENSEMBLE_MODES]))
+        for current_ensemble in suite['ensembles']:
+            line = [current_ensemble['family'], _format_parameters(current_ensemble['parameters']), str(current_ensemble['species']), str(current_ensemble['sets'])]
+            line += ['{:.1f}'.format(current_ensemble['throughput'][x]) if x in current_ensemble['throughput'] else '-' for x in ENSEMBLE_MODES]
+            lines.append('\t'.join(line))
+    return '\n'.join(lines)
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = 'Benchmark network generation with synthetic model families.')
+    parser.add_argument('--output', help = 'JSON file to write the results to')
+    parser.add_argument('--compare', help = 'JSON file with earlier results to compare against')
+    parser.add_argument('--repeats', type = int, default = 3, help = 'Number of runs for each case, the best time is kept')
+    parser.add_argument('--threshold', type = float, default = 1.2, help = 'Slowdown ratio reported as a regression')
+    parser.add_argument('--quick', action = 'store_true', help = 'Run only a few small cases')
+    args = parser.parse_args(argv)
+
+    # Run and report the benchmarks
+    suite = run_suite(QUICK_CASES if args.quick else DEFAULT_CASES, args.repeats, QUICK_BULK_CASES if args.quick else BULK_CASES, 
+                      QUICK_ENSEMBLE_CASES if args.quick else ENSEMBLE_CASES)
+    print(format_suite(suite))
+    if args.output != None:
+        with open(args.output, 'w') as output_file:
+            json.dump(suite, output_file, indent = 2)
+
+    # Compare with earlier results
+    exit_code = 0 if all(x['correct'] for x in suite['results']) else 1
+    if args.compare != None:
+        with open(args.compare) as compare_file:
+            old_suite = json.load(compare_file)
+        print('\nComparison with {} (commit {})'.format(args.compare, old_suite.get('commit')))
+        for family, parameters, old_time, new_time, ratio, regressed in compare_results(old_suite, suite, threshold = args.threshold):
+            print('{}\t{}\t{:.4f}\t{:.4f}\t{:.2f}x{}'.format(family, _format_parameters(parameters), old_time, new_time, ratio, '\tREGRESSION' if regressed else ''))
+            if regressed:
+                exit_code = 1
+        for module, old_time, new_time, ratio, regressed in compare_import_times(old_suite, suite, threshold = args.threshold):
+            print('import {}\t{:.4f}\t{:.4f}\t{:.2f}x{}'.format(module, old_time, new_time, ratio, '\tREGRESSION' if regressed else ''))
+            if regressed:
+                exit_code = 1
+        for family, parameters, old_throughput, new_throughput, ratio, regressed in compare_ensemble_throughputs(old_suite, suite, threshold = args.threshold):
+            print('ensemble {}\t{}\t{:.1f}\t{:.1f}\t{:.2f}x{}'.format(family, _format_parameters(parameters), old_throughput, new_throughput, ratio, '\tREGRESSION' if regressed else ''))
+            if regressed:
+                exit_code = 1
+    return exit_code
+
+# Helper functions
+def _case_key(result):
+    return (result['family'], tuple(sorted(result['parameters'].items())))
+
+def _format_parameters(parameters):
+    return ','.join('{}={}'.format(key, value) for key, value in sorted(parameters.items()))
+
+def _git_commit():
+    # Returns the current git commit of the package, or None if it can't be found
+    try:
+        output = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd = os.path.dirname(os.path.abspath(__file__)),
+                                stdout = subprocess.PIPE, stderr = subprocess.DEVNULL, universal_newlines = True)
+    except OSError:
+        return None
+    return output.stdout.strip() or None
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,70 @@
+"""Test suite for the benchmark model families and runner
+
+"""
+import pytest
+import bikipy.benchmarks.model_families as bkbf
+import bikipy.benchmarks.run_benchmarks as bkbr
+
+#---- Tests ----
+
+# Test that the generated networks of small models in each family have the analytic number of states and edges
+@pytest.mark.parametrize('family, parameters', [('independent_sites', {'n_sites': 1, 'n_conformations': 1}),
+                                                ('independent_sites', {'n_sites': 3, 'n_conformations': 2}),
+                                                ('independent_sites', {'n_sites': 2, 'n_conformations': 4}),
+                                                ('conformations', {'n_conformations': 1}),
+                                                ('conformations', {'n_conformations': 4}),
+                                                ('dimer', {'n_conformations': 1}),
+                                                ('dimer', {'n_conformations': 3}),
+                                                ('competition', {'n_drugs': 1}),
+                                                ('competition', {'n_drugs': 3}),
+                                                ('ddat', {})])
+def test_model_family_counts(family, parameters):
+    model = bkbf.make_model(family, parameters)
+    model.generate_network()
+    graph = model.network.main_graph
+    assert (graph.number_of_nodes(), graph.number_of_edges()) == bkbf.expected_counts(family, parameters)
+
+# Test that the runner reports each case and finds regressions
+def test_run_suite_and_compare():
+    suite = bkbr.run_suite(bkbr.QUICK_CASES, repeats = 1, bulk_cases = bkbr.QUICK_BULK_CASES, ensemble_cases = bkbr.QUICK_ENSEMBLE_CASES)
+    assert len(suite['results']) == len(bkbr.QUICK_CASES)
+    assert all(x['correct'] for x in suite['results'])
+    assert all(x['times']['generate_network'] >= x['times']['apply_rules'] for x in suite['results'])
+    assert all(step in suite['results'][0]['times'] for step in ['autosymbol', 'autonumber'])
+    assert len(bkbr.format_suite(suite).splitlines()) == len(bkbr.QUICK_CASES) + len(bkbr.IMPORT_MODULES) + len(bkbr.QUICK_BULK_CASES) + len(bkbr.QUICK_ENSEMBLE_CASES) + 7
+
+    # Make a slower copy of the results to compare against
+    slow_suite = {'results': [dict(x, times = {'generate_network': 2 * x['times']['generate_network']}) for x in suite['results']]}
+    comparison = bkbr.compare_results(suite, slow_suite)
+    assert len(comparison) == len(bkbr.QUICK_CASES)
+    assert all(x[5] for x in comparison)
+    assert not any(x[5] for x in bkbr.compare_results(slow_suite, suite))
+
+# Test that generating with and without the bulk construction mode gives the same network and reports both times
+def test_time_bulk_build():
+    family, parameters = bkbr.QUICK_BULK_CASES[0]
+    build_result = bkbr.time_bulk_build(family, parameters, repeats = 1)
+    assert (build_result['states'], build_result['edges']) == bkbf.expected_counts(family, parameters)
+    assert sorted(build_result['times']) == ['bulk', 'no_bulk']
+    assert build_result['speedup'] > 0
+
+# Test that the ensemble throughput is reported for each mode and compared
+def test_time_ensemble():
+    family, parameters, number_of_sets = bkbr.QUICK_ENSEMBLE_CASES[0]
+    ensemble_result = bkbr.time_ensemble(family, parameters, number_of_sets, repeats = 1)
+    assert ensemble_result['sets'] == number_of_sets
+    assert sorted(ensemble_result['throughput']) == sorted(bkbr.ENSEMBLE_MODES)
+    assert all(x > 0 for x in ensemble_result['throughput'].values())
+
+    # Halve the throughput of a copy to compare against
+    slow_ensemble = dict(ensemble_result, throughput = {x: y / 2 for x, y in ensemble_result['throughput'].items()})
+    comparison = bkbr.compare_ensemble_throughputs({'ensembles': [ensemble_result]}, {'ensembles': [slow_ensemble]})
+    assert len(comparison) == 1 and comparison[0][5]
+    assert not bkbr.compare_ensemble_throughputs({'ensembles': [slow_ensemble]}, {'ensembles': [ensemble_result]})[0][5]
+
+# Test that importing the core modules doesn't load the slow plotting and symbolic packages
+def test_import_time():
+    for current_module in bkbr.IMPORT_MODULES:
+        import_result = bkbr.time_import(current_module, repeats = 1)
+        assert import_result['time'] > 0
+        assert import_result['heavy_modules'] == []
@@ -3,16 +3,69 @@ biochemical system, the model, and the experiments performed.
 
 """
 
+import os
 import uuid
+import weakref
+import contextlib
 import itertools
 import copy
+import numpy as np
 import networkx as nx
-import sympy as sp
-from sympy.core.basic import Basic as spBaseClass 
 from collections import Counter
-from traits.api import HasTraits, Str, List, Tuple, Int, Instance, Enum, Either, Bool, Dict
+from traits.api import HasTraits, Str, List, Tuple, Int, Instance, Enum, Either, Bool, Dict, Any, TraitError
 from bikipy.bikicore.exceptions import ComponentNotValidError, RuleNotValidError
 
+# Bulk construction of network objects, see the bulk_build() context manager
+_cheap_ID_prefix = uuid.uuid4().int >> 64 << 64 # Random upper half of the cheap IDs, so they differ between processes and sessions
+_cheap_ID_counter = itertools.count(1)
+_bulk_build_objects = None # List of States and StateTransitions to validate when the outermost bulk_build() context closes, None outside of the context
+
+@contextlib.contextmanager
+def bulk_build():
+    # Context for making many States and StateTransitions quickly, used during network generation
+    # Inside the context:
+    #   - New States and StateTransitions get cheap, increasing IDs instead of random uuid4 IDs
+    #   - The values set when they are made (IDs, the lists of States made with State.from_lists(), and the direction of 
+    #     Conversions) skip traits validation and notifications. When the outermost context closes, these values are all 
+    #     assigned again through traits (without notifications), so they are validated and behave like any other trait 
+    #     values from then on. A TraitError is raised if any of them is invalid.
+    #   - Traits set later on, e.g. by the labeling methods, are validated and notified as usual
+    global _bulk_build_objects
+    outermost = _bulk_build_objects is None
+    if outermost:
+        _bulk_build_objects = []
+    try:
+        yield
+        if outermost:
+            for current_object in _bulk_build_objects:
+                current_object.check_bulk_values()
+    finally:
+        if outermost:
+            _bulk_build_objects = None
+
+def new_ID():
+    # Returns an ID for a new State or StateTransition, cheap and increasing inside bulk_build() and a random uuid4 outside of it
+    # Cheap IDs are a counter in the lower half and a random number for each process in the upper half
+    if _bulk_build_objects is None:
+        return uuid.uuid4()
+    return uuid.UUID(int = _cheap_ID_prefix | next(_cheap_ID_counter))
+
+def _set_bulk_values(new_object, **values):
+    # Stores values on a new State or StateTransition, through traits outside of bulk_build() and directly inside of it
+    # The State and StateTransition __init__ methods list the new object, so its check_bulk_values() runs when the context closes
+    if _bulk_build_objects is None:
+        new_object.trait_set(**values)
+    else:
+        new_object.__dict__.update(values)
+
+def _new_cheap_ID_prefix():
+    # Forked processes start with a copy of the parent's prefix and counter, so they need a prefix of their own
+    global _cheap_ID_prefix
+    _cheap_ID_prefix = uuid.uuid4().int >> 64 << 64
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child = _new_cheap_ID_prefix)
+
 # Define classes for the different components of the biochemical system
 class Drug(HasTraits):
     
@@ -54,7 +107,7 @@ class State(HasTraits):
     name = Str()
     symbol = Str()
     number = Int()
-    variable = Instance(spBaseClass) # Must be a sympy object
+    variable = Instance('sympy.core.basic.Basic') # Must be a sympy object, named by string so sympy is only imported when needed
     ID = Instance(uuid.UUID)
     required_drug_list = List(Instance(Drug))
     required_protein_list = List(Instance(Protein))
@@ -63,9 +116,34 @@ class State(HasTraits):
     
     # Want to give a new state an ID right away
     def __init__(self, *args, **kwargs):
-        self.ID = uuid.uuid4()
+        _set_bulk_values(self, ID = new_ID())
+        if _bulk_build_objects is not None:
+            _bulk_build_objects.append(self)
         super().__init__(*args, **kwargs) # Make sure to call the HasTraits initialization machinery 
     
+    @classmethod
+    def from_lists(cls, component_list, conformation_list, link_list):
+        # Makes a new state from component, conformation, and internal link lists
+        # Inside a bulk_build() context, the lists are stored without traits validation or notifications
+        new_state = cls()
+        if _bulk_build_objects is None:
+            new_state.add_component_list(component_list, conformation_list)
+            new_state.internal_links = link_list
+        else:
+            state_values = new_state.__dict__ # The new state is already listed for checking by __init__
+            state_values['required_drug_list'] = [x for x in component_list if isinstance(x, Drug)]
+            state_values['required_protein_list'] = [x for x in component_list if isinstance(x, Protein)]
+            state_values['req_protein_conf_lists'] = [conformation_list[i] for i, x in enumerate(component_list) if isinstance(x, Protein)]
+            state_values['internal_links'] = list(link_list)
+        return new_state
+    
+    def check_bulk_values(self):
+        # Assigns the ID and the plain lists stored inside a bulk_build() context through traits, without notifications
+        # Traits validates them against the trait definitions (raises TraitError if invalid) and keeps validating later changes
+        state_values = self.__dict__
+        self.trait_setq(**{x: state_values[x] for x in ['ID', 'required_drug_list', 'required_protein_list', 'req_protein_conf_lists', 'internal_links'] 
+                           if x in state_values})
+    
     def autosymbol(self, method = 0):
         # Create the generated symbol name that will usually be the one used in display. 
         # Symbols are created from the components of the state
@@ -107,7 +185,7 @@ class State(HasTraits):
                     for test_position in range(len(group_tuple_list)):
                         
                         # Get test conformation
-                        test_conf = conformations[group_tuple_list[test_position[1]]]
+                        test_conf = conformations[group_tuple_list[test_position][1]]
                         
                         # Insert shorter conformations lists before the long one
                         if len(current_conf) < len(test_conf):
@@ -190,6 +268,7 @@ class State(HasTraits):
         # Call after numbering by the network function.
         # NOTE: we call the sympy symbol a "variable", and the single-letter notation for chemical components a
         #   "symbol", in line with usage in basic algebra and chemistry language. Sorry, symbolic mathmatics.
+        import sympy as sp # Slow to import, so only load it when it's used
         
         self.variable = sp.symbols('S_{}'.format(self.number))
             
@@ -204,7 +283,14 @@ class State(HasTraits):
             return component_sorted, conformation_sorted
         elif return_components_only:
             return component_sorted
-        
+
+    def generate_state_key(self):
+        # Returns a canonical, hashable key built from the components, conformations and internal links of the state
+        # Two states have the same key when they would be an 'exact' match in the Model state comparison methods
+
+        component_list, conformation_list = self.generate_component_list()
+        return create_state_key(component_list, conformation_list, self.internal_links)
+
     def add_component_list(self, incoming_components, incoming_conformations):
         # Adds component and conformation lists to the state
          
@@ -271,19 +357,27 @@ class StateTransition(HasTraits):
     # Traits initialization
     name = Str()
     number = Int(None)
-    variable = Instance(spBaseClass) # Must be a sympy object
+    variable = Instance('sympy.core.basic.Basic') # Must be a sympy object, named by string so sympy is only imported when needed
     ID = Instance(uuid.UUID)
     
      # Want to give a new state an ID right away, determined by the network generation code
     def __init__(self, *args, **kwargs):
-        self.ID = uuid.uuid4()
+        _set_bulk_values(self, ID = new_ID())
+        if _bulk_build_objects is not None:
+            _bulk_build_objects.append(self)
         super().__init__(*args, **kwargs) # Make sure to call the HasTraits initialization machinery
+    
+    def check_bulk_values(self):
+        # Assigns the values stored inside a bulk_build() context through traits without notifications, raises TraitError if invalid
+        transition_values = self.__dict__
+        self.trait_setq(**{x: transition_values[x] for x in ['ID', 'reference_direction'] if x in transition_values})
         
     def autovariable(self):
         # Creates a sympy symbol object that represents the edges's rate constant in rate equations. 
         # Call after numbering by the network function.
         # NOTE: we call the sympy symbol a "variable", and the single-letter notation for chemical components a
         #   "symbol", in line with usage in basic algebra and chemistry language. Sorry, symbolic mathmatics.
+        import sympy as sp # Slow to import, so only load it when it's used
         
         self.variable = sp.symbols('k_{}'.format(self.number))
     
@@ -294,7 +388,7 @@ class Conversion(StateTransition):
     
     # Keep track of the original conversion direction for better numbering
     def __init__(self, reference_direction = True, *args, **kwargs):
-        self.reference_direction = reference_direction
+        _set_bulk_values(self, reference_direction = reference_direction)
         super().__init__(*args, **kwargs) # Make sure to call the HasTraits initialization machinery 
     
 class Association(StateTransition):
@@ -342,12 +436,42 @@ class Rule(HasTraits):
                      #' does not exist.'] #Not sure how to implement these rules right now, maybe need a refactor into different types of rules? 
     rule = Enum(*_rule_choices)
     
+    # The compiled form of the rule used during network generation, cleared whenever the rule is edited
+    compiled_rule = Any()
+    _compiled_rule_snapshot = Any() # Fields of the rule when it was compiled
+    
     # Create a list of possible component choices before completeing Traits initalization
     def __init__(self, model, *args, **kwargs):
         self._possible_components = [*model.drug_list, *model.protein_list]
         self.add_trait('rule_subject', List(Enum(*self._possible_components)))
         self.add_trait('rule_object', List(Enum(*self._possible_components))) 
         super().__init__(*args, **kwargs) # Make sure to call the HasTraits initialization machinery
+        self.on_trait_change(self._clear_compiled_rule, 'rule, rule_subject[], rule_object[], subject_conf[], object_conf[]')
+    
+    # Method to create a compiled rule with all the lists and signatures needed to apply the rule
+    def compile_rule(self):
+        # Always makes a new CompiledRule, which is kept until the rule is edited
+        self.compiled_rule = CompiledRule(self)
+        self._compiled_rule_snapshot = self._rule_snapshot()
+        return self.compiled_rule
+    
+    # Method to get the current compiled rule, compiling it if needed
+    def get_compiled_rule(self):
+        # The change handler doesn't see in-place edits of the inner conformation lists (e.g. rule.subject_conf[0].append(1)),
+        # so the rule is also compared with the snapshot taken when it was compiled
+        if self.compiled_rule == None or self._compiled_rule_snapshot != self._rule_snapshot():
+            return self.compile_rule()
+        return self.compiled_rule
+    
+    def _clear_compiled_rule(self):
+        # Change handler, any edit to the rule makes the compiled rule out of date
+        self.compiled_rule = None
+    
+    def _rule_snapshot(self):
+        # Returns the fields of the rule as nested tuples, which can't change when the rule's lists are edited
+        return (self.rule, tuple(self.rule_subject), tuple(self.rule_object),
+                tuple(None if x == None else tuple(x) for x in self.subject_conf),
+                tuple(None if x == None else tuple(x) for x in self.object_conf))
     
     # Method to check if the rule is valid
     def check_rule_traits(self):
@@ -647,6 +771,96 @@ class Rule(HasTraits):
                 
         return new_sub_conf_list, new_obj_conf_list
     
+# Define class to hold the parts of a rule that do not change while a network is generated
+class CompiledRule(HasTraits):
+    # Created from a Rule with Rule.compile_rule(), which stores it on the rule until the rule is edited
+    
+    # Traits initialization
+    rule = Str()
+    signature_list = List() # Reference signatures from Rule.generate_signature_list()
+    component_lists = Dict() # 'subject', 'object', 'both', and 'difference' (dissociation rules only) -> sorted component and conformation lists
+    object_conformation_combinations = List() # Object conformation lists with all the "any" conformations filled in
+    _frozen_signatures = Any() # (SignatureAlphabet, frozen reference signatures), see get_frozen_signature_list()
+    
+    def __init__(self, source_rule, *args, **kwargs):
+        super().__init__(*args, **kwargs) # Make sure to call the HasTraits initialization machinery
+        self.rule = source_rule.rule
+        self.signature_list = source_rule.generate_signature_list()
+        
+        # Store the sorted component lists
+        for what_to_include in ['subject', 'object', 'both']:
+            self.component_lists[what_to_include] = source_rule.generate_component_list(what_to_include)
+        if self.rule == ' dissociates from ' or self.rule == ' reversibly dissociates from ' \
+                or self.rule == ' dissociates and reassociates in rapid equlibrium from ':
+            self.component_lists['difference'] = source_rule.generate_component_list('difference')
+        
+        # Expand the object conformations, used to find the new conformations in conversions
+        object_components, object_conformations = self.component_lists['object']
+        ignored_output, self.object_conformation_combinations = source_rule._get_all_conformation_combinations([], object_conformations, [], object_components)
+    
+    def generate_component_list(self, what_to_include = 'both'):
+        # Returns the stored lists in the same form as Rule.generate_component_list(). Do not modify the returned lists.
+        if what_to_include not in self.component_lists:
+            raise ValueError("Function supplied with incorrect option for parameter 'what_to_include'")
+        return self.component_lists[what_to_include]
+    
+    def get_frozen_signature_list(self, alphabet):
+        # Returns the reference signatures as FrozenSignatures over the given SignatureAlphabet. Do not modify the returned list.
+        # The signatures are frozen the first time and reused until a different alphabet is given.
+        if self._frozen_signatures == None or self._frozen_signatures[0] is not alphabet:
+            self._frozen_signatures = (alphabet, [x.freeze(alphabet) for x in self.signature_list])
+        return self._frozen_signatures[1]
+    
+# Define class for the main graph of a network
+class VersionedDiGraph(nx.DiGraph):
+    # NetworkX DiGraph with a version number that goes up every time nodes or edges are added or removed, so indices and views
+    # made from the graph can tell if it has changed, even when the number of nodes and edges is the same again.
+    # Changes to node or edge data (e.g. numbering the reactions) are not counted.
+    
+    def __init__(self, *args, **kwargs):
+        self.version = 0
+        super().__init__(*args, **kwargs)
+    
+    def add_node(self, *args, **kwargs):
+        self.version += 1
+        super().add_node(*args, **kwargs)
+    
+    def add_nodes_from(self, *args, **kwargs):
+        self.version += 1
+        super().add_nodes_from(*args, **kwargs)
+    
+    def remove_node(self, *args, **kwargs):
+        self.version += 1
+        super().remove_node(*args, **kwargs)
+    
+    def remove_nodes_from(self, *args, **kwargs):
+        self.version += 1
+        super().remove_nodes_from(*args, **kwargs)
+    
+    def add_edge(self, *args, **kwargs):
+        self.version += 1
+        super().add_edge(*args, **kwargs)
+    
+    def add_edges_from(self, *args, **kwargs):
+        self.version += 1
+        super().add_edges_from(*args, **kwargs)
+    
+    def remove_edge(self, *args, **kwargs):
+        self.version += 1
+        super().remove_edge(*args, **kwargs)
+    
+    def remove_edges_from(self, *args, **kwargs):
+        self.version += 1
+        super().remove_edges_from(*args, **kwargs)
+    
+    def clear(self):
+        self.version += 1
+        super().clear()
+    
+    def clear_edges(self):
+        self.version += 1
+        super().clear_edges()
+
 # Define class as a container for the network graphs of states
 # Do we really want a seperate container that's just added onto a Model class? Don't know yet
 class Network(HasTraits):
@@ -658,13 +872,133 @@ class Network(HasTraits):
     derived_graphs = Dict(key_trait = Str(), value_trait = Instance(nx.DiGraph))
     derived_graph_correlate_states = Dict(key_trait = Str(), value_trait = List(Tuple(Instance(State), Instance(State))))
     derived_graph_correlate_STobjs = Dict(key_trait = Str(), value_trait = List(Tuple(Instance(StateTransition), Instance(StateTransition))))
-    
+    derived_networks = Dict(key_trait = Str(), value_trait = Instance('bikipy.bikicore.components.DerivedNetwork')) # Mask based views of the main graph
+    _mask_index = Any() # (graph version, (number of nodes, number of edges, State -> position, (tail, head) -> position)) for the main graph, see get_mask_index()
+    _component_matrix = Any() # (graph version, component list, state x component boolean matrix), see get_component_matrix()
+    state_key_index = Dict() # Canonical state key -> State in the main graph
+    component_state_index = Dict() # (component, conformation tuple) or (component, None) for any conformation -> set of main graph States
+    _indexed_states = Dict() # State -> (index order, canonical state key), for every main graph state seen by the indices
+    _duplicate_key_states = Dict() # Canonical state key -> list of other States with the key (only possible if added by hand)
+    _index_counter = Int(0)
+    labeling_version = Int(0) # Goes up each time autonumber() or autovariable() relabels the main graph, see Solver.get_system()
+    indexed_variables = Bool(False) # If True, autovariable() gives indexed variables S[i] and k[j] instead of symbols S_n and k_n
+    state_variable_base = Instance('sympy.core.basic.Basic') # IndexedBase S of the indexed state variables, None for symbols
+    rate_constant_base = Instance('sympy.core.basic.Basic') # IndexedBase k of the indexed rate constant variables, None for symbols
+
     # Initial network is an empty main_graph and empty lists of derivitive graphs
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs) # Make sure to call the HasTraits initialization machinery
-        self.main_graph = nx.DiGraph()
+        self.main_graph = VersionedDiGraph()
         self.derived_graphs = {}
-        
+        self.derived_networks = {}
+        self.rebuild_state_index()
+
+    def index_state(self, state):
+        # Add a main graph state to the canonical state key index and the component index
+        # If another state with the same key is already indexed, key lookups keep returning the first one
+
+        if state in self._indexed_states:
+            return
+        state_key = state.generate_state_key()
+        self._indexed_states[state] = (self._index_counter, state_key)
+        self._index_counter += 1
+
+        # Canonical key index
+        if state_key not in self.state_key_index:
+            self.state_key_index[state_key] = state
+        else:
+            self._duplicate_key_states.setdefault(state_key, []).append(state)
+
+        # Component index
+        for posting_key in self._component_index_keys(state):
+            self.component_state_index.setdefault(posting_key, set()).add(state)
+
+    def unindex_state(self, state):
+        # Remove a state from the canonical state key index and the component index, call when the state leaves the main graph
+
+        if state not in self._indexed_states:
+            return
+        index_order, state_key = self._indexed_states.pop(state)
+
+        # Canonical key index, another state with the same key takes over if there is one
+        if self.state_key_index.get(state_key) is state:
+            if state_key in self._duplicate_key_states:
+                self.state_key_index[state_key] = self._duplicate_key_states[state_key].pop(0)
+                if len(self._duplicate_key_states[state_key]) == 0:
+                    del self._duplicate_key_states[state_key]
+            else:
+                del self.state_key_index[state_key]
+        elif state_key in self._duplicate_key_states:
+            self._duplicate_key_states[state_key].remove(state)
+            if len(self._duplicate_key_states[state_key]) == 0:
+                del self._duplicate_key_states[state_key]
+
+        # Component index
+        for posting_key in self._component_index_keys(state):
+            posting_set = self.component_state_index[posting_key]
+            posting_set.discard(state)
+            if len(posting_set) == 0:
+                del self.component_state_index[posting_key]
+
+    def rebuild_state_index(self):
+        # Recreate the canonical state key index and the component index from the states currently in the main graph
+
+        self.state_key_index = {}
+        self.component_state_index = {}
+        self._indexed_states = {}
+        self._duplicate_key_states = {}
+        self._index_counter = 0
+        for current_state in self.main_graph:
+            self.index_state(current_state)
+
+    def find_state(self, state_key):
+        # Returns the main graph state with the given canonical key, or None if there is no such state
+
+        self._check_state_index()
+        found_state = self.state_key_index.get(state_key)
+        if found_state != None and found_state not in self.main_graph:
+            self.rebuild_state_index()
+            found_state = self.state_key_index.get(state_key)
+        return found_state
+
+    def find_states_with_components(self, component_list, conformation_list):
+        # Returns a list of the main graph states that contain each of the listed components/conformations, in graph order
+        # A [] or None conformation matches any conformation. Only the presence of each component is checked, not how many
+        # copies of it there are, so the states returned are candidates that still need a full comparison.
+
+        self._check_state_index()
+
+        # Get the posting set of each required component/conformation
+        posting_keys = {(component, None) if conformation == None or conformation == [] else (component, (*conformation,))
+                        for component, conformation in zip(component_list, conformation_list)}
+        if len(posting_keys) == 0:
+            return list(self.main_graph)
+        posting_sets = sorted((self.component_state_index.get(x, set()) for x in posting_keys), key = len)
+
+        # Intersect, starting with the smallest set
+        candidate_states = set(posting_sets[0]).intersection(*posting_sets[1:])
+        if not all(x in self.main_graph for x in candidate_states):
+            self.rebuild_state_index()
+            return self.find_states_with_components(component_list, conformation_list)
+
+        # Put the result back in graph order
+        return sorted(candidate_states, key = lambda x: self._indexed_states[x][0])
+
+    def _check_state_index(self):
+        # States can be added to or removed from main_graph directly, so rebuild the indices if they fell out of step
+        if len(self._indexed_states) != self.main_graph.number_of_nodes():
+            self.rebuild_state_index()
+
+    def _component_index_keys(self, state):
+        # Keys for the component index of a state, each component is listed with (component, None) and proteins
+        # also with (component, conformation tuple)
+        posting_keys = set()
+        for component, conformation in zip(*state.generate_component_list()):
+            posting_keys.add((component, None))
+            if conformation != None:
+                posting_keys.add((component, (*conformation,)))
+        return posting_keys
+
     def autosymbol(self):
         # Give each state in the main graph a symbol
         
@@ -683,32 +1017,37 @@ class Network(HasTraits):
         for current_index, current_state in enumerate(state_list):
             current_state.number = current_index + 1 # Avoid using number 0, since a null state often has a specific meaning
        
+        # Edges get the lowest positive number not used yet, negative numbers for opposite reactions count as their positive counterpart
+        # Numbers are only ever handed out in increasing order, so a running counter that skips any numbers already on the graph is enough
+        used_numbers = {abs(STobj.number) for (u, v, STobj) in self.main_graph.edges.data('reaction_type') if STobj.number != None}
+        next_number = 1 # Don't use 0, as null states have a specific meaning in chemical kinetics
+        successors = self.main_graph.succ # Map of tail -> head -> edge data, used to find the reverse of each edge
+        
         # Number edge ST objects via their connection to the states (so in general, low number edges on low number states)
         for current_state in state_list:
             
             # Find edges with current state as tail and visit each one
-            edge_tuples = [x for x in self.main_graph.out_edges(current_state, 'reaction_type')]
-            for current_edge_tuple in edge_tuples:
-                STobj = current_edge_tuple[2]
-                Reverse_STobj = None # Reset reverse
+            for head_state, edge_data in successors[current_state].items():
+                STobj = edge_data['reaction_type']
                 
                 # If edge is already numbered, go to the next edge
                 if STobj.number != None:
                     continue
                 
                 # Otherwise, we need to give a new number out
-                new_number = self._get_next_edge_number()
+                while next_number in used_numbers:
+                    next_number += 1
+                new_number = next_number
+                used_numbers.add(new_number)
 
-                # Look for opposite rule
-                try:
-                    Reverse_STobj = self.main_graph.edges[current_edge_tuple[1], current_edge_tuple[0]]['reaction_type']
-                except KeyError: # This is OK, there's just not an edge there
-                    assign_reverse = False 
+                # Look for opposite rule, only assign a new value if it's not already numbered
+                reverse_edge_data = successors[head_state].get(current_state)
+                if reverse_edge_data == None: # This is OK, there's just not an edge there
+                    Reverse_STobj = None
+                    assign_reverse = False
                 else:
-                    if Reverse_STobj.number == None: # Only assign a new value if it's not already numbered
-                        assign_reverse = True
-                    else:
-                        assign_reverse = False
+                    Reverse_STobj = reverse_edge_data['reaction_type']
+                    assign_reverse = Reverse_STobj.number == None
   
                 # Handle association rules
                 if isinstance(STobj, Association):
@@ -750,18 +1089,44 @@ class Network(HasTraits):
                         # Give the opposite reaction the positive number, if needed
                         if assign_reverse:
                             Reverse_STobj.number = new_number
+        
+        self.labeling_version += 1
     
-    def autovariable(self):
+    def autovariable(self, indexed = None):
         # Give each state and edge state-transition object in the main graph a variable
         # Call after numbering
+        # Parameters:
+            # indexed - bool or None, default = None uses the indexed_variables trait. If True, the variables are the entries S[i] and k[j]
+            #   of two sympy IndexedBase objects instead of one symbol per state and edge, with i and j the positions of the states
+            #   and transition objects in number order (the species and reaction order of the main graph's ReactionTable)
+        if indexed == None:
+            indexed = self.indexed_variables
         
-        # Call autovariable on each state
-        for current_state in self.main_graph:
-            current_state.autovariable()
+        if not indexed:
+            self.state_variable_base = None
+            self.rate_constant_base = None
             
-        # Call autovairable on each edge 
-        for u, v, STobj in self.main_graph.edges.data('reaction_type'):
-            STobj.autovariable() 
+            # Call autovariable on each state
+            for current_state in self.main_graph:
+                current_state.autovariable()
+                
+            # Call autovairable on each edge 
+            for u, v, STobj in self.main_graph.edges.data('reaction_type'):
+                STobj.autovariable() 
+        else:
+            import sympy as sp # Slow to import, so only load it when it's used
+            
+            # Order the states and the transition objects, which can be shared by several edges, like ReactionTable does
+            state_list = sorted(self.main_graph, key = lambda x: x.number)
+            STobj_list = sorted({x for u, v, x in self.main_graph.edges.data('reaction_type')}, key = lambda x: (abs(x.number), x.number < 0))
+            self.state_variable_base = sp.IndexedBase('S', shape = (len(state_list),))
+            self.rate_constant_base = sp.IndexedBase('k', shape = (len(STobj_list),))
+            for state_index, current_state in enumerate(state_list):
+                current_state.variable = self.state_variable_base[state_index]
+            for STobj_index, STobj in enumerate(STobj_list):
+                STobj.variable = self.rate_constant_base[STobj_index]
+        
+        self.labeling_version += 1
     
     def autoname(self):
         # Give each state in the main graph a variable
@@ -788,65 +1153,156 @@ class Network(HasTraits):
         else:
             raise ValueError('Given value for source_graph_name not recognized.')
             
-        # Make a new independent shallow copy of the graph
-        new_graph = source_graph.copy()
+        # For each state and state transition object, we want to make a new one with the same information, but different ID (and memory address)
+        # The copies are made once and kept in old -> new mappings, transition objects shared by several edges stay shared in the new graph
+        # The copies keep references to model-wide components, rules, etc. 
+        with bulk_build():
+            state_mapping = {x: self._copy_state(x) for x in source_graph}
+        STobj_mapping = {}
+        for u, v, current_source_STobj in source_graph.edges.data('reaction_type'):
+            if current_source_STobj not in STobj_mapping:
+                STobj_mapping[current_source_STobj] = self._copy_transition(current_source_STobj)
         
-        # For each state, we want to make a new state with the same information, but different ID (and memory address)
-        # We also set all the references in the new graph to the new state and write down correlated states in the list
+        # Build the new graph from the mappings in one pass, keeping the node and edge order
+        new_graph = nx.DiGraph()
+        new_graph.graph.update(source_graph.graph)
+        new_graph.add_nodes_from((state_mapping[x], data.copy()) for x, data in source_graph.nodes.data())
+        new_graph.add_edges_from((state_mapping[u], state_mapping[v], dict(data, reaction_type = STobj_mapping[data['reaction_type']])) 
+                                 for u, v, data in source_graph.edges.data())
         
-        # Make required changes to each old and new states one-by-one
-        new_state_correlate_list = []
-        for current_source_state in source_graph:
-            
-            # Make shallow copy of state object (keep references to model-wide components, rules, etc.) and get new ID
-            new_state = copy.copy(current_source_state)
-            new_state.ID = uuid.uuid4()
-            
-            # Add to correlate list
-            new_state_correlate_list.append((current_source_state, new_state))
-            
-            # Change the new graph references
-            for current_new_state in new_graph:
-                if current_new_state == current_source_state:
-                    current_new_state = new_state
+        # Assign new graph to derivitive graphs, with lists of correlated states and STobjs (one for each edge)
+        self.derived_graphs[name] = new_graph
+        self.derived_graph_correlate_states[name] = [*state_mapping.items()]
+        self.derived_graph_correlate_STobjs[name] = [(x, STobj_mapping[x]) for u, v, x in source_graph.edges.data('reaction_type')]
+    
+    def _copy_state(self, source_state):
+        # Helper function that makes a new state with the same components, links, and labels as the source state, but a new ID
+        new_state = State.from_lists(*source_state.generate_component_list(), source_state.internal_links)
+        new_state.trait_set(name = source_state.name, symbol = source_state.symbol, number = source_state.number, variable = source_state.variable)
+        return new_state
+    
+    def _copy_transition(self, source_STobj):
+        # Helper function that makes a new state transition object of the same type and values as the source object, but a new ID
+        # Values still at None (e.g. an unnumbered transition) are left at their defaults
+        new_STobj = source_STobj.__class__()
+        copied_names = [x for x in source_STobj.copyable_trait_names() if x != 'ID']
+        new_STobj.trait_set(**{key: value for key, value in source_STobj.trait_get(copied_names).items() if value != None})
+        return new_STobj
+    
+    def derive_network(self, name, node_mask = None, edge_mask = None, parameter_overrides = None, source_network_name = None):
+        # Make a derived network, a view of the main graph stored as boolean masks over its nodes and edges plus parameter overrides
+        # Parameters:
+            # name - string, serves as the key for the dictionaries of derived networks and derived graphs
+            # node_mask, edge_mask - boolean arrays in main graph node and edge order (see get_mask_index), or None to keep everything
+            # parameter_overrides - dictionary of parameter values that replace the main network's values in this derived network
+            # source_network_name - string or None, name of a derived network to start from. Its masks and overrides are combined with the new ones.
+        # Returns the new DerivedNetwork, its graph is also added to derived_graphs as a lightweight view
         
-        # Make required changes to each old and new STObj one-by-one
-        new_STobj_correlate_list = []
-        for u, v, current_source_STobj in source_graph.edges.data('reaction_type'):
-            
-            # Make shallow copy of STObj object (keep references to model-wide components, rules, etc.) and get new ID
-            new_STobj = copy.copy(current_source_STobj)
-            new_STobj.ID = uuid.uuid4()
-            
-            # Add to correlate list
-            new_STobj_correlate_list.append((current_source_STobj, new_STobj))
-            
-            # Change the new graph references 
-            for current_new_STobj in new_graph:
-                if current_new_STobj == current_source_STobj:
-                    current_new_STobj = new_STobj
+        # Start from the whole main graph or from another derived network
+        number_of_nodes, number_of_edges, node_positions, edge_positions = self.get_mask_index()
+        if source_network_name == None:
+            combined_node_mask = np.ones(number_of_nodes, dtype = bool)
+            combined_edge_mask = np.ones(number_of_edges, dtype = bool)
+            combined_overrides = {}
+        elif source_network_name in self.derived_networks:
+            source_network = self.derived_networks[source_network_name]
+            source_network.check_masks()
+            combined_node_mask = source_network.node_mask.copy()
+            combined_edge_mask = source_network.edge_mask.copy()
+            combined_overrides = dict(source_network.parameter_overrides)
+        else:
+            raise ValueError('Given value for source_network_name not found in derived_networks list.')
         
-        # Assign new graph to derivitive graphs
-        self.derived_graphs[name] = new_graph
-        self.derived_graph_correlate_states[name] = new_state_correlate_list
-        self.derived_graph_correlate_STobjs[name] = new_STobj_correlate_list
+        # Combine with the new masks and overrides
+        if node_mask is not None:
+            combined_node_mask &= self._check_mask(node_mask, number_of_nodes)
+        if edge_mask is not None:
+            combined_edge_mask &= self._check_mask(edge_mask, number_of_edges)
+        if parameter_overrides != None:
+            combined_overrides.update(parameter_overrides)
+        
+        # Store the derived network, and its graph view with the derived graphs
+        new_network = DerivedNetwork(network = self, node_mask = combined_node_mask, edge_mask = combined_edge_mask, parameter_overrides = combined_overrides,
+                                     graph_version = self.get_graph_version())
+        self.derived_networks[name] = new_network
+        self.derived_graphs[name] = new_network.get_graph()
+        return new_network
+    
+    def get_graph_version(self):
+        # Returns a value that changes whenever nodes or edges are added to or removed from the main graph, or it is replaced
+        # A main graph that isn't a VersionedDiGraph only has its node and edge counts to go by
+        return (id(self.main_graph), getattr(self.main_graph, 'version', None), self.main_graph.number_of_nodes(), self.main_graph.number_of_edges())
+    
+    def get_mask_index(self):
+        # Returns (number of nodes, number of edges, State -> position, (tail, head) -> position) for the main graph
+        # Positions follow the main graph's node and edge order, and are shared by all the derived networks of the main graph
+        graph_version = self.get_graph_version()
+        if self._mask_index == None or self._mask_index[0] != graph_version:
+            node_positions = {x: i for i, x in enumerate(self.main_graph)}
+            edge_positions = {x: i for i, x in enumerate(self.main_graph.edges())}
+            self._mask_index = (graph_version, (len(node_positions), len(edge_positions), node_positions, edge_positions))
+        return self._mask_index[1]
+    
+    def get_component_matrix(self):
+        # Returns a list of the components in the main graph and a boolean matrix with a row for each state (in mask index order)
+        # and a column for each component, True where the state contains the component
+        number_of_nodes, number_of_edges, node_positions, edge_positions = self.get_mask_index()
+        graph_version = self.get_graph_version()
+        if self._component_matrix == None or self._component_matrix[0] != graph_version:
+            component_columns = {}
+            state_columns = []
+            for current_state in self.main_graph:
+                state_columns.append([component_columns.setdefault(x, len(component_columns)) for x in current_state.required_drug_list + current_state.required_protein_list])
+            component_matrix = np.zeros((number_of_nodes, len(component_columns)), dtype = bool)
+            for row, columns in enumerate(state_columns):
+                component_matrix[row, columns] = True
+            self._component_matrix = (graph_version, [*component_columns], component_matrix)
+        return self._component_matrix[1:]
+    
+    def make_component_node_mask(self, available_component_list):
+        # Returns a boolean node mask for the main graph that is True for the states made only of the available components
+        component_list, component_matrix = self.get_component_matrix()
+        available_components = set(available_component_list)
+        unavailable_columns = np.array([x not in available_components for x in component_list], dtype = bool)
+        return ~np.any(component_matrix[:, unavailable_columns], axis = 1)
+    
+    def get_reaction_table(self, graph_name = None):
+        # Returns a ReactionTable of the main graph, or of the derived graph with the given name
+        if graph_name == None:
+            return ReactionTable.from_graph(self.main_graph)
+        return ReactionTable.from_graph(self.derived_graphs[graph_name])
+    
+    def make_node_mask(self, states):
+        # Returns a boolean node mask for the main graph that is True for the given states
+        number_of_nodes, number_of_edges, node_positions, edge_positions = self.get_mask_index()
+        node_mask = np.zeros(number_of_nodes, dtype = bool)
+        node_mask[[node_positions[x] for x in states]] = True
+        return node_mask
+    
+    def _check_mask(self, mask, length):
+        # Helper function that makes sure a mask is a boolean array of the right length
+        mask = np.asarray(mask, dtype = bool)
+        if mask.shape != (length,):
+            raise ValueError('Mask length does not match the main graph, expected {} values but got {}.'.format(length, mask.shape))
+        return mask
     
     def reduce_graph_by_components(self, available_component_list, reduced_graph_name, source_graph_name=None):
         # Function to delete nodes and edges in the graph, leaving only those that can be formed with the list of components
         # Parameters:
             # available_component_list - list of components that are present for making in this subgraph
             # source_graph_name - string with the name of the graph to be modified. Default = main_graph
+        # Reductions of the main graph or of a derived network are stored as a derived network, anything else as a subgraph view
             
-        # Select graph
-        if source_graph_name == None:
-            source_graph = self.main_graph
-        else:
-            source_graph = self.derived_graphs[source_graph_name]
+        # Reductions of the main graph are one vectorized test of the state x component matrix
+        if source_graph_name == None or source_graph_name in self.derived_networks:
+            node_mask = self.make_component_node_mask(available_component_list)
+            self.derive_network(reduced_graph_name, node_mask = node_mask, source_network_name = source_graph_name)
+            return
         
-        # Calculate the nodes to keep
-        included_nodes = [node for node in source_graph if all([x[1] in available_component_list for x in node.enumerate_components()])]
-        
-        # Make subgraph
+        # Otherwise, test the nodes of the graph one-by-one
+        source_graph = self.derived_graphs[source_graph_name]
+        available_components = set(available_component_list)
+        included_nodes = [node for node in source_graph if all(x in available_components for x in node.required_drug_list + node.required_protein_list)]
         self.derived_graphs[reduced_graph_name] = source_graph.subgraph(included_nodes)
     
     def _get_next_edge_number(self, graph = None):
@@ -868,6 +1324,442 @@ class Network(HasTraits):
         return test_number
 
 
+# Define class for networks derived from the main graph of a Network
+class DerivedNetwork(HasTraits):
+    # A derived network (e.g. an experimental condition) is stored as boolean masks over the nodes and edges of the main graph,
+    # plus overrides for parameter values. The graph is only made when asked for, and is a view of the main graph rather than a copy.
+    # Masks follow the node and edge order of Network.get_mask_index() at the time the derived network was made, so they are only
+    # valid while the main graph has the same version.
+    
+    # Traits initialization
+    network = Instance(Network)
+    node_mask = Instance(np.ndarray)
+    edge_mask = Instance(np.ndarray)
+    parameter_overrides = Dict() # Parameter (e.g. a sympy variable) -> value used in this derived network
+    graph_version = Any() # Network.get_graph_version() when the masks were made, None to only check the mask lengths
+    _graph = Any()
+    
+    def get_graph(self):
+        # Returns a read-only view of the main graph with only the masked-in states and edges, made on first use
+        # Raises ValueError if the main graph has changed since the masks were made
+        self.check_masks()
+        if self._graph == None:
+            number_of_nodes, number_of_edges, node_positions, edge_positions = self.network.get_mask_index()
+            node_mask = self.node_mask
+            edge_mask = self.edge_mask
+            self._graph = nx.subgraph_view(self.network.main_graph, filter_node = lambda x: node_mask[node_positions[x]],
+                                           filter_edge = lambda u, v: edge_mask[edge_positions[(u, v)]])
+        return self._graph
+    
+    def check_masks(self):
+        # Raises ValueError if nodes or edges of the main graph have changed since the masks were made
+        if (len(self.node_mask), len(self.edge_mask)) != (self.network.main_graph.number_of_nodes(), self.network.main_graph.number_of_edges()):
+            raise ValueError('The main graph has changed since this derived network was made.')
+        if self.graph_version != None and self.graph_version != self.network.get_graph_version():
+            raise ValueError('The main graph has changed since this derived network was made.')
+    
+    def get_states(self):
+        # Returns the list of states in the derived network, in main graph order
+        return [x for x, included in zip(self.network.main_graph, self.node_mask) if included]
+    
+    def get_parameters(self, base_parameters):
+        # Returns a new dictionary of the base parameters with this network's overrides applied
+        parameters = dict(base_parameters)
+        parameters.update(self.parameter_overrides)
+        return parameters
+    
+    def nbytes(self):
+        # Approximate memory used by the masks
+        return self.node_mask.nbytes + self.edge_mask.nbytes
+    
+    def _node_mask_changed(self):
+        self._graph = None
+    
+    def _edge_mask_changed(self):
+        self._graph = None
+
+# Define class for the reactions of a network in table and matrix form
+class ReactionTable(object):
+    # Each StateTransition object is one reaction. Association edges from both reactants share one object, and so do dissociation
+    # edges to both products, so those edges are collected into a single reaction.
+    # Species are the states ordered by State.number, and reactions are ordered by StateTransition.number as k_1, k_-1, k_2, ... 
+    # Reaction j uses rate constant j, so the reaction index is also the parameter index.
+    
+    def __init__(self, species, reactions, reactants, products):
+        self.species = species # List of States, index i has the i-th lowest number (number i + 1 for a numbered main graph)
+        self.reactions = reactions # List of StateTransition objects
+        self.reactants = reactants # List of tuples of (species index, stoichiometric coefficient) for each reaction
+        self.products = products # List of tuples of (species index, stoichiometric coefficient) for each reaction
+        self.species_numbers = np.array([x.number for x in species], dtype = np.int64)
+        self.parameter_numbers = np.array([x.number for x in reactions], dtype = np.int64) # Signed, negative for reverse reactions
+    
+    @classmethod
+    def from_graph(cls, graph):
+        # Make the reaction table of a numbered graph of States with StateTransition 'reaction_type' edge data, in one pass over the edges
+        
+        # Collect the tails and heads of the edges of each transition object
+        reaction_edges = {}
+        for tail, head, STobj in graph.edges.data('reaction_type'):
+            reaction_edges.setdefault(STobj, ([], []))
+            reaction_edges[STobj][0].append(tail)
+            reaction_edges[STobj][1].append(head)
+        
+        # Order the species and reactions by number
+        if any(x.number == 0 for x in graph) or any(x.number == None for x in reaction_edges):
+            raise ValueError('Graph must be numbered before making a reaction table, run autonumber first.')
+        species = sorted(graph, key = lambda x: x.number)
+        species_indices = {x: i for i, x in enumerate(species)}
+        reactions = sorted(reaction_edges, key = lambda x: (abs(x.number), x.number < 0))
+        
+        # Read the reactants and products of each reaction
+        reactants = []
+        products = []
+        for current_reaction in reactions:
+            tails, heads = reaction_edges[current_reaction]
+            
+            # Associations join the tails into one head, and dissociations split one tail into the heads
+            if isinstance(current_reaction, (Association, RE_Association)):
+                reaction_reactants = Counter(tails)
+                reaction_products = Counter(heads[:1])
+                
+                # A single edge is either a dimer of identical states, or the other reactant is not part of the graph (e.g. held constant)
+                if len(tails) == 1 and cls._is_dimer_of(heads[0], tails[0]):
+                    reaction_reactants[tails[0]] = 2
+            elif isinstance(current_reaction, (Dissociation, RE_Dissociation)):
+                reaction_reactants = Counter(tails[:1])
+                reaction_products = Counter(heads)
+                if len(heads) == 1 and cls._is_dimer_of(tails[0], heads[0]):
+                    reaction_products[heads[0]] = 2
+            else:
+                reaction_reactants = Counter(tails)
+                reaction_products = Counter(heads)
+            reactants.append(tuple((species_indices[x], n) for x, n in reaction_reactants.items()))
+            products.append(tuple((species_indices[x], n) for x, n in reaction_products.items()))
+        
+        return cls(species, reactions, reactants, products)
+    
+    @staticmethod
+    def _is_dimer_of(dimer_state, monomer_state):
+        # Helper function that checks if a state has exactly twice the components and conformations of another state
+        dimer_count = Counter(zip(dimer_state.required_drug_list + dimer_state.required_protein_list, 
+                                  [None] * len(dimer_state.required_drug_list) + [tuple(x) for x in dimer_state.req_protein_conf_lists]))
+        monomer_count = Counter(zip(monomer_state.required_drug_list + monomer_state.required_protein_list, 
+                                    [None] * len(monomer_state.required_drug_list) + [tuple(x) for x in monomer_state.req_protein_conf_lists]))
+        return dimer_count == monomer_count + monomer_count
+    
+    @property
+    def number_of_species(self):
+        return len(self.species)
+    
+    @property
+    def number_of_reactions(self):
+        return len(self.reactions)
+    
+    def get_parameters(self, parameter_overrides = None):
+        # Returns the list of rate constant variables in reaction order, with any overrides (e.g. from a DerivedNetwork) applied
+        parameters = [x.variable for x in self.reactions]
+        if parameter_overrides:
+            parameters = [parameter_overrides.get(x, x) for x in parameters]
+        return parameters
+    
+    def rate_equations(self, parameter_overrides = None):
+        # Returns the mass action rate equations d[species]/dt as a list of sympy expressions in species order
+        import sympy as sp # Slow to import, so only load it when it's used
+        species_variables = [x.variable for x in self.species]
+        equation_terms = [[] for x in self.species]
+        for rate_constant, reaction_reactants, reaction_products in zip(self.get_parameters(parameter_overrides), self.reactants, self.products):
+            rate = rate_constant * sp.Mul(*[species_variables[i]**n for i, n in reaction_reactants])
+            for species_index, coefficient in reaction_reactants:
+                equation_terms[species_index].append(-coefficient * rate)
+            for species_index, coefficient in reaction_products:
+                equation_terms[species_index].append(coefficient * rate)
+        return [sp.Add(*x) for x in equation_terms]
+    
+    def lambdify_rate_equations(self, parameter_overrides = None):
+        # Returns a function f(S, k) of the state and rate constant arrays that gives the array of d[species]/dt in species order
+        # Needs indexed variables from Network.autovariable(indexed = True), so the generated code indexes into two arrays
+        # instead of taking one argument per state and rate constant
+        import sympy as sp # Slow to import, so only load it when it's used
+        variables = [x.variable for x in self.species] + [x.variable for x in self.reactions]
+        if not self.reactions or not all(isinstance(x, sp.Indexed) for x in variables):
+            raise ValueError('Rate equations can only be lambdified with indexed variables, run Network.autovariable(indexed = True) first.')
+        equations_function = sp.lambdify((self.species[0].variable.base, self.reactions[0].variable.base), self.rate_equations(parameter_overrides), modules = 'numpy')
+        return lambda S, k: np.array(equations_function(S, k), dtype = float)
+    
+    def reactant_order_matrix(self):
+        # Returns a scipy.sparse CSR matrix (reactions x species) of the reactant coefficients, the reaction orders for mass action rates
+        return self._coefficient_matrix(self.reactants)
+    
+    def product_matrix(self):
+        # Returns a scipy.sparse CSR matrix (reactions x species) of the product coefficients
+        return self._coefficient_matrix(self.products)
+    
+    def stoichiometry_matrix(self):
+        # Returns a scipy.sparse CSR matrix (species x reactions) of the net change of each species in each reaction
+        return (self.product_matrix() - self.reactant_order_matrix()).T.tocsr()
+    
+    def to_rows(self):
+        # Returns the table as a list of (rate constant number, reaction type name, reactant symbols, product symbols) tuples
+        rows = []
+        for current_reaction, reaction_reactants, reaction_products in zip(self.reactions, self.reactants, self.products):
+            reactant_symbols = tuple(self.species[i].symbol for i, n in reaction_reactants for repeat in range(n))
+            product_symbols = tuple(self.species[i].symbol for i, n in reaction_products for repeat in range(n))
+            rows.append((current_reaction.number, type(current_reaction).__name__, reactant_symbols, product_symbols))
+        return rows
+    
+    def _coefficient_matrix(self, coefficient_lists):
+        # Helper function to make a sparse reactions x species matrix from lists of (species index, coefficient) tuples
+        import scipy.sparse # Slow to import, so only load it when it's used
+        row_counts = [len(x) for x in coefficient_lists]
+        rows = np.repeat(np.arange(len(coefficient_lists)), row_counts)
+        columns = np.array([i for x in coefficient_lists for i, n in x], dtype = np.int64)
+        values = np.array([n for x in coefficient_lists for i, n in x], dtype = np.int64)
+        return scipy.sparse.csr_matrix((values, (rows, columns)), shape = (len(coefficient_lists), len(self.species)))
+
+# Define class for storing large networks in arrays instead of State objects
+class CompactNetwork(object):
+    # Optional, memory efficient store for large combinatorial networks
+    # Components and conformations are stored as small integer codes in NumPy arrays, internal links in a flat CSR-style array,
+    # and state and edge attributes as columns. State and StateTransition objects are only made when asked for.
+    
+    # Transition types that can be stored in the edge columns
+    transition_types = [Association, Dissociation, Conversion, RE_Association, RE_Dissociation, RE_Conversion]
+    
+    def __init__(self):
+        # Code tables
+        self.component_table = [] # Code -> Drug or Protein object
+        self.conformation_table = [None] # Code -> None (drugs) or tuple of conformation indices
+        self.link_element_table = [] # Code -> nested link element, stored in the link array as -(code + 1)
+        self._component_codes = {}
+        self._conformation_codes = {None: 0}
+        self._link_element_codes = {}
+        self._transition_type_codes = {x: i for i, x in enumerate(self.transition_types)}
+        
+        # State columns, the elements of state i are at positions element_offsets[i] to element_offsets[i + 1]
+        # and its links are at positions link_offsets[i] to link_offsets[i + 1] of the link arrays
+        self._element_offsets = _GrowableArray(np.int64, [0])
+        self._element_components = _GrowableArray(np.int32)
+        self._element_conformations = _GrowableArray(np.int32)
+        self._link_offsets = _GrowableArray(np.int64, [0])
+        self._link_elements1 = _GrowableArray(np.int32)
+        self._link_elements2 = _GrowableArray(np.int32)
+        self._state_numbers = _GrowableArray(np.int64)
+        self.state_symbols = []
+        self.state_names = []
+        self._state_key_index = {} # Canonical state key -> state index
+        
+        # Edge columns
+        self._edge_tails = _GrowableArray(np.int64)
+        self._edge_heads = _GrowableArray(np.int64)
+        self._edge_types = _GrowableArray(np.int8)
+        self._edge_numbers = _GrowableArray(np.int64) # 0 when the transition has no number
+        self._edge_reference_directions = _GrowableArray(np.bool_)
+        
+        # States that have been made on request, only kept while in use elsewhere
+        self._state_views = weakref.WeakValueDictionary()
+    
+    # Read-only views of the columns
+    element_offsets = property(lambda self: self._element_offsets.array)
+    element_components = property(lambda self: self._element_components.array)
+    element_conformations = property(lambda self: self._element_conformations.array)
+    link_offsets = property(lambda self: self._link_offsets.array)
+    link_elements1 = property(lambda self: self._link_elements1.array)
+    link_elements2 = property(lambda self: self._link_elements2.array)
+    state_numbers = property(lambda self: self._state_numbers.array)
+    edge_tails = property(lambda self: self._edge_tails.array)
+    edge_heads = property(lambda self: self._edge_heads.array)
+    edge_types = property(lambda self: self._edge_types.array)
+    edge_numbers = property(lambda self: self._edge_numbers.array)
+    
+    @classmethod
+    def from_graph(cls, graph):
+        # Make a compact network from a networkx graph of States with StateTransition 'reaction_type' edge data
+        compact_network = cls()
+        state_indices = {}
+        for current_state in graph:
+            state_indices[current_state] = compact_network.add_state_object(current_state)
+        for tail_state, head_state, STobj in graph.edges.data('reaction_type'):
+            compact_network.add_edge(state_indices[tail_state], state_indices[head_state], STobj)
+        return compact_network
+    
+    def to_graph(self):
+        # Make a networkx graph with State and StateTransition objects for all the stored states and edges
+        graph = nx.DiGraph()
+        state_list = [self.get_state(x) for x in range(self.number_of_states())]
+        graph.add_nodes_from(state_list)
+        for edge_index in range(self.number_of_edges()):
+            graph.add_edge(state_list[self._edge_tails[edge_index]], state_list[self._edge_heads[edge_index]], reaction_type = self.get_transition(edge_index))
+        return graph
+    
+    def number_of_states(self):
+        return len(self._state_numbers)
+    
+    def number_of_edges(self):
+        return len(self._edge_tails)
+    
+    def nbytes(self):
+        # Total size of the state and edge columns in bytes
+        return sum(x.nbytes for x in [self._element_offsets, self._element_components, self._element_conformations, self._link_offsets, 
+                                      self._link_elements1, self._link_elements2, self._state_numbers, self._edge_tails, self._edge_heads,
+                                      self._edge_types, self._edge_numbers, self._edge_reference_directions])
+    
+    def add_state(self, component_list, conformation_list, link_list, number = 0, symbol = '', name = ''):
+        # Adds a state described by component, conformation and internal link lists, returns the index of the state
+        # If an equivalent state is already stored, nothing is added and the index of the existing state is returned
+        state_key = create_state_key(component_list, conformation_list, link_list)
+        state_index = self._state_key_index.get(state_key)
+        if state_index != None:
+            return state_index
+        
+        # Store components in the order of State.generate_component_list, all drugs first, then proteins
+        ordered_elements = [x for x in zip(component_list, conformation_list) if isinstance(x[0], Drug)] + \
+                           [x for x in zip(component_list, conformation_list) if isinstance(x[0], Protein)]
+        if [x[0] for x in ordered_elements] != list(component_list):
+            raise ValueError('Components must be listed with all drugs first, then proteins')
+        self._element_components.extend([self._get_code(current_component, self._component_codes, self.component_table) for current_component, current_conf in ordered_elements])
+        self._element_conformations.extend([self._get_code(None if current_conf == None else tuple(current_conf), self._conformation_codes, self.conformation_table) 
+                                            for current_component, current_conf in ordered_elements])
+        self._element_offsets.append(len(self._element_components))
+        
+        # Store the links
+        for current_link in link_list:
+            if len(current_link) != 2:
+                raise ValueError('Internal links must have two elements')
+            self._link_elements1.append(self._encode_link_element(current_link[0]))
+            self._link_elements2.append(self._encode_link_element(current_link[1]))
+        self._link_offsets.append(len(self._link_elements1))
+        
+        # Store the attributes
+        state_index = self.number_of_states()
+        self._state_numbers.append(number)
+        self.state_symbols.append(symbol)
+        self.state_names.append(name)
+        self._state_key_index[state_key] = state_index
+        return state_index
+    
+    def add_state_object(self, state):
+        # Adds a copy of a State, returns the index of the state
+        return self.add_state(*state.generate_component_list(), state.internal_links, state.number, state.symbol, state.name)
+    
+    def find_state(self, component_list, conformation_list, link_list):
+        # Returns the index of a stored state equivalent to the one described, or None if there isn't one
+        return self._state_key_index.get(create_state_key(component_list, conformation_list, link_list))
+    
+    def add_edge(self, tail_index, head_index, STobj):
+        # Adds an edge between two stored states with the type, number and direction of the given StateTransition, returns the index of the edge
+        if STobj.__class__ not in self._transition_type_codes:
+            raise ValueError('Transition type cannot be stored')
+        self._edge_tails.append(tail_index)
+        self._edge_heads.append(head_index)
+        self._edge_types.append(self._transition_type_codes[STobj.__class__])
+        self._edge_numbers.append(0 if STobj.number == None else STobj.number)
+        self._edge_reference_directions.append(getattr(STobj, 'reference_direction', True))
+        return self.number_of_edges() - 1
+    
+    def get_component_list(self, state_index):
+        # Returns the component and conformation lists of a stored state, in the same form as State.generate_component_list
+        start, end = self._element_offsets[state_index], self._element_offsets[state_index + 1]
+        component_list = [self.component_table[x] for x in self._element_components[start:end]]
+        conformation_list = [None if self.conformation_table[x] == None else list(self.conformation_table[x]) for x in self._element_conformations[start:end]]
+        return component_list, conformation_list
+    
+    def get_internal_links(self, state_index):
+        # Returns the internal link list of a stored state
+        start, end = self._link_offsets[state_index], self._link_offsets[state_index + 1]
+        return [(self._decode_link_element(x), self._decode_link_element(y)) for x, y in zip(self._link_elements1[start:end], self._link_elements2[start:end])]
+    
+    def get_state(self, state_index):
+        # Returns a State for a stored state, the same State is given back as long as it is still in use
+        state = self._state_views.get(state_index)
+        if state is None:
+            if not 0 <= state_index < self.number_of_states():
+                raise IndexError('State index out of range')
+            component_list, conformation_list = self.get_component_list(state_index)
+            state = State()
+            state.add_component_list(component_list, conformation_list)
+            state.internal_links = self.get_internal_links(state_index)
+            state.number = int(self._state_numbers[state_index])
+            state.symbol = self.state_symbols[state_index]
+            state.name = self.state_names[state_index]
+            self._state_views[state_index] = state
+        return state
+    
+    def get_transition(self, edge_index):
+        # Returns a new StateTransition for a stored edge
+        transition_type = self.transition_types[self._edge_types[edge_index]]
+        if transition_type == Conversion:
+            STobj = Conversion(bool(self._edge_reference_directions[edge_index]))
+        else:
+            STobj = transition_type()
+        if self._edge_numbers[edge_index] != 0:
+            STobj.number = int(self._edge_numbers[edge_index])
+        return STobj
+    
+    def _get_code(self, value, code_dict, code_table):
+        # Helper function that returns the integer code for a value, adding it to the code table if needed
+        code = code_dict.get(value)
+        if code == None:
+            code = len(code_table)
+            code_dict[value] = code
+            code_table.append(value)
+        return code
+    
+    def _encode_link_element(self, link_element):
+        # Component indices are stored directly, nested elements are stored as negative codes
+        if isinstance(link_element, tuple):
+            return -(self._get_code(link_element, self._link_element_codes, self.link_element_table) + 1)
+        return link_element
+    
+    def _decode_link_element(self, code):
+        if code < 0:
+            return self.link_element_table[-code - 1]
+        return int(code)
+
+
+class _GrowableArray(object):
+    # Append-only 1D NumPy array that doubles its storage as needed
+    __slots__ = ('_buffer', '_length')
+    
+    def __init__(self, dtype, initial_values = ()):
+        self._buffer = np.zeros(max(len(initial_values), 16), dtype = dtype)
+        self._buffer[:len(initial_values)] = initial_values
+        self._length = len(initial_values)
+    
+    def __len__(self):
+        return self._length
+    
+    def __getitem__(self, key):
+        return self._buffer[:self._length][key]
+    
+    @property
+    def array(self):
+        # Read-only view of the stored values
+        view = self._buffer[:self._length]
+        view.flags.writeable = False
+        return view
+    
+    @property
+    def nbytes(self):
+        return self._buffer.nbytes
+    
+    def append(self, value):
+        self._reserve(self._length + 1)
+        self._buffer[self._length] = value
+        self._length += 1
+    
+    def extend(self, values):
+        self._reserve(self._length + len(values))
+        self._buffer[self._length:self._length + len(values)] = values
+        self._length += len(values)
+    
+    def _reserve(self, length):
+        # Grow the buffer to at least the given length
+        if length > len(self._buffer):
+            new_buffer = np.zeros(max(length, 2 * len(self._buffer)), dtype = self._buffer.dtype)
+            new_buffer[:self._length] = self._buffer[:self._length]
+            self._buffer = new_buffer
+
+
 class CountingSignature(HasTraits):
     # Used for storing information about the number of elements involved in state to state transistion reactions
     # Two use modes with 1st parameter "count_type":
@@ -923,5 +1815,174 @@ class CountingSignature(HasTraits):
             # Convert the conformation lists to hashable tuples
             hashable_conformations = [(*x,) if x != None else x for x in conformations]
             return Counter([*zip(components, hashable_conformations)])
-        
-    
\ No newline at end of file
+    
+    def freeze(self, alphabet):
+    # Make an immutable FrozenSignature with the same counts, using the given SignatureAlphabet
+        return FrozenSignature(self.count_type, alphabet, self.subject_count, self.object_count, self.third_state_count)
+
+# Define class for numbering the elements counted by signatures
+class SignatureAlphabet(object):
+    # Append-only numbering of the hashable elements (components, or (component, conformation) tuples) counted in signatures
+    # All the frozen signatures of a model share one alphabet, so their count vectors line up
+    __slots__ = ('_element_index',)
+    
+    def __init__(self):
+        self._element_index = {}
+    
+    def __len__(self):
+        return len(self._element_index)
+    
+    def index(self, element):
+        # Returns the vector position of an element, adding it to the alphabet if it is new
+        position = self._element_index.get(element)
+        if position == None:
+            position = len(self._element_index)
+            self._element_index[element] = position
+        return position
+    
+    def count_vector(self, count):
+        # Convert a Counter into a read-only vector of counts
+        positions = [(self.index(element), number) for element, number in count.items() if number > 0]
+        vector = np.zeros(len(self), dtype = np.int64)
+        for position, number in positions:
+            vector[position] = number
+        vector.flags.writeable = False
+        return vector
+    
+    def stack(self, vectors):
+        # Stack count vectors into a matrix with one row per vector
+        # Vectors made before the alphabet grew are padded with zeros
+        matrix = np.zeros((len(vectors), len(self)), dtype = np.int64)
+        for row, vector in enumerate(vectors):
+            matrix[row, :len(vector)] = vector
+        return matrix
+
+# Define class for immutable signatures used during network generation
+class FrozenSignature(object):
+    # Immutable and hashable version of CountingSignature, counts are stored as integer vectors over a SignatureAlphabet
+    # Parts of the signature that were not counted are stored as None
+    __slots__ = ('count_type', 'alphabet', 'subject_vector', 'object_vector', 'third_state_vector')
+    
+    _part_names = {'subject': 'subject_vector', 'object': 'object_vector', 'third_state': 'third_state_vector'}
+    
+    def __init__(self, count_type, alphabet, subject_count = None, object_count = None, third_state_count = None):
+        # Add all the elements to the alphabet first, so all the parts have vectors of the same length
+        for count in [subject_count, object_count, third_state_count]:
+            if count != None:
+                for element in count:
+                    alphabet.index(element)
+        object.__setattr__(self, 'count_type', count_type)
+        object.__setattr__(self, 'alphabet', alphabet)
+        object.__setattr__(self, 'subject_vector', None if subject_count == None else alphabet.count_vector(subject_count))
+        object.__setattr__(self, 'object_vector', None if object_count == None else alphabet.count_vector(object_count))
+        object.__setattr__(self, 'third_state_vector', None if third_state_count == None else alphabet.count_vector(third_state_count))
+    
+    def __setattr__(self, name, value):
+        raise AttributeError('FrozenSignature objects cannot be changed')
+    
+    def __delattr__(self, name):
+        raise AttributeError('FrozenSignature objects cannot be changed')
+    
+    def get_vector(self, part, length = None):
+        # Returns the count vector for the 'subject', 'object', or 'third_state' part, padded with zeros to the given length
+        if part not in self._part_names:
+            raise ValueError("Function supplied with incorrect option for parameter 'part'")
+        vector = getattr(self, self._part_names[part])
+        if vector is None or length == None or length == len(vector):
+            return vector
+        padded_vector = np.zeros(length, dtype = np.int64)
+        padded_vector[:len(vector)] = vector
+        return padded_vector
+    
+    def __sub__(self, other):
+        # Part by part subtraction, like a Counter the result never has negative counts
+        if not self._compatible(other):
+            return NotImplemented
+        length = len(self.alphabet)
+        new_vectors = []
+        for part in ['subject', 'object', 'third_state']:
+            vector = self.get_vector(part, length)
+            other_vector = other.get_vector(part, length)
+            if vector is None or other_vector is None:
+                new_vectors.append(vector)
+            else:
+                new_vectors.append(np.maximum(vector - other_vector, 0))
+        return self._from_vectors(self.count_type, self.alphabet, *new_vectors)
+    
+    def contains(self, other):
+        # Returns True if each part of this signature has at least the counts of the other signature
+        if not self._compatible(other):
+            raise ValueError('Signatures must have the same count type and alphabet')
+        length = len(self.alphabet)
+        for part in ['subject', 'object', 'third_state']:
+            other_vector = other.get_vector(part, length)
+            if other_vector is None:
+                continue
+            vector = self.get_vector(part, length)
+            if vector is None or not np.all(vector >= other_vector):
+                return False
+        return True
+    
+    def __eq__(self, other):
+        if not isinstance(other, FrozenSignature):
+            return NotImplemented
+        return self._compatible(other) and self._hash_key() == other._hash_key()
+    
+    def __hash__(self):
+        return hash(self._hash_key())
+    
+    def _compatible(self, other):
+        return isinstance(other, FrozenSignature) and self.count_type == other.count_type and self.alphabet is other.alphabet
+    
+    def _hash_key(self):
+        # Trailing zeros are dropped so the key does not change when the alphabet grows
+        key = [self.count_type]
+        for vector in [self.subject_vector, self.object_vector, self.third_state_vector]:
+            if vector is None:
+                key.append(None)
+            else:
+                nonzero_positions = np.flatnonzero(vector)
+                key.append(tuple(vector[:nonzero_positions[-1] + 1]) if len(nonzero_positions) > 0 else ())
+        return tuple(key)
+    
+    @classmethod
+    def _from_vectors(cls, count_type, alphabet, subject_vector, object_vector, third_state_vector):
+        # Make a signature directly from count vectors
+        new_signature = cls.__new__(cls)
+        object.__setattr__(new_signature, 'count_type', count_type)
+        object.__setattr__(new_signature, 'alphabet', alphabet)
+        for name, vector in [('subject_vector', subject_vector), ('object_vector', object_vector), ('third_state_vector', third_state_vector)]:
+            if vector is not None:
+                vector = np.array(vector, dtype = np.int64)
+                vector.flags.writeable = False
+            object.__setattr__(new_signature, name, vector)
+        return new_signature
+    
+    
+# Helper functions for canonical state keys
+def create_state_key(component_list, conformation_list, link_list):
+    # Returns a canonical, hashable key for a state described by component, conformation and internal link lists
+    # Components are identified by their ID and sorted so the key does not depend on the order of the lists
+    # Links are translated into the components they connect, so equivalent link structures give the same key
+
+    # Make a hashable and sortable description of each component/conformation pair
+    element_keys = [_state_key_element(component, conformation) for component, conformation in zip(component_list, conformation_list)]
+
+    # Links are unordered pairs of (possibly nested) link elements
+    link_keys = [tuple(sorted(_state_key_link_element(link_element, element_keys) for link_element in link)) for link in link_list]
+
+    return (tuple(sorted(element_keys)), tuple(sorted(link_keys)))
+
+def _state_key_element(component, conformation):
+    # Key for a single component/conformation pair, drugs use an empty conformation tuple
+    if conformation == None:
+        return ('c', component.ID, ())
+    else:
+        return ('c', component.ID, (*conformation,))
+
+def _state_key_link_element(link_element, element_keys):
+    # Recursively translate a link tuple tree into the keys of the components it references
+    if isinstance(link_element, int):
+        return element_keys[link_element]
+    else:
+        return ('t', tuple(_state_key_link_element(x, element_keys) for x in link_element))
@@ -1,9 +1,6 @@
 """Class for the solver object used throughout the program.
 """
 
-import networkx as nx
-import matplotlib as mpl
-import matplotlib.pyplot as plt
 import networkx as nx
 import bikipy.bikicore.model as bkcm
 import bikipy.bikicore.components as bkcc
@@ -18,3 +18,9 @@ class RuleNotValidError(BikipyException):
     def __init__(self, message = ''):
         super().__init__(message)
 
+class SimulationError(BikipyException):
+    """Exception for when the integrator fails to solve a model's rate equations."""
+    
+    # Hand message to the base exception module
+    def __init__(self, message = ''):
+        super().__init__(message)
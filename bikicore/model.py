@@ -2,14 +2,120 @@
 """
 
 import uuid
+import time
+import math
 import itertools
+import collections
+import contextlib
+import concurrent.futures
+import numpy as np
 import networkx as nx
-import matplotlib as mpl
-import matplotlib.pyplot as plt
+from collections import Counter
 import bikipy.bikicore.components as bkcc
-from traits.api import HasTraits, Int, Str, Instance, This, List
+from traits.api import HasTraits, Int, Str, Float, Any, Instance, This, List, Dict, Bool
 
 
+# Lightweight copy of a graph's structure for drawing later, the edges are pairs of indices into the node label list
+GraphSnapshot = collections.namedtuple('GraphSnapshot', ['label', 'node_labels', 'edges'])
+
+def take_graph_snapshot(graph, label, ID_labels = False):
+    # Record the nodes and edges of a state graph as a GraphSnapshot, node order is kept for the layout
+    node_index = {}
+    node_labels = []
+    for current_index, current_state in enumerate(graph):
+        node_index[current_state] = current_index
+        if ID_labels:
+            node_labels.append(str(current_state.ID)[-4:])
+        else:
+            node_labels.append(r'$' + current_state.symbol + '$')
+    edges = [(node_index[tail], node_index[head]) for tail, head in graph.edges()]
+    return GraphSnapshot(label, node_labels, edges)
+
+def render_graph_snapshot(snapshot, file_format = 'png', dpi = 500, figsize = (16, 12)):
+    # Draw a GraphSnapshot and save it to a file named after the snapshot label, returns the file name
+    # Doesn't use pyplot, so it is safe to call from a worker process or thread
+    from matplotlib.figure import Figure # Slow to import, so only load it when drawing
+    G = nx.DiGraph()
+    G.add_nodes_from(range(len(snapshot.node_labels)))
+    G.add_edges_from(snapshot.edges)
+    
+    # Draw the pieces
+    figure = Figure(figsize = figsize)
+    axes = figure.add_subplot(1, 1, 1)
+    pos = nx.circular_layout(G)  # positions for all nodes
+    nx.draw_networkx_nodes(G, pos, ax = axes)
+    nx.draw_networkx_edges(G, pos, ax = axes)
+    nx.draw_networkx_labels(G, pos, dict(enumerate(snapshot.node_labels)), font_size = 6, ax = axes)
+    
+    # Save in the requested format, dpi doesn't change vector formats like svg
+    file_name = snapshot.label + '.' + file_format
+    figure.savefig(file_name, format = file_format, dpi = dpi)
+    return file_name
+
+# Statistics for one rule applied during one cycle of network generation
+class RuleCycleStats(HasTraits):
+    
+    # Initalize traits
+    rule = Instance(bkcc.Rule)
+    cycle = Int
+    wall_time = Float # Seconds
+    candidate_states = Int # States that fit the rule description
+    candidate_pairs = Int # Pairs, splits, conversions, or competing index sets that passed signature matching and were tested for internal links
+    signature_comparisons = Int # Query signatures compared against reference signatures
+    valid_reactions = Int # Candidates that passed the internal link test
+    nodes_added = Int
+    edges_added = Int
+    nodes_removed = Int
+    edges_removed = Int
+
+# Collects RuleCycleStats records from Model.generate_network or Model.apply_rules_to_network
+class GenerationStats(HasTraits):
+    
+    # Initalize traits
+    records = List(Instance(RuleCycleStats))
+    callback = Any # Optional callable, called with each new RuleCycleStats record
+    current_cycle = Int # Cycle number given to new records, set by generate_network
+    labeling_times = Dict(Str, Float) # Seconds spent in each of the network's automatic labeling methods, set by generate_network
+    
+    def add_record(self, record):
+        # Store a new record and pass it on to the callback
+        self.records.append(record)
+        if self.callback != None:
+            self.callback(record)
+    
+    def totals_by_rule(self):
+        # Returns a dictionary of rule -> RuleCycleStats with the values summed over all cycles, cycle is set to the number of cycles
+        totals = {}
+        for current_record in self.records:
+            if current_record.rule not in totals:
+                totals[current_record.rule] = RuleCycleStats(rule = current_record.rule)
+            rule_total = totals[current_record.rule]
+            rule_total.cycle += 1
+            for current_name in self._summed_names:
+                setattr(rule_total, current_name, getattr(rule_total, current_name) + getattr(current_record, current_name))
+        return totals
+    
+    def report(self):
+        # Returns a text table of the totals for each rule, slowest rule first
+        header = ['rule', 'cycles'] + self._summed_names
+        lines = ['\t'.join(header)]
+        totals = sorted(self.totals_by_rule().values(), key = lambda x: x.wall_time, reverse = True)
+        for rule_total in totals:
+            line = [self._describe_rule(rule_total.rule), str(rule_total.cycle)]
+            line += ['{:.4f}'.format(rule_total.wall_time)] + [str(getattr(rule_total, x)) for x in self._summed_names[1:]]
+            lines.append('\t'.join(line))
+        return '\n'.join(lines)
+    
+    def _describe_rule(self, rule):
+        # Helper function to write a short description of a rule, e.g. "A associates with R"
+        subject_symbols = ''.join(x.symbol for x in rule.rule_subject)
+        object_symbols = ''.join(x.symbol for x in rule.rule_object)
+        return subject_symbols + rule.rule + object_symbols
+    
+    # Names of the values that are summed for the totals, wall_time must be first
+    _summed_names = ['wall_time', 'candidate_states', 'candidate_pairs', 'signature_comparisons', 'valid_reactions', 
+                     'nodes_added', 'edges_added', 'nodes_removed', 'edges_removed']
+
 # Model class
 class Model(HasTraits):
     
@@ -22,6 +128,9 @@ class Model(HasTraits):
     protein_list = List(Instance(bkcc.Protein))
     # compartment_list = List(bkcc.Compartment) #To be implemented in future
     rule_list = List(Instance(bkcc.Rule))
+    signature_alphabet = Instance(bkcc.SignatureAlphabet, ()) # Shared numbering for the count vectors of frozen signatures
+    graph_snapshots = List() # GraphSnapshots recorded by generate_network with save_graphs = True
+    indexed_variables = Bool(False) # Passed on to the generated Network, see Network.autovariable()
     
     def __init__(self, number, name, parent_model, *args, **kwargs):
         super().__init__(*args, **kwargs) # Make sure to call the HasTraits initialization machinery
@@ -33,59 +142,85 @@ class Model(HasTraits):
         self.protein_list = []
         self.rule_list = []
     
-    def generate_network(self, max_cycles=20, save_graphs=False):
+    def generate_network(self, max_cycles=20, save_graphs=False, stats=None, graph_format='png', graph_dpi=500, render_in_worker=False, bulk=True):
         # Create a new network graph of the model by using the list of rules. 
+        # Parameters:
+            # save_graphs - bool, default = False. If True, a snapshot of the graph is recorded at the start and after each cycle,
+            #   and the snapshots are drawn to files once the network is finished.
+            # stats - GenerationStats or None, default = None. If given, a record is added to it for each rule in each cycle.
+            # graph_format, graph_dpi - file format ('png', 'svg', 'pdf', ...) and resolution of the saved graphs
+            # render_in_worker - bool, default = False. If True, the saved graphs are drawn in a separate worker process, which keeps
+            #   matplotlib out of this process. This is not background rendering, generate_network() still waits for the files to be written.
+            # bulk - bool, default = True. If True, the states and transitions are built in a bkcc.bulk_build() context.
+            #   False builds them with full traits validation and notifications, e.g. to measure what the bulk mode saves.
+        # Returns a list of the saved graph file names
+        
+        # Build all the states and transitions in bulk, they are validated together at the end
+        self.graph_snapshots = []
+        with bkcc.bulk_build() if bulk else contextlib.nullcontext():
+            self._generate_network(max_cycles, save_graphs, stats)
+        
+        # Draw any snapshots now that generation is done
+        return self.render_graph_snapshots(graph_format, graph_dpi, render_in_worker)
+        
+    def _generate_network(self, max_cycles, save_graphs, stats):
+        # Does the work for generate_network
         
         # Create a new Network object
-        self.network = bkcc.Network()
+        self.network = bkcc.Network(indexed_variables = self.indexed_variables)
       
         # Add singleton states to graph
         for current_component in self.drug_list:
-            new_state = bkcc.State()
-            new_state.required_drug_list = [current_component]
-            new_state.required_protein_list = []
-            new_state.req_protein_conf_lists = []
+            new_state = bkcc.State.from_lists([current_component], [None], [])
             self.network.main_graph.add_node(new_state)
         for current_component in self.protein_list:
             for current_conformation in range(len(current_component.conformation_names)):
-                new_state = bkcc.State()
-                new_state.required_drug_list = []
-                new_state.required_protein_list = [current_component]
-                new_state.req_protein_conf_lists = [[current_conformation]]
+                new_state = bkcc.State.from_lists([current_component], [[current_conformation]], [])
                 self.network.main_graph.add_node(new_state)
         
+        # Compile the rules once for the whole run, rules that are edited later will recompile themselves when needed
+        for current_rule in self.rule_list:
+            current_rule.compile_rule()
+        
         # After creating the singleton graph, reapply the network rules until no more changes happen
-        old_network = self.network.main_graph.copy()
+        # Each rule remembers which states it has already been applied to, so a cycle only looks at matches involving
+        # the frontier of states created since that rule last ran
+        applied_states = {}
         current_cycle_number = 0
         if save_graphs: 
-            self._fancy_graph_draw('singleton_start_graph', None, True)
+            self.graph_snapshots.append(take_graph_snapshot(self.network.main_graph, 'singleton_start_graph', True))
         while current_cycle_number <= max_cycles:
-            self.apply_rules_to_network()
-#            self._main_graph_dump('Graph_0')
-#            print('Graph size = ', self.network.main_graph.number_of_nodes())
-            # Check if graph changed
-            if nx.algorithms.isomorphism.is_isomorphic(old_network, self.network.main_graph):
-#                self._main_graph_dump('Final_graph')
-#                print('Graph size = ', self.network.main_graph.number_of_nodes())
+            if stats != None:
+                stats.current_cycle = current_cycle_number
+            graph_changes = self.apply_rules_to_network(applied_states = applied_states, stats = stats)
+            
+            # Check if any nodes or edges were added or removed
+            if sum(graph_changes.values()) == 0:
                 if save_graphs: 
-                    self._fancy_graph_draw('last_graph', None, True)
+                    self.graph_snapshots.append(take_graph_snapshot(self.network.main_graph, 'last_graph', True))
                 break
             else:
-                old_network = self.network.main_graph.copy()
                 current_cycle_number += 1
                 if save_graphs: 
-                    self._fancy_graph_draw('intermediate_graph{}'.format(current_cycle_number), None, True)
-#                self._main_graph_dump('Graph_' + str(current_cycle_number))
-#                print('Graph size = ', self.network.main_graph.number_of_nodes())
+                    self.graph_snapshots.append(take_graph_snapshot(self.network.main_graph, 'intermediate_graph{}'.format(current_cycle_number), True))
                 
         # Now run the automatic labeling methods - States get all these things, edges get a number and variable
-        self.network.autosymbol()
-        self.network.autonumber()
-        self.network.autoname()
-        self.network.autovariable()
+        for current_method in ['autosymbol', 'autonumber', 'autoname', 'autovariable']:
+            if stats == None:
+                getattr(self.network, current_method)()
+            else:
+                start_time = time.perf_counter()
+                getattr(self.network, current_method)()
+                stats.labeling_times[current_method] = time.perf_counter() - start_time
         
-    def apply_rules_to_network(self, graph = None):
+    def apply_rules_to_network(self, graph = None, applied_states = None, stats = None):
         # Apply the model's rules to an existing graph
+        # Parameters:
+            # graph - networkx DiGraph, default is the main graph
+            # applied_states - dict or None, default = None. Maps each rule to the set of states it has already been applied to and is
+            #   updated in place. Only matches involving at least one state new to the rule are made. None applies every rule to every state.
+            # stats - GenerationStats or None, default = None. If given, a RuleCycleStats record is added to it for each rule.
+        # Returns a Counter with the number of nodes and edges added to and removed from the graph
 
         # If default, work on the main graph
         if graph == None:
@@ -93,7 +228,27 @@ class Model(HasTraits):
             graph_blacklist = self.network.main_graph_blacklist
         
         # Apply each rule to the graph
+        graph_changes = Counter()
         for current_rule in self.rule_list:
+            compiled_rule = current_rule.get_compiled_rule()
+            rule_changes = Counter()
+            
+            # Only count things if someone is collecting the statistics
+            if stats == None:
+                rule_counts = None
+            else:
+                rule_counts = Counter()
+                start_time = time.perf_counter()
+            
+            # Find the states that are new to this rule, in graph order
+            if applied_states == None:
+                new_state_list = None
+                new_states = None
+            else:
+                old_states = applied_states.setdefault(current_rule, set())
+                new_state_list = [x for x in graph if x not in old_states]
+                new_states = set(new_state_list)
+                old_states.update(new_states)
 
             # Each type of rule needs a different treatment
             
@@ -101,116 +256,185 @@ class Model(HasTraits):
             if current_rule.rule == ' associates with ' or current_rule.rule == ' reversibly associates with ' \
                     or current_rule.rule == ' associates and dissociates in rapid equlibrium with ':
                 
-                #print(str(current_rule.rule_subject),',', str(current_rule.subject_conf), str(current_rule.rule), str(current_rule.rule_object),',', str(current_rule.object_conf))
                 # Get a list of accecptable signatures for the rule and read which type of signature we need
-                reference_signatures = current_rule.generate_signature_list()
+                reference_signatures = compiled_rule.get_frozen_signature_list(self.signature_alphabet)
                 
                 # Find states that fit the rule description
                 matching_subject_states = self._find_states_that_match_rule(current_rule, 'subject')
                 matching_object_states = self._find_states_that_match_rule(current_rule, 'object')
-                #print('subject_matches: ', matching_subject_states)
-                #print('object_matches: ', matching_object_states)
+                
                 # Find the possible pairings of subject and object states that create valid signatures
-                possible_state_tuple_list = self._find_association_pairs(reference_signatures, matching_subject_states, matching_object_states)
-                #print('possible tuples: ', possible_state_tuple_list)
+                possible_state_tuple_list = self._find_association_pairs(reference_signatures, matching_subject_states, matching_object_states, new_states, rule_counts)
+                
                 # Test if the a pair of states could create the implied internal structure required by the rule
                 valid_state_tuple_list, valid_link_list = self._find_association_internal_link(current_rule, possible_state_tuple_list)
-                #print('valid states: ', valid_state_tuple_list, valid_link_list)
+                if rule_counts != None:
+                    rule_counts.update(candidate_states = len(matching_subject_states) + len(matching_object_states), 
+                                       candidate_pairs = len(possible_state_tuple_list), valid_reactions = len(valid_state_tuple_list))
+                
                 # Associate any valid pairs of states 
                 for current_state_tuple, current_link_tuple in zip(valid_state_tuple_list, valid_link_list):
                     if current_rule.rule == ' associates with ':
-                        self._create_association(graph, graph_blacklist, *current_state_tuple, current_link_tuple)
+                        rule_changes += self._create_association(graph, graph_blacklist, *current_state_tuple, current_link_tuple)
                     elif current_rule.rule == ' reversibly associates with ':
-                        self._create_association(graph, graph_blacklist, *current_state_tuple, current_link_tuple, reversible = True)
+                        rule_changes += self._create_association(graph, graph_blacklist, *current_state_tuple, current_link_tuple, reversible = True)
                     elif current_rule.rule == ' associates and dissociates in rapid equlibrium with ':
-                        self._create_association(graph, graph_blacklist, *current_state_tuple, current_link_tuple, reversible = True, rapid_equlibrium = True)
+                        rule_changes += self._create_association(graph, graph_blacklist, *current_state_tuple, current_link_tuple, reversible = True, rapid_equlibrium = True)
          
             # Dissociation
             elif current_rule.rule == ' dissociates from ' or current_rule.rule == ' reversibly dissociates from ' \
                     or current_rule.rule == ' dissociates and reassociates in rapid equlibrium from ':
 
                 # Get a list of accecptable signatures for the rule and read which type of signature we need
-                reference_signatures = current_rule.generate_signature_list()
+                reference_signatures = compiled_rule.get_frozen_signature_list(self.signature_alphabet)
                 
                 # Find states that fit the rule description
-                matching_object_states = self._find_states_that_match_rule(current_rule, 'object')
+                matching_object_states = self._find_states_that_match_rule(current_rule, 'object', new_state_list)
                 
                 # Find the possible pairings of subject and object states that create valid signatures
-                possible_state_split_list = self._find_dissociation_pairs(reference_signatures, matching_object_states)
+                possible_state_split_list = self._find_dissociation_pairs(reference_signatures, matching_object_states, rule_counts)
                 
                 # Test if the a pair of states could create the implied internal structure required by the rule
                 valid_state_split_list, valid_link_lists = self._find_dissociation_internal_link(current_rule, possible_state_split_list)
+                if rule_counts != None:
+                    rule_counts.update(candidate_states = len(matching_object_states), candidate_pairs = len(possible_state_split_list), 
+                                       valid_reactions = len(valid_state_split_list))
                 
                 # Associate any valid pairs of states 
                 for current_state_split_tuple, current_link_tuple in zip(valid_state_split_list, valid_link_lists):
                     if current_rule.rule == ' dissociates from ':
-                        self._create_dissociation(graph, graph_blacklist, *current_state_split_tuple, *current_link_tuple)
+                        rule_changes += self._create_dissociation(graph, graph_blacklist, *current_state_split_tuple, *current_link_tuple)
                     elif current_rule.rule == ' reversibly dissociates from ':
-                        self._create_dissociation(graph, graph_blacklist, *current_state_split_tuple, *current_link_tuple, reversible = True)
+                        rule_changes += self._create_dissociation(graph, graph_blacklist, *current_state_split_tuple, *current_link_tuple, reversible = True)
                     elif current_rule.rule == ' dissociates and reassociates in rapid equlibrium from ':
-                        self._create_dissociation(graph, graph_blacklist, *current_state_split_tuple, *current_link_tuple, reversible = True, rapid_equlibrium = True)
+                        rule_changes += self._create_dissociation(graph, graph_blacklist, *current_state_split_tuple, *current_link_tuple, reversible = True, rapid_equlibrium = True)
             
             # Conformational changes and reactions
             elif current_rule.rule == ' converts to ' or current_rule.rule == ' reversibly converts to ' \
                     or current_rule.rule == ' converts in rapid equlibrium to ':
                 
                 # Get a list of acceptable signatures for the rule converstion rules
-                reference_signatures = current_rule.generate_signature_list()
+                reference_signatures = compiled_rule.signature_list
                 
                 # Find states that fit the rule description
-                matching_subject_states = self._find_states_that_match_rule(current_rule, 'subject')
+                matching_subject_states = self._find_states_that_match_rule(current_rule, 'subject', new_state_list)
                 
                 # Find all possible conversion reactions with the matching states, returns the components involved and what they change to, but not the internal structure
-                possible_conversion_tuples = self._find_conversion_pairs(current_rule, reference_signatures, matching_subject_states)
+                possible_conversion_tuples = self._find_conversion_pairs(current_rule, reference_signatures, matching_subject_states, rule_counts)
 
                 # Validate links for possible conversion reactions
                 valid_conversion_tuples = self._find_conversion_internal_link(current_rule, possible_conversion_tuples)
+                if rule_counts != None:
+                    rule_counts.update(candidate_states = len(matching_subject_states), candidate_pairs = len(possible_conversion_tuples), 
+                                       valid_reactions = len(valid_conversion_tuples))
                 
                 # Make the conversion
                 for convert_tuple in valid_conversion_tuples:
                     if current_rule.rule == ' converts to ':
-                        self._create_conversion(graph, graph_blacklist, *convert_tuple)
+                        rule_changes += self._create_conversion(graph, graph_blacklist, *convert_tuple)
                     if current_rule.rule == ' reversibly converts to ':
-                        self._create_conversion(graph, graph_blacklist, *convert_tuple, reversible = True) 
+                        rule_changes += self._create_conversion(graph, graph_blacklist, *convert_tuple, reversible = True) 
                     if current_rule.rule == ' converts in rapid equlibrium to ':
-                        self._create_conversion(graph, graph_blacklist, *convert_tuple, reversible = True, rapid_equlibrium = True)
+                        rule_changes += self._create_conversion(graph, graph_blacklist, *convert_tuple, reversible = True, rapid_equlibrium = True)
             
             # Competition rule
             elif current_rule.rule == ' is competitive with ':   
                 
                 # Find matching signatures
-                reference_signatures = current_rule.generate_signature_list()
+                reference_signatures = compiled_rule.signature_list
                 
                 # Find states that fit the rule description
-                matching_states = self._find_states_that_match_rule(current_rule, 'both')
+                matching_states = self._find_states_that_match_rule(current_rule, 'both', new_state_list)
                 
                 # Find all possible indieces for competing components in the matching states
-                possible_competing_tuples = self._find_competitive_states(current_rule, reference_signatures, matching_states)
+                possible_competing_tuples = self._find_competitive_states(current_rule, reference_signatures, matching_states, rule_counts)
 
                 # Validate links for matching states
                 states_to_remove = self._find_competition_internal_link(current_rule, possible_competing_tuples)
+                if rule_counts != None:
+                    rule_counts.update(candidate_states = len(matching_states), candidate_pairs = len(possible_competing_tuples), 
+                                       valid_reactions = len(states_to_remove))
                 
-                # Make the conversion
-                for current_state in states_to_remove:
-                    self._remove_states(graph, graph_blacklist, states_to_remove)
+                # Remove the competing states
+                rule_changes += self._remove_states(graph, graph_blacklist, states_to_remove)
             
             else:
                 raise ValueError("Rule not recognized")
+            
+            # Add up the changes and record the statistics for this rule
+            graph_changes += rule_changes
+            if stats != None:
+                rule_counts.update(rule_changes)
+                stats.add_record(RuleCycleStats(rule = current_rule, cycle = stats.current_cycle, wall_time = time.perf_counter() - start_time, **rule_counts))
+        
+        # Report back what changed on the graph
+        return graph_changes
     
     def reduce_graph(self, name, included_components = 'all', excluded_components = [], pseudo_1st_order_components = []):
-        pass
+        # Make a derived network of the main graph with only the states that can be made from the chosen components
+        # Parameters:
+            # name - string, name of the derived network
+            # included_components - list of components or 'all' (default), the components that are present
+            # excluded_components - list of components to remove from the included components
+            # pseudo_1st_order_components - list of components present in large excess, their free concentration is treated as constant.
+            #   Their free states are removed, and their associations become pseudo-first-order reactions of the binding partner,
+            #   with an effective rate constant of k * [free component] recorded as a parameter override of the derived network.
+        # Returns the new bkcc.DerivedNetwork
+        
+        # Find the available components, excess components must be present
+        if included_components == 'all':
+            included_components = self.drug_list + self.protein_list
+        excluded_set = set(excluded_components)
+        available_components = [x for x in included_components if x not in excluded_set]
+        available_components += [x for x in pseudo_1st_order_components if x not in available_components]
+        
+        # States with any unavailable component are removed in one operation over the state x component matrix
+        network = self.network
+        node_mask = network.make_component_node_mask(available_components)
+        
+        # Remove the free states of the excess components
+        pseudo_set = set(pseudo_1st_order_components)
+        free_pseudo_states = [x for x in network.main_graph 
+                              if len(x.required_drug_list) + len(x.required_protein_list) == 1 and (x.required_drug_list + x.required_protein_list)[0] in pseudo_set]
+        if free_pseudo_states != []:
+            node_mask &= ~network.make_node_mask(free_pseudo_states)
+        
+        # Fold the constant concentration of the excess components into the rate constants of their associations
+        parameter_overrides = {}
+        node_positions = network.get_mask_index()[2]
+        for current_state in free_pseudo_states:
+            for u, v, STobj in network.main_graph.out_edges(current_state, 'reaction_type'):
+                if not isinstance(STobj, (bkcc.Association, bkcc.RE_Association)) or not node_mask[node_positions[v]]:
+                    continue # Only associations to a kept state use the free state as a reactant, anything else is removed with the state
+                if STobj.variable == None or current_state.variable == None:
+                    raise ValueError('Network variables are needed for pseudo-first-order reactions, run generate_network first.')
+                if all(x in free_pseudo_states for x, y in network.main_graph.in_edges(v) if network.main_graph.edges[x, y]['reaction_type'] is STobj):
+                    raise ValueError('Association between pseudo-first-order components can not be reduced to a first-order reaction.')
+                parameter_overrides[STobj.variable] = parameter_overrides.get(STobj.variable, STobj.variable) * current_state.variable
+        
+        # Make the derived network
+        return network.derive_network(name, node_mask = node_mask, parameter_overrides = parameter_overrides)
     
-    def _find_states_that_match_rule(self, rule, what_to_find):
+    def _find_states_that_match_rule(self, rule, what_to_find, candidate_states = None):
         # Helper function that looks through a graph and returns lists states that include a rule's required components
         # what_to_find = 'subject', 'object', or 'both'
+        # candidate_states = list of states to look through, default (None) is all the states in the main graph
         
         # Get the components and conformations that we are looking for
         # Note that any proteins with a [] conformation will always be last in the list
-        rule_components, rule_conformations = rule.generate_component_list(what_to_find)
+        rule_components, rule_conformations = rule.get_compiled_rule().generate_component_list(what_to_find)
+        
+        # Use the network's component index to narrow down the states in the main graph, which are then checked in full below
+        indexed_states = self.network.find_states_with_components(rule_components, rule_conformations)
+        if candidate_states == None:
+            candidate_states = indexed_states
+        else:
+            indexed_states = set(indexed_states)
+            candidate_states = [x for x in candidate_states if x in indexed_states]
 
-        # Iterate through all the graph's states and add them to the lists if they match
+        # Iterate through all the candidate states and add them to the lists if they match
         matching_states = []
-        for current_state in self.network.main_graph.__iter__():
+        for current_state in candidate_states:
             if self._state_match_to_component_lists(current_state, rule_components, rule_conformations, [], 'minimal'): # We do not worry about links here
                 matching_states.append(current_state)
 
@@ -320,28 +544,78 @@ class Model(HasTraits):
         else:
             raise ValueError('Function _compare_component_lists received an incorrect argument for parameter "match"')
     
-    def _find_association_pairs(self, reference_signatures, matching_subject_states, matching_object_states):
+    def _find_association_pairs(self, reference_signatures, matching_subject_states, matching_object_states, new_states = None, counts = None):
         # Function that returns a list of 2-tuples containing a valid subject and object state pair for an association reaction
-        
-        # Get the type of signatures required
-        count_type = reference_signatures[0].count_type
-        
-        # Loop through all the possible combinations of subject and object states and store any valid pairs
+        # If a set of new states is given, only pairs with at least one new state are tested. Pairs keep the same order either way.
+        # If a Counter is given for counts, the number of signature comparisons is added to it
+        # The reference signatures must be FrozenSignatures over the model's signature alphabet
+        
+        # The subject part of an association signature only depends on the subject state, and the object part only on the object state.
+        # Find which reference signatures each state can satisfy on its own side, written as a bitmask over the reference list.
+        subject_masks = self._association_signature_masks(matching_subject_states, 'subject', reference_signatures)
+        object_masks = self._association_signature_masks(matching_object_states, 'object', reference_signatures)
+        if counts != None:
+            counts['signature_comparisons'] += (len(matching_subject_states) + len(matching_object_states)) * len(reference_signatures)
+        
+        # Bucket the object states by bitmask, keeping their positions so the original pair order can be restored
+        object_buckets = {}
+        for position, (current_obj, current_mask) in enumerate(zip(matching_object_states, object_masks)):
+            if current_mask != 0:
+                object_buckets.setdefault(current_mask, []).append((position, current_obj))
+        
+        # A pair is valid when both states satisfy the same reference signature, so only join compatible buckets
         valid_pairs = []
-        for current_tuple in itertools.product(matching_subject_states, matching_object_states):
-
-            # Create a signature from the current pair
-            test_signature = bkcc.CountingSignature(count_type, *current_tuple)
-            sub_comp, sub_conf = current_tuple[0].generate_component_list()
-            obj_comp, obj_conf = current_tuple[1].generate_component_list()
-            test_signature.count_for_third_state(sub_comp + obj_comp, sub_conf + obj_conf)
+        compatible_objects = {} # Subject bitmask -> (all compatible object states, compatible object states that are new)
+        for current_sub, current_mask in zip(matching_subject_states, subject_masks):
+            if current_mask == 0:
+                continue # Can't make any valid pairs
+            
+            # Join the compatible buckets once for each kind of subject state
+            if current_mask not in compatible_objects:
+                joined_bucket = sorted(itertools.chain(*[bucket for mask, bucket in object_buckets.items() if mask & current_mask]), key = lambda x: x[0])
+                joined_states = [x[1] for x in joined_bucket]
+                if new_states == None:
+                    compatible_objects[current_mask] = (joined_states, joined_states)
+                else:
+                    compatible_objects[current_mask] = (joined_states, [x for x in joined_states if x in new_states])
             
-            # See if the test signature matches with any of the reference ones
-            if self._signature_match_association(test_signature, reference_signatures):
-                valid_pairs.append(current_tuple)
+            # Old subject states only need to be paired with new object states
+            if new_states == None or current_sub in new_states:
+                pair_objects = compatible_objects[current_mask][0]
+            else:
+                pair_objects = compatible_objects[current_mask][1]
+            valid_pairs.extend((current_sub, x) for x in pair_objects)
         
         # Give the list of tuples back
         return valid_pairs
+    
+    def _association_signature_masks(self, states, what_to_match, reference_signatures):
+        # Helper function that returns a list of integer bitmasks of the reference signatures each state satisfies as the subject or object of an association
+        # Vectorized version of _signature_match_association_part, all the states are tested against one reference signature at a time
+        # The reference signatures must be FrozenSignatures over the model's signature alphabet
+        query_matrix = self._count_state_matrix(states, reference_signatures[0].count_type)
+        length = query_matrix.shape[1]
+        
+        # Test against the matching part of each reference signature
+        signature_masks = [0] * len(states)
+        for index, refsig in enumerate(reference_signatures):
+            reference_vector = refsig.get_vector(what_to_match, length)
+            reference_third_state_vector = refsig.get_vector('third_state', length)
+            
+            # If we can find a full set of the reference associated state components in a query, we must delete them (from, i.e., a previous dimerization, etc.)
+            has_third_state = np.all(query_matrix >= reference_third_state_vector, axis = 1)
+            reduced_matrix = np.where(has_third_state[:, np.newaxis], np.maximum(query_matrix - reference_third_state_vector, 0), query_matrix)
+            
+            # We need to have at least the number of components that the reference state has, but we can have more
+            for state_index in np.flatnonzero(np.all(reduced_matrix >= reference_vector, axis = 1)):
+                signature_masks[state_index] |= 1 << index
+        return signature_masks
+    
+    def _count_state_matrix(self, states, count_type):
+        # Helper function that counts the components of each state into the rows of a matrix over the model's signature alphabet
+        counting_signature = bkcc.CountingSignature(count_type)
+        state_vectors = [self.signature_alphabet.count_vector(counting_signature._count_state(x)) for x in states]
+        return self.signature_alphabet.stack(state_vectors)
  
     def _signature_match_association(self, query_signature, reference_signatures):
         # Helper function that asks if a given query signature matches (any of) the reference signatures in an association context 
@@ -354,32 +628,17 @@ class Model(HasTraits):
         
         # Work through each reference signature until we find one that works
         for refsig in reference_signatures:
-
-            # These are the keys we are looking for, anything else is just extra that we ignore
-            refkeys = refsig.third_state_count.keys()
             
             # Check the subject part of the signature
             # The differences between the third and object states should be equal to the reference subject
             query_diff_sub = query_signature.third_state_count - query_signature.object_count
-            
-            # If we can find a full set of the reference associated state components in a query, we must delete them (from, i.e., a previous dimerization, etc.)
-            if all([query_diff_sub[key] >= refsig.third_state_count[key] for key in refkeys]):
-                query_diff_sub = query_diff_sub - refsig.third_state_count
-            
-            # We need to have at least the number of components that the reference state has, but we can have more
-            if not all([query_diff_sub[key] >= refsig.subject_count[key] for key in refkeys]):
+            if not self._signature_match_association_part(query_diff_sub, refsig.subject_count, refsig.third_state_count):
                 continue # Short-circut the comparison, this one doesn't match the pattern
             
             # Check the object part of the signature
             # The differences between the third and subject states should be equal to the reference object
             query_diff_obj = query_signature.third_state_count - query_signature.subject_count
-            
-            # If we can find a full set of the reference associated state components in a query, we must delete them (from, i.e., a previous dimerization, etc.)
-            if all([query_diff_obj[key] >= refsig.third_state_count[key] for key in refkeys]):
-                query_diff_obj = query_diff_obj - refsig.third_state_count
-            
-            # We need to have at least the number of components that the reference state has, but we can have more
-            if not all([query_diff_obj[key] >= refsig.object_count[key] for key in refkeys]):
+            if not self._signature_match_association_part(query_diff_obj, refsig.object_count, refsig.third_state_count):
                 continue # Short-circut the comparison, this one doesn't match the pattern
             
             # If we arrive here, we have a match and we can short-circut the overall result
@@ -388,37 +647,115 @@ class Model(HasTraits):
         # If we arrive here, nothing matched after exhausting the list of reference signatures
         else:
             return False
+    
+    def _signature_match_association_part(self, query_count, reference_count, reference_third_state_count):
+        # Helper function that asks if the subject or object part of an association query matches the same part of a reference signature
+        # Returns True or False
+        
+        # These are the keys we are looking for, anything else is just extra that we ignore
+        refkeys = reference_third_state_count.keys()
+        
+        # If we can find a full set of the reference associated state components in a query, we must delete them (from, i.e., a previous dimerization, etc.)
+        if all([query_count[key] >= reference_third_state_count[key] for key in refkeys]):
+            query_count = query_count - reference_third_state_count
+        
+        # We need to have at least the number of components that the reference state has, but we can have more
+        return all([query_count[key] >= reference_count[key] for key in refkeys])
       
-    def _find_dissociation_pairs(self, reference_signatures, matching_object_states):
+    def _find_dissociation_pairs(self, reference_signatures, matching_object_states, counts = None):
         # Function that returns a list of 2-tuples containing a tuple of indices to split off as subject and a object state for a dissociation reaction
+        # If a Counter is given for counts, the number of signature comparisons is added to it
+        # The reference signatures must be FrozenSignatures over the model's signature alphabet
         
         # Get the type of signatures required
-        count_type = reference_signatures[0].count_type
+        counting_signature = bkcc.CountingSignature(reference_signatures[0].count_type)
         
         # Loop through all the found object states and store any valid splitting of components
         valid_pairs = []
         for current_obj in matching_object_states:
             obj_comp_list, obj_conf_list = current_obj.generate_component_list()
             
-            # Need to split the object state into all possible subject & third states
-            split_indices = []
-            for num_indices in range(1, len(obj_comp_list)): # Need to repeat for single, double, etc. allowed number of conformations
-                split_indices.extend(itertools.combinations(range(0, len(obj_comp_list)), num_indices))
+            # Need to split the object state into all the subject & third states that break a single link
+            split_indices = self._find_dissociation_splits(current_obj)
+            if split_indices == []:
+                continue # Nothing to split
             
-            # Create a signature from each possible splitting
-            for current_split in split_indices:
-                test_signature = bkcc.CountingSignature(count_type, object_state = current_obj)
-                test_sub_comp = [obj_comp_list[x] for x in current_split]
-                test_sub_conf = [obj_conf_list[x] for x in current_split]
-                test_signature.count_for_subject(test_sub_comp, test_sub_conf)
-                test_signature.third_state_count = test_signature.object_count - test_signature.subject_count
-                
-                # See if the test signature matches with any of the reference ones
-                if self._signature_match_dissociation(test_signature, reference_signatures):
-                    valid_pairs.append((current_obj, current_split))
+            # Count the object state once and each possible subject as a row of a matrix
+            object_vector = self.signature_alphabet.count_vector(counting_signature._count_list(obj_comp_list, obj_conf_list))
+            subject_vectors = [self.signature_alphabet.count_vector(counting_signature._count_list([obj_comp_list[x] for x in current_split], [obj_conf_list[x] for x in current_split])) 
+                               for current_split in split_indices]
+            subject_matrix = self.signature_alphabet.stack(subject_vectors)
+            object_vector = self.signature_alphabet.stack([object_vector])[0]
+            
+            # See which splits match with any of the reference signatures
+            split_matches = self._signature_match_dissociation_matrix(subject_matrix, object_vector, reference_signatures)
+            if counts != None:
+                counts['signature_comparisons'] += len(split_indices) * len(reference_signatures)
+            valid_pairs.extend((current_obj, current_split) for current_split, is_match in zip(split_indices, split_matches) if is_match)
         
         # Give the list of tuples back
         return valid_pairs
+    
+    def _find_dissociation_splits(self, state):
+        # Function that returns tuples of component indices that can be split off of a state by breaking exactly one internal link
+        # Splits are given in the same order as itertools.combinations, fewest indices first
+        number_of_components = len(state.required_drug_list) + len(state.required_protein_list)
+        link_list = state.internal_links
+        
+        # A nested link element can be partly split off, so try every combination of indices instead (the link check sorts them out later)
+        if any(isinstance(link_element, tuple) for current_link in link_list for link_element in current_link):
+            split_indices = []
+            for num_indices in range(1, number_of_components): # Need to repeat for single, double, etc. allowed number of conformations
+                split_indices.extend(itertools.combinations(range(0, number_of_components), num_indices))
+            return split_indices
+        
+        # Otherwise, remove each link in turn and see if it leaves the two linked components in seperate groups
+        split_set = set()
+        for link_index, (link_element1, link_element2) in enumerate(link_list):
+            link_graph = nx.Graph()
+            link_graph.add_nodes_from(range(0, number_of_components))
+            link_graph.add_edges_from(x for i, x in enumerate(link_list) if i != link_index)
+            groups = [tuple(x) for x in nx.connected_components(link_graph)]
+            element1_group = next(x for x in groups if link_element1 in x)
+            if link_element2 in element1_group:
+                continue # Still linked some other way, so this link can't be broken by itself
+            element2_group = next(x for x in groups if link_element2 in x)
+            
+            # Either side of the link can be split off, along with any unlinked groups of components
+            other_groups = [x for x in groups if x != element1_group and x != element2_group]
+            for side_group in [element1_group, element2_group]:
+                for num_groups in range(0, len(other_groups) + 1):
+                    for extra_groups in itertools.combinations(other_groups, num_groups):
+                        split_set.add(tuple(sorted(itertools.chain(side_group, *extra_groups))))
+        
+        # Put the splits in order
+        return sorted(split_set, key = lambda x: (len(x), x))
+    
+    def _signature_match_dissociation_matrix(self, subject_matrix, object_vector, reference_signatures):
+        # Vectorized version of _signature_match_dissociation for many subjects split off from the same object state
+        # Takes a matrix of subject counts (one row per split), the object count vector, and a list of FrozenSignatures
+        # Returns a boolean array with one value for each row of the subject matrix
+        
+        # The third states are whatever is left over after splitting off the subjects
+        third_state_matrix = np.maximum(object_vector - subject_matrix, 0)
+        length = subject_matrix.shape[1]
+        
+        # Work through each reference signature and keep any split that matches one of them
+        split_matches = np.zeros(subject_matrix.shape[0], dtype = bool)
+        for refsig in reference_signatures:
+            reference_object_vector = refsig.get_vector('object', length)
+            
+            # These are the keys we are looking for, anything else is just extra that we ignore
+            refkeys = reference_object_vector > 0
+            
+            # Check if the signatures match the rule
+            if not np.all(object_vector[refkeys] >= reference_object_vector[refkeys]):
+                continue # The object state can't match this reference with any split
+            sub_test = np.all(subject_matrix[:, refkeys] == refsig.get_vector('subject', length)[refkeys], axis = 1)
+            third_test = np.all(third_state_matrix[:, refkeys] >= refsig.get_vector('third_state', length)[refkeys], axis = 1)
+            split_matches |= sub_test & third_test
+        
+        return split_matches
           
     def _signature_match_dissociation(self, query_signature, reference_signatures):
         # Helper function that asks if a given query signature matches (any of) the reference signatures in dissociation context 
@@ -446,12 +783,14 @@ class Model(HasTraits):
         else:
             return False
     
-    def _find_conversion_pairs(self, rule, reference_signatures, matching_subject_states):
+    def _find_conversion_pairs(self, rule, reference_signatures, matching_subject_states, counts = None):
         # Function that returns a list of 4-tuples containing the subject state, indices of the changed components, and lists of converted components and conformations.
+        # If a Counter is given for counts, the number of signature comparisons is added to it
         
         # Get the type of signatures required
         count_type = reference_signatures[0].count_type
-        convert_rule_components, convert_rule_conformations = rule.generate_component_list('object')
+        compiled_rule = rule.get_compiled_rule()
+        convert_rule_components, convert_rule_conformations = compiled_rule.generate_component_list('object')
         
         # Loop through all the found object states and store any valid splitting of components
         valid_pairs = []
@@ -463,6 +802,8 @@ class Model(HasTraits):
                 
                 # Test all possible sets of indices for the conversion
                 number_indices_needed = len([*current_sig.subject_count.elements()])
+                if counts != None:
+                    counts['signature_comparisons'] += math.comb(len(sub_comp_list), number_indices_needed) * len(compiled_rule.object_conformation_combinations)
                 for current_indices in itertools.combinations(range(0, len(sub_comp_list)), number_indices_needed):
                     
                     # Get lists of anything that's not tagged as being converted with the indices
@@ -470,8 +811,7 @@ class Model(HasTraits):
                     nonconvert_conf_list = [x for i, x in enumerate(sub_conf_list) if i not in current_indices]
                     
                     # Make lists of new components/conformations and see if they create a matching signature
-                    ignored_output, convert_conf_lists = rule._get_all_conformation_combinations([], convert_rule_conformations, [], convert_rule_components)   
-                    for current_convert_conf in convert_conf_lists:
+                    for current_convert_conf in compiled_rule.object_conformation_combinations:
                         
                         # Make a new signature with the converted components
                         test_signature = bkcc.CountingSignature(count_type, subject_state = current_sub) 
@@ -501,8 +841,9 @@ class Model(HasTraits):
         else:
             return False
     
-    def _find_competitive_states(self, rule, reference_signatures, matching_states):
+    def _find_competitive_states(self, rule, reference_signatures, matching_states, counts = None):
     # Find all the possible indices for identifying the competing parts of each matched state
+    # If a Counter is given for counts, the number of signature comparisons is added to it
         
         # Get requried information for matching
         count_type = reference_signatures[0].count_type
@@ -511,6 +852,7 @@ class Model(HasTraits):
     
         # Work through each state and signature and test all index combinations to see if they match
         possible_competition_tuples = []
+        tested_index_pairs = 0
         for current_state in matching_states:
             
             # Get the indices and list of components
@@ -532,6 +874,7 @@ class Model(HasTraits):
                     continue # Test next index pair
                 
                 # Otherwise, make a signature from the indices
+                tested_index_pairs += 1
                 test_signature = bkcc.CountingSignature(count_type) 
                 test_signature.count_for_subject([state_component_list[i] for i in current_sub_indices], [state_conformation_list[i] for i in current_sub_indices])
                 test_signature.count_for_object([state_component_list[i] for i in current_obj_indices], [state_conformation_list[i] for i in current_obj_indices]) # Add the converted components to the signature
@@ -540,6 +883,8 @@ class Model(HasTraits):
                 if any([self._signature_match_competition(test_signature, x) for x in reference_signatures]):
                     possible_competition_tuples.append((current_state, current_sub_indices, current_obj_indices))
                     continue # Test next index pair
+        if counts != None:
+            counts['signature_comparisons'] += tested_index_pairs * len(reference_signatures)
                  
         # Return any state-index tuples that might work for link testing
         return possible_competition_tuples 
@@ -560,6 +905,8 @@ class Model(HasTraits):
         # Function to connect two states into an association relationship on the given graph
         # Creates a new associated state if one cannot be found in existing graph
         # New link must be given for components in the assocated state 
+        # Returns a Counter with the number of nodes and edges added to the graph
+        graph_changes = Counter()
              
         # Create lists of components/conformations for a possible associated state
         sub_comp, sub_conf = subject_state.generate_component_list()
@@ -569,18 +916,12 @@ class Model(HasTraits):
         associated_old_links = self._combine_internal_link_lists(subject_state, object_state)
         associated_links = associated_old_links + [new_link]
        
-        # See if this possible state already exists in the graph
-        for current_state in graph.__iter__():
-            if self._state_match_to_component_lists(current_state, associated_component_list, associated_conformation_list, associated_links, match = 'exact'):
-                # If the state already exists, use it
-                associated_state = current_state
-                break
+        # See if this possible state already exists in the graph, if so, use it
+        associated_state = self._find_existing_state(graph, associated_component_list, associated_conformation_list, associated_links)
         
         # If no valid associated state alreay exists, create a new one
-        else: # no break
-            associated_state = bkcc.State()
-            associated_state.add_component_list(associated_component_list, associated_conformation_list)
-            associated_state.internal_links = associated_links
+        if associated_state == None:
+            associated_state = bkcc.State.from_lists(associated_component_list, associated_conformation_list, associated_links)
             
         # Only add the association if the third state is not on the blacklist
         if not any(self._state_match_to_state(associated_state, x, match = 'exact') for x in graph_blacklist):
@@ -596,8 +937,8 @@ class Model(HasTraits):
                 new_STobj = bkcc.Association()
             
             # Add edges to the associated state from the object and subject states (NetworkX will add any states that don't alreay exist in the graph)
-            graph.add_edge(subject_state, associated_state, reaction_type = new_STobj)
-            graph.add_edge(object_state, associated_state, reaction_type = new_STobj)
+            graph_changes += self._add_transition_edge(graph, subject_state, associated_state, new_STobj)
+            graph_changes += self._add_transition_edge(graph, object_state, associated_state, new_STobj)
             if reversible:
                 
                 # Create a new Dissociation StateTransition object
@@ -607,13 +948,17 @@ class Model(HasTraits):
                     new_STobj = bkcc.Dissociation()
                 
                 # Add reversable edges 
-                graph.add_edge(associated_state, subject_state, reaction_type = new_STobj)
-                graph.add_edge(associated_state, object_state, reaction_type = new_STobj)
+                graph_changes += self._add_transition_edge(graph, associated_state, subject_state, new_STobj)
+                graph_changes += self._add_transition_edge(graph, associated_state, object_state, new_STobj)
+        
+        return graph_changes
     
     def _create_dissociation(self, graph, graph_blacklist, object_state, split_indices, subject_link_list, third_state_link_list, reversible = False, rapid_equlibrium = False):
         # Function to split an object state into the subject state and a remaining third state on a given graph
         # Creates new states if the generated ones cannot be found in existing graph
         # Link lists must be given for components in the split states
+        # Returns a Counter with the number of nodes and edges added to the graph
+        graph_changes = Counter()
                 
         # Get indices of the third state 
         remaining_indices = [x for x in range(0, len(object_state.required_drug_list + object_state.required_protein_list)) if x not in split_indices] 
@@ -625,31 +970,19 @@ class Model(HasTraits):
         third_state_comp = [object_comp[i] for i in remaining_indices]
         third_state_conf = [object_conf[i] for i in remaining_indices]
                 
-        # See if the subject state already exists in the graph
-        for current_state in graph.__iter__():
-            if self._state_match_to_component_lists(current_state, subject_comp, subject_conf, subject_link_list, match = 'exact'):
-                # If the state already exists, use it
-                subject_state = current_state
-                break
+        # See if the subject state already exists in the graph, if so, use it
+        subject_state = self._find_existing_state(graph, subject_comp, subject_conf, subject_link_list)
         
         # If no valid subject state alreay exists, create a new one
-        else: # no break
-            subject_state = bkcc.State()
-            subject_state.add_component_list(subject_comp, subject_conf)
-            subject_state.internal_links = subject_link_list
+        if subject_state == None:
+            subject_state = bkcc.State.from_lists(subject_comp, subject_conf, subject_link_list)
         
-        # See if the third state already exists in the graph
-        for current_state in graph.__iter__():
-            if self._state_match_to_component_lists(current_state, third_state_comp, third_state_conf, third_state_link_list, match = 'exact'):
-                # If the state already exists, use it
-                third_state = current_state
-                break
+        # See if the third state already exists in the graph, if so, use it
+        third_state = self._find_existing_state(graph, third_state_comp, third_state_conf, third_state_link_list)
         
         # If no valid subject state alreay exists, create a new one
-        else: # no break
-            third_state = bkcc.State()
-            third_state.add_component_list(third_state_comp, third_state_conf)
-            third_state.internal_links = third_state_link_list
+        if third_state == None:
+            third_state = bkcc.State.from_lists(third_state_comp, third_state_conf, third_state_link_list)
             
         # Only add the dissociated states if the subject and third states are not on the blacklist
         if not any(self._state_match_to_state(subject_state, x, match = 'exact') for x in graph_blacklist) and \
@@ -666,8 +999,8 @@ class Model(HasTraits):
                 new_STobj = bkcc.Dissociation()
                 
             # Add edges to the associated state from the object and subject states (NetworkX will add any states that don't alreay exist in the graph)
-            graph.add_edge(object_state, subject_state, reaction_type = new_STobj)
-            graph.add_edge(object_state, third_state, reaction_type = new_STobj)
+            graph_changes += self._add_transition_edge(graph, object_state, subject_state, new_STobj)
+            graph_changes += self._add_transition_edge(graph, object_state, third_state, new_STobj)
             if reversible:
                  
                 # Create a new Association StateTransition object
@@ -677,25 +1010,23 @@ class Model(HasTraits):
                     new_STobj = bkcc.Association() 
                 
                 # Add reversable edges
-                graph.add_edge(subject_state, object_state, reaction_type = new_STobj)
-                graph.add_edge(third_state, object_state, reaction_type = new_STobj)    
+                graph_changes += self._add_transition_edge(graph, subject_state, object_state, new_STobj)
+                graph_changes += self._add_transition_edge(graph, third_state, object_state, new_STobj)
+        
+        return graph_changes
 
     def _create_conversion(self, graph, graph_blacklist, subject_state, new_component_list, new_conformation_list, new_link_tuples, reversible = False, rapid_equlibrium = False):
         # Function to convert the given components in the state to those specified by the rule
         # Creates new states if the generated ones cannot be found in existing graph
+        # Returns a Counter with the number of nodes and edges added to the graph
+        graph_changes = Counter()
         
-        # See if the object state already exists in the graph
-        for current_state in graph.__iter__():
-            if self._state_match_to_component_lists(current_state, new_component_list, new_conformation_list, new_link_tuples, match = 'exact'):
-                # If the state already exists, use it
-                object_state = current_state
-                break
+        # See if the object state already exists in the graph, if so, use it
+        object_state = self._find_existing_state(graph, new_component_list, new_conformation_list, new_link_tuples)
         
         # If no valid subject state alreay exists, create a new one
-        else: # no break
-            object_state = bkcc.State()
-            object_state.add_component_list(new_component_list, new_conformation_list)
-            object_state.internal_links = new_link_tuples
+        if object_state == None:
+            object_state = bkcc.State.from_lists(new_component_list, new_conformation_list, new_link_tuples)
         
         # Only add the converstion if the object state is not on the blacklist
         if not any(self._state_match_to_state(object_state, x, match = 'exact') for x in graph_blacklist):
@@ -711,7 +1042,7 @@ class Model(HasTraits):
                 new_STobj = bkcc.Conversion(reference_direction = True) # This is the direction that corrsoponds to the rule
                 
             # Add edges to convert states (NetworkX will add any states that don't alreay exist in the graph)
-            graph.add_edge(subject_state, object_state, reaction_type = new_STobj)
+            graph_changes += self._add_transition_edge(graph, subject_state, object_state, new_STobj)
             if reversible:
                 
                 # Create a new Conversion StateTransition object
@@ -721,31 +1052,70 @@ class Model(HasTraits):
                     new_STobj = bkcc.Conversion(reference_direction = False) # This is the opposite direction of the rule 
                 
                 # Add reversable edges
-                graph.add_edge(object_state, subject_state, reaction_type = new_STobj)
+                graph_changes += self._add_transition_edge(graph, object_state, subject_state, new_STobj)
+        
+        return graph_changes
               
     def _remove_states(self, graph, graph_blacklist, state_list):
         # Function to remove the listed states from the indicated graph
         # Add to graph's state blacklist
+        # Returns a Counter with the number of nodes and edges removed from the graph
 
         # NOTE: Did not choose to match by object address so the function is more general (i.e., remove states that didn't origonate from the indicated graph)        
+        graph_changes = Counter()
         
         # Repeat for each state
         for competing_state in state_list:
             
             # Find the state in the graph
-            for current_state in graph.__iter__():
-                if self._state_match_to_state(current_state, competing_state, match = 'exact'):
+            current_state = self._find_existing_state(graph, *competing_state.generate_component_list(), competing_state.internal_links)
+            if current_state != None:
                 
-                    # Remove the state from the graph (all connecting edges are removed as well)
-                    graph.remove_node(current_state)
-                    
-                    # Add state to blacklist
-                    if not any(self._state_match_to_state(current_state, x, match = 'exact') for x in graph_blacklist):
-                        graph_blacklist.append(current_state)
-
-                    # Find next state
-                    break
+                # Remove the state from the graph (all connecting edges are removed as well)
+                graph_changes['nodes_removed'] += 1
+                graph_changes['edges_removed'] += graph.in_degree(current_state) + graph.out_degree(current_state)
+                graph.remove_node(current_state)
+                if graph is self.network.main_graph:
+                    self.network.unindex_state(current_state)
+                
+                # Add state to blacklist
+                if not any(self._state_match_to_state(current_state, x, match = 'exact') for x in graph_blacklist):
+                    graph_blacklist.append(current_state)
+        
+        return graph_changes
                 
+    def _find_existing_state(self, graph, component_list, conformation_list, link_list):
+        # Helper function that returns the state in the graph exactly matching the given lists, or None if there isn't one
+        # The main graph is searched with the network's canonical state key index, any other graph is searched state by state
+        
+        if graph is self.network.main_graph:
+            return self.network.find_state(bkcc.create_state_key(component_list, conformation_list, link_list))
+        
+        for current_state in graph.__iter__():
+            if self._state_match_to_component_lists(current_state, component_list, conformation_list, link_list, match = 'exact'):
+                return current_state
+        return None
+    
+    def _add_transition_edge(self, graph, tail_state, head_state, STobj):
+        # Helper function to add a state transition edge to the graph (NetworkX will add any states that don't alreay exist in the graph)
+        # Returns a Counter with the number of nodes and edges that were actually added
+        
+        # Count what is new before adding
+        graph_changes = Counter()
+        new_states = [x for x in (tail_state, head_state) if x not in graph]
+        graph_changes['nodes_added'] = len(new_states)
+        graph_changes['edges_added'] = int(not graph.has_edge(tail_state, head_state))
+        
+        # Add the edge, an existing edge gets the new StateTransition object
+        graph.add_edge(tail_state, head_state, reaction_type = STobj)
+        
+        # Keep the network's state key index up to date with states added to the main graph
+        if graph is self.network.main_graph:
+            for current_state in new_states:
+                self.network.index_state(current_state)
+        
+        return graph_changes
+    
     def _translate_link_tuple(self, link_tuple, translate_dict):
         # Generator expression to translate complex tuple trees - only run when consumed by tuple later on
         if isinstance(link_tuple, int): # Need to handle a single integer element as well
@@ -803,8 +1173,9 @@ class Model(HasTraits):
         reference_component_list, reference_conformation_list = reference_state.generate_component_list()
         link_element1_component_list, link_element1_conformation_list = self._collect_link_components(link[0], reference_component_list, reference_conformation_list)
         link_element2_component_list, link_element2_conformation_list = self._collect_link_components(link[1], reference_component_list, reference_conformation_list)
-        rule_subject_comp, rule_subject_conf = rule.generate_component_list('subject')
-        rule_third_state_comp, rule_third_state_conf = rule.generate_component_list('difference')
+        compiled_rule = rule.get_compiled_rule()
+        rule_subject_comp, rule_subject_conf = compiled_rule.generate_component_list('subject')
+        rule_third_state_comp, rule_third_state_conf = compiled_rule.generate_component_list('difference')
         
         # See if the link matches the rule in either forward or reverse direction
         if self._compare_component_lists(link_element1_component_list, link_element1_conformation_list, rule_subject_comp, rule_subject_conf, match = 'minimal'):
@@ -1110,7 +1481,7 @@ class Model(HasTraits):
                  
                 # Get lists of components/conformations to compare
                 new_comp_list, new_conf_list = subject_state.generate_component_list()
-                rule_comp_list, rule_conf_list = rule.generate_component_list('subject')
+                rule_comp_list, rule_conf_list = rule.get_compiled_rule().generate_component_list('subject')
                 
                 # See if all the ordered components in the rule match with those from the state
                 match_list = []
@@ -1121,7 +1492,7 @@ class Model(HasTraits):
                 
                 # If they all match, make the converstion and add to the converstion tuple list
                 if all(match_list):
-                    converted_rule_comp_list, converted_rule_conf_list = rule.generate_component_list('object')
+                    converted_rule_comp_list, converted_rule_conf_list = rule.get_compiled_rule().generate_component_list('object')
                     for rule_index, state_index in enumerate(current_translation_indices):
                         new_comp_list[state_index] = converted_rule_comp_list[rule_index]
                         if not converted_rule_conf_list[rule_index] == []: # Just ignore the state's conformation if there is an "any" conformation in the rule
@@ -1167,51 +1538,30 @@ class Model(HasTraits):
         return valid_competing_states
         
     # Graphing
-    def _fancy_graph_draw(self, label='default', name=None, ID_labels=False):
-        plt.cla()
-        plt.figure(figsize=(16, 12)) 
-        
-        # Get graph - default is main_graph
+    def render_graph_snapshots(self, file_format='png', dpi=500, in_worker=False):
+        # Draw the recorded graph snapshots to files, in a separate worker process if in_worker is True
+        # Returns a list of the file names once all of them are written, errors while drawing are raised here
+        if self.graph_snapshots == []:
+            return []
+        if not in_worker:
+            return [render_graph_snapshot(x, file_format, dpi) for x in self.graph_snapshots]
+        
+        # Hand the snapshots to a worker process and wait for them, result() raises any error from the worker
+        with concurrent.futures.ProcessPoolExecutor(max_workers = 1) as executor:
+            futures = [executor.submit(render_graph_snapshot, x, file_format, dpi) for x in self.graph_snapshots]
+            return [x.result() for x in futures]
+    
+    def _fancy_graph_draw(self, label='default', name=None, ID_labels=False, file_format='png', dpi=500):
+        # Draw a graph to a file right away - default is main_graph
         if name == None:
             G = self.network.main_graph
         else:
             G = self.network.derived_graphs[name]
-            
-        # Calculate positions
-        #pos = nx.spring_layout(G)  # positions for all nodes
-        #pos = nx.shell_layout(G)  # positions for all nodes
-        #pos = nx.kamada_kawai_layout(G)  # positions for all nodes
-        #pos = nx.spectral_layout(G)  # positions for all nodes
-        pos = nx.circular_layout(G)  # positions for all nodes
-        if ID_labels:
-            node_labels = {node:str(node.ID)[-4:] for node in G}
-        else:
-            node_labels = {node:r'$'+node.symbol+'$' for node in G}
-
-       # edge_labels = ["r'$"+str(edge.variable)+"$'" for u,v,edge in G.edges.data('reaction_type')]
-        
-        # Draw the peices
-        nx.draw_networkx_nodes(G, pos)
-        nx.draw_networkx_edges(G, pos)
-        
-        
-#        # some math labels
-#        labels = {}
-#        labels[0] = r'$a$'
-#        labels[1] = r'$b$'
-#        labels[2] = r'$c$'
-#        labels[3] = r'$d$'
-#        labels[4] = r'$\alpha$'
-#        labels[5] = r'$\beta$'
-#        labels[6] = r'$\gamma$'
-#        labels[7] = r'$\delta$'
-        nx.draw_networkx_labels(G, pos, node_labels, font_size=6)
-        
-        plt.savefig(label+'.png', dpi=500)
-        plt.close()
+        return render_graph_snapshot(take_graph_snapshot(G, label, ID_labels), file_format, dpi)
     
     # Graphing utility function
     def _main_graph_dump(self, label='default'):
+        import matplotlib.pyplot as plt # Slow to import, so only load it when drawing
         plt.cla()
         G = self.network.main_graph
         nx.draw(G, with_labels=True, font_weight='bold')
@@ -1,27 +1,766 @@
 """Class for the solver object used throughout the program.
 """
 
-import networkx as nx
-import matplotlib as mpl
-import matplotlib.pyplot as plt
-import networkx as nx
+import os
+import re
+import uuid
+import hashlib
+import tempfile
+import concurrent.futures
+import importlib.util
+import numpy as np
+from collections import namedtuple
 import bikipy.bikicore.model as bkcm
 import bikipy.bikicore.components as bkcc
-import bikipy.bikicore.datahandling as bkcd
-from traits.api import HasTraits, Int, Str, Instance, This, List
+from bikipy.bikicore.exceptions import SimulationError
+from traits.api import HasTraits, Int, Str, Instance, This, List, Dict
 
 
+# Version of the generated rate equation module format, part of the fingerprint so modules in an older format aren't reused
+RHS_MODULE_VERSION = 1
+
+# Generated rate equation modules that have been imported in this process, fingerprint -> module
+_compiled_modules = {}
+
+# Number of LinearSolutions each first order system keeps for reuse, and the largest condition number of the eigenvectors that
+# the eigendecomposition is used with (less well conditioned rate matrices use the matrix exponential instead)
+LINEAR_SOLUTION_CACHE_SIZE = 128
+MAX_EIGENVECTOR_CONDITION = 1e8
+
+# Concentrations of each species (rows) at each time point (columns) from a simulation
+Simulation = namedtuple('Simulation', ['time_points', 'concentrations', 'species'])
+
+# Observations of each condition at each time point from a batch of simulations, an array of conditions x time points x observables
+BatchSimulation = namedtuple('BatchSimulation', ['time_points', 'observations', 'species'])
+
+# Observations of each parameter set at each time point from an ensemble of simulations, and which sets were solved successfully
+EnsembleSimulation = namedtuple('EnsembleSimulation', ['time_points', 'observations', 'species', 'success'])
+
 # Solver class
 class Solver(HasTraits):
-    
+
     # Initalize traits
     model = Instance(bkcm.Model)
-    experiment_list = List(Instance(bkcd.Experiment))
-    
+    ID = Instance(uuid.UUID)
+    experiment_list = List()
+    cache_directory = Str() # Directory for generated rate equation modules, leave empty to build the rate equations in memory
+    _systems = Dict() # Graph name -> (graph key, MassActionSystem), reused between simulations, see get_system()
+
     def __init__(self, model, *args, **kwargs):
         super().__init__(*args, **kwargs) # Make sure to call the HasTraits initialization machinery
         self.model = model
         self.ID = uuid.uuid4()
         self.experiment_list = []
+        self._systems = {}
+
+    def get_system(self, graph_name = None):
+        # Returns the MassActionSystem of the model's main graph, or of a derived graph with its parameter overrides
+        # The system is made once for each graph and reused while the model keeps the same network, the main graph doesn't
+        # change, the name still refers to the same derived graph (deriving a graph again under the same name replaces it), and
+        # the states and edges haven't been renumbered or given new variables by autonumber() or autovariable()
+        network = self.model.network
+        graph_key = (network, network.get_graph_version(), network.labeling_version, network.derived_graphs.get(graph_name),
+                     network.derived_networks.get(graph_name))
+        if graph_name in self._systems and self._systems[graph_name][0] == graph_key:
+            return self._systems[graph_name][1]
+        parameter_overrides = None
+        if graph_name in network.derived_networks:
+            parameter_overrides = network.derived_networks[graph_name].parameter_overrides
+        if self.cache_directory:
+            system = load_compiled_system(network.get_reaction_table(graph_name), parameter_overrides, self.cache_directory)
+        else:
+            system = MassActionSystem(network.get_reaction_table(graph_name), parameter_overrides)
+        self._systems[graph_name] = (graph_key, system)
+        return system
+
+    def simulate(self, initial_concentrations, parameter_values, time_points, graph_name = None, method = None, rtol = 1e-6, atol = 1e-12):
+        # Integrate the mass action rate equations of the model's network
+        # Parameters:
+            # initial_concentrations - dictionary of State, state variable, variable name or state number -> concentration at the
+            #   first time point, missing states start at zero. An array in species order is also accepted.
+            # parameter_values - dictionary of rate constant variable, variable name or signed number -> value, plus the values of
+            #   any other variables in parameter overrides (e.g. held concentrations). An array in reaction order is also accepted.
+            # time_points - increasing times to report the concentrations at, the first one is the start of the simulation
+            # graph_name - name of a derived graph to simulate instead of the main graph
+            # method - stiff integrator for scipy.integrate.solve_ivp, 'LSODA', 'BDF' or 'Radau', or 'exact' for the exact solution of
+            #   a first order network (see LinearSolution). BDF and Radau use the sparse Jacobian as it is, which pays off for large
+            #   networks. Default = None uses 'exact' if every reaction is first order (e.g. in a graph with held ligand
+            #   concentrations), and 'LSODA' otherwise.
+        # Returns a Simulation namedtuple
+        system = self.get_system(graph_name)
+        rate_constants = system.rate_constant_vector(parameter_values)
+        start_concentrations = system.concentration_vector(initial_concentrations)
+        time_points = np.asarray(time_points, dtype = float)
+        if _uses_exact_solution(system, method):
+            return Simulation(time_points, system.linear_solution(rate_constants).concentrations(start_concentrations, time_points).T, system.species)
+        result = _integrate(system, start_concentrations, rate_constants, time_points, method or 'LSODA', rtol, atol)
+        return Simulation(result.t, result.y, system.species)
+
+    def simulate_batch(self, initial_concentrations, parameter_values, time_points, observables = None, graph_name = None, mode = 'stacked', 
+                       method = None, rtol = 1e-6, atol = 1e-12, max_workers = None):
+        # Integrate the rate equations for many conditions in one call, e.g. each ligand concentration of a saturation or competition curve
+        # Parameters:
+            # initial_concentrations - list with the initial concentrations of each condition, each one as in simulate(), or an 
+            #   array of conditions x species
+            # parameter_values - parameter values as in simulate() for all of the conditions, or a list with the values of each 
+            #   condition (e.g. when a held ligand concentration in a reduced graph changes)
+            # time_points - as in simulate()
+            # observables - list of observables, each one a State, a list of States that are added together, or an array of 
+            #   weights in species order. Default = None, observe each species.
+            # graph_name - name of a derived graph to simulate instead of the main graph
+            # mode - 'stacked' (default) puts the conditions into one block diagonal system that is solved in a single integration,
+            #   which is fastest for small networks. 'processes' simulates each condition in a pool of worker processes, which is 
+            #   better for large networks where factoring the stacked Jacobian gets expensive.
+            # method - integrator, default = None uses the exact solution for a first order network in either mode (see 
+            #   simulate()), and otherwise 'BDF' for a stacked system (with the sparse block diagonal Jacobian) and 'LSODA' for 
+            #   each condition in the worker processes
+            # max_workers - number of worker processes, default = None uses the number of processors
+        # Returns a BatchSimulation namedtuple with an array of conditions x time points x observables
+        system = self.get_system(graph_name)
+        start_concentrations = np.array([system.concentration_vector(x) for x in initial_concentrations])
+        number_of_conditions = len(start_concentrations)
+        rate_constants = _values_for_each(parameter_values, number_of_conditions, system.rate_constant_vector, 'parameter values')
+        time_points = np.asarray(time_points, dtype = float)
+        
+        # Solve the conditions together or in parallel
+        if mode not in ['stacked', 'processes']:
+            raise ValueError("Batch simulation mode must be 'stacked' or 'processes', not {!r}.".format(mode))
+        if _uses_exact_solution(system, method):
+            concentrations = _solve_first_order(system, start_concentrations, rate_constants, time_points)
+        elif mode == 'stacked':
+            result = _integrate(StackedMassActionSystem(system, number_of_conditions), start_concentrations.ravel(), rate_constants, time_points, 
+                                method or 'BDF', rtol, atol)
+            concentrations = result.y.reshape(number_of_conditions, len(system.species), len(time_points)).transpose(0, 2, 1)
+        else:
+            with concurrent.futures.ProcessPoolExecutor(max_workers, initializer = _set_worker_system, initargs = (system,)) as executor:
+                futures = [executor.submit(_simulate_condition, x, k, time_points, method or 'LSODA', rtol, atol) for x, k in zip(start_concentrations, rate_constants)]
+                concentrations = np.array([x.result().T for x in futures])
+        return BatchSimulation(time_points, _observe(system, concentrations, observables), system.species)
+
+    def simulate_ensemble(self, parameter_sets, initial_concentrations, time_points, observables = None, graph_name = None, mode = None,
+                          rtol = 1e-6, atol = 1e-12, group_size = 50, max_steps = 100000):
+        # Integrate the rate equations for many sets of parameter values, e.g. for fitting, bootstrapping or sensitivity analysis
+        # Parameters:
+            # parameter_sets - list with the parameter values of each set, each one as in simulate(), or an array of sets x reactions
+            # initial_concentrations - initial concentrations as in simulate() for all of the sets, or a list with those of each set
+            # time_points, observables, graph_name - as in simulate_batch()
+            # mode - 'lockstep' advances all the sets together with integrate_ensemble(), each with its own step size. 'grouped' 
+            #   solves groups of group_size sets as stacked systems with BDF, which shares the step size within a group. 'exact' 
+            #   uses the exact solution of a first order network. Default = None uses 'exact' for first order networks and 
+            #   'lockstep' otherwise.
+            # rtol, atol - error tolerances
+            # group_size - number of sets in each group for the 'grouped' mode
+            # max_steps - maximum number of steps for each set in the 'lockstep' mode
+        # Returns an EnsembleSimulation namedtuple with an array of sets x time points x observables. Sets whose integration failed
+        #   are False in the success array and have NaN observations instead of raising an error.
+        system = self.get_system(graph_name)
+        rate_constants = np.array([system.rate_constant_vector(x) for x in parameter_sets])
+        number_of_sets = len(rate_constants)
+        start_concentrations = _values_for_each(initial_concentrations, number_of_sets, system.concentration_vector, 'initial concentrations')
+        time_points = np.asarray(time_points, dtype = float)
         
-    
\ No newline at end of file
+        if mode == None:
+            mode = 'exact' if system.is_first_order() else 'lockstep'
+        if mode == 'exact':
+            concentrations = _solve_first_order(system, start_concentrations, rate_constants, time_points)
+            success = np.ones(number_of_sets, dtype = bool)
+        elif mode == 'lockstep':
+            concentrations, success, steps = integrate_ensemble(system, start_concentrations, rate_constants, time_points, rtol, atol, max_steps)
+        elif mode == 'grouped':
+            concentrations = np.full((number_of_sets, len(time_points), len(system.species)), np.nan)
+            success = np.ones(number_of_sets, dtype = bool)
+            for group_start in range(0, number_of_sets, group_size):
+                group = slice(group_start, min(group_start + group_size, number_of_sets))
+                number_in_group = group.stop - group.start
+                try:
+                    result = _integrate(StackedMassActionSystem(system, number_in_group), start_concentrations[group].ravel(), rate_constants[group], 
+                                        time_points, 'BDF', rtol, atol)
+                except SimulationError:
+                    success[group] = False
+                    continue
+                concentrations[group] = result.y.reshape(number_in_group, len(system.species), len(time_points)).transpose(0, 2, 1)
+        else:
+            raise ValueError("Ensemble simulation mode must be 'lockstep', 'grouped' or 'exact', not {!r}.".format(mode))
+        return EnsembleSimulation(time_points, _observe(system, concentrations, observables), system.species, success)
+
+# Define class for the mass action rate equations of a network
+class MassActionSystem(object):
+    # Rate equations dx/dt = S v(x) for a ReactionTable, with stoichiometry matrix S (species x reactions) and mass action
+    # fluxes v_j = k_j * x_a * x_b. Reactions have at most two reactants; a missing reactant points at a constant 1 appended
+    # to the concentrations, and a dimerization has the same species as both reactants.
+    # The Jacobian S dv/dx has a fixed sparsity pattern, so the pattern and the map from the flux derivatives to the Jacobian
+    # values are made once and each call only fills in the values.
+
+    def __init__(self, reaction_table, parameter_overrides = None):
+        import scipy.sparse # Slow to import, so only load it when it's used
+
+        self.reaction_table = reaction_table
+        self.species = reaction_table.species
+        self.parameters = reaction_table.get_parameters(parameter_overrides)
+        self._numbered_names = None # (prefix, number) -> variable name, made on first use
+        self._linear_solutions = {} # Rate constant bytes -> LinearSolution, for first order networks
+        number_of_species = reaction_table.number_of_species
+        number_of_reactions = reaction_table.number_of_reactions
+
+        # Reactant indices of each reaction
+        self.first_reactants = np.full(number_of_reactions, number_of_species, dtype = np.int64)
+        self.second_reactants = np.full(number_of_reactions, number_of_species, dtype = np.int64)
+        for reaction_index, reaction_reactants in enumerate(reaction_table.reactants):
+            reactant_indices = [i for i, n in reaction_reactants for repeat in range(n)]
+            if len(reactant_indices) > 2:
+                raise ValueError('Reaction {} has more than two reactants.'.format(reaction_table.reactions[reaction_index].number))
+            reactant_indices += [number_of_species, number_of_species]
+            self.first_reactants[reaction_index], self.second_reactants[reaction_index] = reactant_indices[:2]
+        self.stoichiometry = reaction_table.stoichiometry_matrix().astype(float)
+
+        # Entries of the flux Jacobian: dv_j/dx_a = k_j * x_b and dv_j/dx_b = k_j * x_a, skipping the constant
+        has_first = self.first_reactants < number_of_species
+        has_second = self.second_reactants < number_of_species
+        self._first_entries = np.flatnonzero(has_first)
+        self._second_entries = np.flatnonzero(has_second)
+        entry_reactions = np.concatenate([self._first_entries, self._second_entries])
+        entry_species = np.concatenate([self.first_reactants[has_first], self.second_reactants[has_second]])
+
+        # Each flux entry (j, a) adds S[s, j] * dv_j/dx_a to the Jacobian value J[s, a] for every species s changed by reaction j
+        entry_columns = self.stoichiometry.T.tocsr()[entry_reactions].tocoo() # Entries x species, values S[s, j]
+        positions = entry_columns.col * number_of_species + entry_species[entry_columns.row]
+        unique_positions, position_indices = np.unique(positions, return_inverse = True)
+        self._jacobian_indices = unique_positions % number_of_species
+        self._jacobian_indptr = np.searchsorted(unique_positions // number_of_species, np.arange(number_of_species + 1))
+        self._jacobian_map = scipy.sparse.csr_matrix((entry_columns.data, (position_indices, entry_columns.row)),
+                                                     shape = (len(unique_positions), len(entry_reactions)))
+        self._shape = (number_of_species, number_of_species)
+
+    def module_source(self, fingerprint):
+        # Returns the source code of a standalone Python module with the rate equations, see load_compiled_system()
+        # The module only needs NumPy and SciPy; parameter overrides are written out as Python expressions of the values
+        return _MODULE_TEMPLATE.format(fingerprint = fingerprint,
+                                       version = RHS_MODULE_VERSION,
+                                       number_of_species = len(self.species),
+                                       number_of_reactions = len(self.parameters),
+                                       species_variables = [str(x.variable) for x in self.species],
+                                       parameter_code = ',\n    '.join(_parameter_code(x) for x in self.parameters),
+                                       first_reactants = self.first_reactants.tolist(),
+                                       second_reactants = self.second_reactants.tolist(),
+                                       stoichiometry_data = self.stoichiometry.data.tolist(),
+                                       stoichiometry_indices = self.stoichiometry.indices.tolist(),
+                                       stoichiometry_indptr = self.stoichiometry.indptr.tolist(),
+                                       first_entries = self._first_entries.tolist(),
+                                       second_entries = self._second_entries.tolist(),
+                                       jacobian_map_data = self._jacobian_map.data.tolist(),
+                                       jacobian_map_indices = self._jacobian_map.indices.tolist(),
+                                       jacobian_map_indptr = self._jacobian_map.indptr.tolist(),
+                                       jacobian_map_shape = self._jacobian_map.shape,
+                                       jacobian_indices = self._jacobian_indices.tolist(),
+                                       jacobian_indptr = self._jacobian_indptr.tolist())
+
+    def rate_constant_vector(self, parameter_values):
+        # Returns the array of rate constants in reaction order from a dictionary of values, evaluating any parameter overrides
+        if not isinstance(parameter_values, dict):
+            return self._check_length(parameter_values, len(self.parameters), 'rate constants')
+        values = {self._variable_name(x, 'k'): value for x, value in parameter_values.items()}
+        rate_constants = np.empty(len(self.parameters))
+        for reaction_index, current_parameter in enumerate(self.parameters):
+            try:
+                if str(current_parameter) in values:
+                    rate_constants[reaction_index] = values[str(current_parameter)]
+                else:
+                    rate_constants[reaction_index] = float(current_parameter.xreplace({x: values[str(x)] for x in _expression_variables(current_parameter)}))
+            except KeyError as missing_name:
+                raise ValueError('No value given for {}.'.format(missing_name.args[0]))
+        return self._check_length(rate_constants, len(self.parameters), 'rate constants')
+
+    def concentration_vector(self, concentrations):
+        # Returns the array of concentrations in species order from a dictionary of values, missing species are zero
+        if not isinstance(concentrations, dict):
+            return self._check_length(concentrations, len(self.species), 'concentrations')
+        values = {self._variable_name(x, 'S'): value for x, value in concentrations.items()}
+        return self._check_length([values.get(str(x.variable), 0.) for x in self.species], len(self.species), 'concentrations')
+
+    def __getstate__(self):
+        # Worker processes only need the arrays of the rate equations, not the States and sympy variables of the reaction table
+        state = dict(self.__dict__)
+        state.update(reaction_table = None, species = None, parameters = None, _numbered_names = None, _linear_solutions = {})
+        return state
+
+    def observable_weights(self, observables):
+        # Returns an observables x species array of weights, for a list of States, lists of States, or arrays of weights
+        species_indices = {x: i for i, x in enumerate(self.species)}
+        weights = np.zeros((len(observables), len(self.species)))
+        for observable_index, current_observable in enumerate(observables):
+            if isinstance(current_observable, bkcc.State):
+                current_observable = [current_observable]
+            if all(isinstance(x, bkcc.State) for x in current_observable):
+                for current_state in current_observable:
+                    if current_state not in species_indices:
+                        raise ValueError('State {} is not one of the species of the network.'.format(current_state.symbol))
+                    weights[observable_index, species_indices[current_state]] += 1.
+            else:
+                weights[observable_index] = self._check_length(current_observable, len(self.species), 'observable weights')
+        return weights
+
+    def ensemble_rhs(self, x, rate_constants):
+        # Right hand side for a sets x species array of concentrations and a sets x reactions array of rate constants
+        extended_x = np.hstack([x, np.ones((len(x), 1))])
+        fluxes = rate_constants * extended_x[:, self.first_reactants] * extended_x[:, self.second_reactants]
+        return (self.stoichiometry @ fluxes.T).T
+
+    def ensemble_jacobian_values(self, x, rate_constants):
+        # Returns a sets x entries array with the values of each set's Jacobian in the precomputed sparsity pattern
+        extended_x = np.hstack([x, np.ones((len(x), 1))])
+        flux_derivatives = np.hstack([rate_constants[:, self._first_entries] * extended_x[:, self.second_reactants[self._first_entries]],
+                                      rate_constants[:, self._second_entries] * extended_x[:, self.first_reactants[self._second_entries]]])
+        return (self._jacobian_map @ flux_derivatives.T).T
+
+    def ensemble_jacobians(self, x, rate_constants):
+        # Returns the dense Jacobian of each set, a sets x species x species array
+        jacobians = np.zeros((len(x),) + self._shape)
+        jacobian_rows = np.repeat(np.arange(self._shape[0]), np.diff(self._jacobian_indptr))
+        jacobians[:, jacobian_rows, self._jacobian_indices] = self.ensemble_jacobian_values(x, rate_constants)
+        return jacobians
+
+    def is_first_order(self):
+        # Returns True if every reaction has exactly one reactant, so the rate equations are linear, dx/dt = A x
+        return bool(np.all(self.first_reactants < self._shape[0]) and np.all(self.second_reactants == self._shape[0]))
+
+    def rate_matrix(self, rate_constants):
+        # Returns the dense matrix A of first order rate equations dx/dt = A x, which is their (constant) Jacobian
+        if not self.is_first_order():
+            raise ValueError('The rate equations are only linear when every reaction is first order.')
+        return self.jacobian(0., np.zeros(self._shape[0]), rate_constants).toarray()
+
+    def linear_solution(self, rate_constants):
+        # Returns the LinearSolution of a first order network for one set of rate constants
+        # The last LINEAR_SOLUTION_CACHE_SIZE solutions are kept, so simulating the same rate constants again (e.g. with other 
+        #   initial concentrations or time points) doesn't repeat the eigendecomposition
+        key = np.asarray(rate_constants, dtype = float).tobytes()
+        if key not in self._linear_solutions:
+            if len(self._linear_solutions) >= LINEAR_SOLUTION_CACHE_SIZE:
+                del self._linear_solutions[next(iter(self._linear_solutions))] # Oldest one first
+            self._linear_solutions[key] = LinearSolution(self.rate_matrix(rate_constants))
+        return self._linear_solutions[key]
+
+    def fluxes(self, x, rate_constants):
+        # Returns the rate of each reaction
+        extended_x = np.append(x, 1.)
+        return rate_constants * extended_x[self.first_reactants] * extended_x[self.second_reactants]
+
+    def rhs(self, t, x, rate_constants):
+        # Right hand side of the rate equations, dx/dt
+        return self.stoichiometry @ self.fluxes(x, rate_constants)
+
+    def jacobian(self, t, x, rate_constants):
+        # Returns the Jacobian d(dx/dt)/dx as a scipy.sparse CSR matrix with the precomputed sparsity pattern
+        import scipy.sparse
+        extended_x = np.append(x, 1.)
+        flux_derivatives = np.concatenate([rate_constants[self._first_entries] * extended_x[self.second_reactants[self._first_entries]],
+                                           rate_constants[self._second_entries] * extended_x[self.first_reactants[self._second_entries]]])
+        return scipy.sparse.csr_matrix((self._jacobian_map @ flux_derivatives, self._jacobian_indices, self._jacobian_indptr), shape = self._shape)
+
+    # Helper functions
+    def _variable_name(self, key, prefix):
+        # Name of the sympy variable for a State, StateTransition, variable, variable name, or number
+        # Numbers are looked up in the species and reactions, so they also work for indexed variables like S[0] and k[1]
+        if isinstance(key, str):
+            return key
+        if isinstance(key, (int, np.integer)):
+            if self._numbered_names == None:
+                self._numbered_names = {('S', x.number): str(x.variable) for x in self.species}
+                self._numbered_names.update({('k', x.number): str(x.variable) for x in self.reaction_table.reactions})
+            return self._numbered_names.get((prefix, key), '{}_{}'.format(prefix, key))
+        if isinstance(key, (bkcc.State, bkcc.StateTransition)):
+            return str(key.variable)
+        return str(key)
+
+    @staticmethod
+    def _check_length(values, length, description):
+        # Helper function that makes sure values are a float array of finite numbers with the right length
+        values = np.asarray(values, dtype = float)
+        if values.shape != (length,):
+            raise ValueError('Expected {} {} but got an array of shape {}.'.format(length, description, values.shape))
+        if not np.all(np.isfinite(values)):
+            raise ValueError('All {} must be finite numbers.'.format(description))
+        return values
+
+# Define class for mass action rate equations from a generated module
+class CompiledMassActionSystem(MassActionSystem):
+    # Same interface as MassActionSystem, but the rate equations and parameter overrides are evaluated by a module made with
+    # MassActionSystem.module_source(), so no sympy expressions or sparse matrix setup are needed once the module exists
+
+    def __init__(self, reaction_table, parameters, module):
+        self.reaction_table = reaction_table
+        self.species = reaction_table.species
+        self.parameters = parameters
+        self._numbered_names = None
+        self._linear_solutions = {}
+        self.module = module
+        
+        # Arrays used by StackedMassActionSystem
+        self.first_reactants = module.FIRST_REACTANTS
+        self.second_reactants = module.SECOND_REACTANTS
+        self.stoichiometry = module.STOICHIOMETRY
+        self._first_entries = module.FIRST_ENTRIES
+        self._second_entries = module.SECOND_ENTRIES
+        self._jacobian_map = module.JACOBIAN_MAP
+        self._jacobian_indices = module.JACOBIAN_INDICES
+        self._jacobian_indptr = module.JACOBIAN_INDPTR
+        self._shape = (module.NUMBER_OF_SPECIES, module.NUMBER_OF_SPECIES)
+
+    def __getstate__(self):
+        # The module is imported again from its file in worker processes
+        state = super().__getstate__()
+        state['module'] = (self.module.FINGERPRINT, self.module.__file__)
+        return state
+
+    def __setstate__(self, state):
+        fingerprint, module_path = state['module']
+        if fingerprint not in _compiled_modules:
+            _compiled_modules[fingerprint] = _import_module(module_path, 'bikipy_rhs_{}'.format(fingerprint))
+        self.__dict__.update(state, module = _compiled_modules[fingerprint])
+
+    def rate_constant_vector(self, parameter_values):
+        # Returns the array of rate constants in reaction order from a dictionary of values, evaluating any parameter overrides
+        if not isinstance(parameter_values, dict):
+            return self._check_length(parameter_values, self.module.NUMBER_OF_REACTIONS, 'rate constants')
+        values = {self._variable_name(x, 'k'): value for x, value in parameter_values.items()}
+        try:
+            rate_constants = self.module.rate_constants(values)
+        except KeyError as missing_name:
+            raise ValueError('No value given for {}.'.format(missing_name.args[0]))
+        return self._check_length(rate_constants, self.module.NUMBER_OF_REACTIONS, 'rate constants')
+
+    def fluxes(self, x, rate_constants):
+        return self.module.fluxes(x, rate_constants)
+
+    def rhs(self, t, x, rate_constants):
+        return self.module.rhs(t, x, rate_constants)
+
+    def jacobian(self, t, x, rate_constants):
+        return self.module.jacobian(t, x, rate_constants)
+
+# Define class for the exact solution of first order rate equations
+class LinearSolution(object):
+    # Solution x(t) = exp(A (t - t0)) x0 of linear rate equations dx/dt = A x, e.g. binding at a held (pseudo-first-order) ligand
+    # concentration. The eigendecomposition A = V diag(l) V^-1 is made once, then the concentrations at any time are
+    # V (exp(l (t - t0)) * V^-1 x0), with no integration error and no step size to choose. Rate matrices without a well 
+    # conditioned set of eigenvectors (e.g. a chain of irreversible reactions with equal rate constants) use the matrix 
+    # exponential for each time point instead.
+
+    def __init__(self, rate_matrix):
+        self.rate_matrix = np.asarray(rate_matrix, dtype = float)
+        eigenvalues, eigenvectors = np.linalg.eig(self.rate_matrix)
+        if np.linalg.cond(eigenvectors) < MAX_EIGENVECTOR_CONDITION:
+            self.eigenvalues = eigenvalues
+            self.eigenvectors = eigenvectors
+            self._inverse_eigenvectors = np.linalg.inv(eigenvectors)
+        else:
+            self.eigenvalues = None
+            self.eigenvectors = None
+            self._inverse_eigenvectors = None
+
+    def concentrations(self, start_concentrations, time_points):
+        # Returns the concentrations at each time point, a time points x species array, where the first time point is the start
+        # start_concentrations can also be a conditions x species array, which returns a conditions x time points x species array
+        start_concentrations = np.asarray(start_concentrations, dtype = float)
+        elapsed_times = np.asarray(time_points, dtype = float) - time_points[0]
+        if self.eigenvalues is None:
+            import scipy.linalg # Slow to import, so only load it when it's used
+            propagators = scipy.linalg.expm(elapsed_times[:, np.newaxis, np.newaxis] * self.rate_matrix)
+            return np.einsum('tij,...j->...ti', propagators, start_concentrations)
+        coefficients = start_concentrations @ self._inverse_eigenvectors.T
+        modes = np.exp(np.outer(elapsed_times, self.eigenvalues)) * coefficients[..., np.newaxis, :]
+        return np.real(modes @ self.eigenvectors.T)
+
+# Define class for the same rate equations under several conditions
+class StackedMassActionSystem(object):
+    # Block diagonal system of a MassActionSystem repeated for several conditions. The concentrations are those of each condition
+    # one after the other, and the rate constants are a conditions x reactions array.
+    # The Jacobian blocks all have the sparsity pattern of the single system, so the stacked pattern is also made once.
+
+    def __init__(self, system, number_of_conditions):
+        self.system = system
+        self.number_of_conditions = number_of_conditions
+        number_of_species = len(system.species)
+        block_offsets = np.arange(number_of_conditions)[:, np.newaxis]
+        self._jacobian_indices = (system._jacobian_indices + number_of_species * block_offsets).ravel()
+        self._jacobian_indptr = np.concatenate([[0], (system._jacobian_indptr[1:] + len(system._jacobian_indices) * block_offsets).ravel()])
+        self._shape = (number_of_conditions * number_of_species, number_of_conditions * number_of_species)
+
+    def rhs(self, t, y, rate_constants):
+        # Right hand side of the stacked rate equations
+        return self.system.ensemble_rhs(y.reshape(self.number_of_conditions, -1), rate_constants).ravel()
+
+    def jacobian(self, t, y, rate_constants):
+        # Returns the block diagonal Jacobian as a scipy.sparse CSR matrix
+        import scipy.sparse
+        jacobian_values = self.system.ensemble_jacobian_values(y.reshape(self.number_of_conditions, -1), rate_constants).ravel()
+        return scipy.sparse.csr_matrix((jacobian_values, self._jacobian_indices, self._jacobian_indptr), shape = self._shape)
+
+def integrate_ensemble(system, start_concentrations, rate_constants, time_points, rtol = 1e-6, atol = 1e-12, max_steps = 100000):
+    # Integrate the rate equations of many sets of rate constants in lockstep
+    # Uses the L-stable, order 3 Rosenbrock method RODAS3 with an order 2 error estimate. Each set has its own time and step size, 
+    # and every step evaluates the right hand sides and Jacobians of all the unfinished sets in one call. Steps are cut short to 
+    # land on the time points, so no interpolation is needed.
+    # Parameters:
+        # system - MassActionSystem
+        # start_concentrations - sets x species array of the concentrations at the first time point
+        # rate_constants - sets x reactions array
+        # time_points - increasing times to report the concentrations at
+        # rtol, atol - relative and absolute error tolerance of each step
+        # max_steps - maximum number of steps, sets that aren't finished by then have failed
+    # Returns a sets x time points x species array of concentrations, a boolean array of the sets that succeeded (the failed ones 
+    #   are NaN from where they failed), and an array of the number of steps each set took
+    number_of_sets, number_of_species = start_concentrations.shape
+    number_of_time_points = len(time_points)
+    identity = np.eye(number_of_species)
+    
+    # State of each set
+    concentrations = np.array(start_concentrations, dtype = float)
+    times = np.full(number_of_sets, time_points[0], dtype = float)
+    next_output = np.ones(number_of_sets, dtype = np.int64)
+    output = np.full((number_of_sets, number_of_time_points, number_of_species), np.nan)
+    output[:, 0] = concentrations
+    success = np.ones(number_of_sets, dtype = bool)
+    steps = np.zeros(number_of_sets, dtype = np.int64)
+    active = next_output < number_of_time_points
+    
+    # First step sizes from the size of the concentrations and their rates of change
+    scale = atol + rtol * np.abs(concentrations)
+    concentration_norm = np.sqrt(np.mean((concentrations / scale)**2, axis = 1))
+    rate_norm = np.sqrt(np.mean((system.ensemble_rhs(concentrations, rate_constants) / scale)**2, axis = 1))
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        step_sizes = np.where((concentration_norm < 1e-5) | (rate_norm < 1e-5), 1e-6, 0.01 * concentration_norm / rate_norm)
+    step_sizes = np.minimum(step_sizes, time_points[-1] - time_points[0])
+    
+    for iteration in range(max_steps):
+        members = np.flatnonzero(active)
+        if len(members) == 0:
+            break
+        x = concentrations[members]
+        k = rate_constants[members]
+        output_times = time_points[next_output[members]]
+        h = np.minimum(step_sizes[members], output_times - times[members])
+        lands_on_output = h == output_times - times[members]
+        
+        # Rosenbrock stages, all solved with the inverse of W = I / (h gamma) - J
+        with np.errstate(all = 'ignore'):
+            W_inverse = np.linalg.inv(identity / (h * _RODAS3_GAMMA)[:, np.newaxis, np.newaxis] - system.ensemble_jacobians(x, k))
+            stages = []
+            for stage_index in range(4):
+                if _RODAS3_NEW_RHS[stage_index]:
+                    stage_rhs = system.ensemble_rhs(x + sum(_RODAS3_A[stage_index][j] * stages[j] for j in range(stage_index)), k)
+                stage_sum = stage_rhs + sum((_RODAS3_C[stage_index][j] / h)[:, np.newaxis] * stages[j] for j in range(stage_index))
+                stages.append((W_inverse @ stage_sum[:, :, np.newaxis])[:, :, 0])
+            new_x = x + sum(m * y for m, y in zip(_RODAS3_M, stages))
+            
+            # Error estimate and step size control for each set
+            error = sum(e * y for e, y in zip(_RODAS3_E, stages))
+            scale = atol + rtol * np.maximum(np.abs(x), np.abs(new_x))
+            error_norm = np.sqrt(np.mean((error / scale)**2, axis = 1))
+            accepted = error_norm <= 1
+            step_factors = np.where(error_norm > 0, np.clip(0.9 * error_norm**(-1 / 3), 0.2, 6.), 6.)
+        step_factors[~np.isfinite(error_norm)] = 0.2
+        step_sizes[members] = np.where(accepted & lands_on_output, np.maximum(step_sizes[members], h * step_factors), h * step_factors)
+        
+        # Move the accepted sets forward, and record the ones that reached a time point
+        accepted_members = members[accepted]
+        times[accepted_members] += h[accepted]
+        concentrations[accepted_members] = new_x[accepted]
+        steps[accepted_members] += 1
+        output_members = members[accepted & lands_on_output]
+        times[output_members] = time_points[next_output[output_members]]
+        output[output_members, next_output[output_members]] = concentrations[output_members]
+        next_output[output_members] += 1
+        active[output_members] = next_output[output_members] < number_of_time_points
+        
+        # Sets whose steps have become too small to make progress, or aren't a number, have failed
+        stalled = members[~(step_sizes[members] >= 1e-14 * np.maximum(1., np.abs(times[members])))]
+        success[stalled] = False
+        active[stalled] = False
+    success[active] = False
+    return output, success, steps
+
+# RODAS3 coefficients (Sandu et al., Atmospheric Environment 31, 1997), stage i solves W K_i = f(x + sum_j A_ij K_j) + sum_j C_ij K_j / h, 
+# the new concentrations are x + sum_i M_i K_i and the error estimate is sum_i E_i K_i. Stage 2 reuses the right hand side of stage 1.
+_RODAS3_GAMMA = 0.5
+_RODAS3_A = [[], [0.], [2., 0.], [2., 0., 1.]]
+_RODAS3_C = [[], [4.], [1., -1.], [1., -1., -8 / 3]]
+_RODAS3_M = [2., 0., 1., 1.]
+_RODAS3_E = [0., 0., 0., 1.]
+_RODAS3_NEW_RHS = [True, False, True, True]
+
+def default_cache_directory():
+    # Directory for generated rate equation modules, from the BIKIPY_CACHE_DIR environment variable or ~/.cache/bikipy/rhs
+    if os.environ.get('BIKIPY_CACHE_DIR'):
+        return os.environ['BIKIPY_CACHE_DIR']
+    return os.path.join(os.path.expanduser('~'), '.cache', 'bikipy', 'rhs')
+
+def network_fingerprint(reaction_table, parameters):
+    # Returns a hex string that identifies the rate equations of a reaction table, with the given rate constant expressions
+    # Networks with the same species variables, reactions and parameters have the same equations and share a fingerprint
+    fingerprint_parts = [str(RHS_MODULE_VERSION),
+                         repr([str(x.variable) for x in reaction_table.species]),
+                         repr(reaction_table.reactants),
+                         repr(reaction_table.products),
+                         repr([str(x) for x in parameters])]
+    return hashlib.sha256('\n'.join(fingerprint_parts).encode('utf-8')).hexdigest()[:32]
+
+def load_compiled_system(reaction_table, parameter_overrides = None, cache_directory = None):
+    # Returns a CompiledMassActionSystem for a reaction table, using the generated module in the cache directory if there is
+    # one for the same network, and writing it first if not
+    # Parameters:
+        # reaction_table - ReactionTable of the network
+        # parameter_overrides - dictionary of rate constant variable -> expression, as in DerivedNetwork.parameter_overrides
+        # cache_directory - directory for the generated modules, default_cache_directory() if None
+    if cache_directory == None:
+        cache_directory = default_cache_directory()
+    parameters = reaction_table.get_parameters(parameter_overrides)
+    fingerprint = network_fingerprint(reaction_table, parameters)
+    if fingerprint not in _compiled_modules:
+        module_path = os.path.join(cache_directory, 'rhs_{}.py'.format(fingerprint))
+        if not os.path.exists(module_path):
+            _write_module(module_path, MassActionSystem(reaction_table, parameter_overrides).module_source(fingerprint))
+        _compiled_modules[fingerprint] = _import_module(module_path, 'bikipy_rhs_{}'.format(fingerprint))
+    return CompiledMassActionSystem(reaction_table, parameters, _compiled_modules[fingerprint])
+
+# Helper functions
+def _integrate(system, start_concentrations, rate_constants, time_points, method, rtol, atol):
+    # Integrate a system with scipy.integrate.solve_ivp, raises SimulationError if it fails
+    import scipy.integrate # Slow to import, so only load it when it's used
+    
+    # LSODA needs a dense Jacobian, BDF and Radau take the sparse one as it is
+    if method == 'LSODA':
+        jacobian = lambda t, x, k: system.jacobian(t, x, k).toarray()
+    else:
+        jacobian = system.jacobian
+    result = scipy.integrate.solve_ivp(system.rhs, (time_points[0], time_points[-1]), start_concentrations, method = method,
+                                       t_eval = time_points, args = (rate_constants,), jac = jacobian, rtol = rtol, atol = atol)
+    if not result.success:
+        raise SimulationError('Integration failed: {}'.format(result.message))
+    if not np.all(np.isfinite(result.y)):
+        raise SimulationError('Integration failed: the concentrations are not finite.')
+    return result
+
+def _uses_exact_solution(system, method):
+    # Returns True if the integration method asks for the exact solution of a first order network, or leaves it to the network
+    if method == 'exact':
+        if not system.is_first_order():
+            raise ValueError("The 'exact' method needs a network where every reaction is first order.")
+        return True
+    return method == None and system.is_first_order()
+
+def _solve_first_order(system, start_concentrations, rate_constants, time_points):
+    # Returns the exact conditions x time points x species concentrations of a first order network for each condition
+    return np.array([system.linear_solution(k).concentrations(x, time_points) for x, k in zip(start_concentrations, rate_constants)])
+
+def _values_for_each(values, number_of_conditions, vector_function, description):
+    # Returns a conditions x values array from one set of values for all of the conditions, or a list with the values of each condition
+    if isinstance(values, dict) or not isinstance(values[0], (dict, list, tuple, np.ndarray)):
+        return np.tile(vector_function(values), (number_of_conditions, 1))
+    if len(values) != number_of_conditions:
+        raise ValueError('Got {} for {} conditions, but expected {}.'.format(description, len(values), number_of_conditions))
+    return np.array([vector_function(x) for x in values])
+
+def _observe(system, concentrations, observables):
+    # Returns the observables from a conditions x time points x species array of concentrations, or the concentrations if there are none
+    if observables is None:
+        return concentrations
+    return concentrations @ system.observable_weights(observables).T
+
+# Worker process functions for Solver.simulate_batch, the system is sent once to each worker
+_worker_system = None
+
+def _set_worker_system(system):
+    global _worker_system
+    _worker_system = system
+
+def _simulate_condition(start_concentrations, rate_constants, time_points, method, rtol, atol):
+    # Returns the species x time points concentrations of one condition
+    return _integrate(_worker_system, start_concentrations, rate_constants, time_points, method, rtol, atol).y
+
+# Helper functions for the generated modules
+def _parameter_code(parameter):
+    # Python expression for a rate constant variable or override expression, with each variable read from a 'values' dictionary
+    # Placeholder names stand in for the variables while printing, since names like k_-1 and S[0] aren't Python variable names
+    import sympy as sp
+    variables = _expression_variables(parameter)
+    code = str(parameter.xreplace({x: sp.Symbol('_v{}'.format(i)) for i, x in enumerate(variables)}))
+    return re.sub(r'_v(\d+)', lambda x: 'values[{!r}]'.format(str(variables[int(x.group(1))])), code)
+
+def _expression_variables(expression):
+    # Returns the variables of a sympy expression, symbols and indexed entries like S[0], sorted by name
+    import sympy as sp
+    indexed_variables = expression.atoms(sp.Indexed)
+    base_labels = {x.base.label for x in indexed_variables}
+    return sorted(indexed_variables | {x for x in expression.atoms(sp.Symbol) if x not in base_labels}, key = str)
+
+def _write_module(module_path, source):
+    # Write a module file in one step, so other processes never import a partly written file
+    os.makedirs(os.path.dirname(module_path), exist_ok = True)
+    file_descriptor, temporary_path = tempfile.mkstemp(dir = os.path.dirname(module_path), suffix = '.tmp')
+    try:
+        with os.fdopen(file_descriptor, 'w') as module_file:
+            module_file.write(source)
+        os.replace(temporary_path, module_path)
+    except BaseException:
+        if os.path.exists(temporary_path):
+            os.remove(temporary_path)
+        raise
+
+def _import_module(module_path, module_name):
+    # Import a module from a file, Python keeps the compiled bytecode next to it for later processes
+    spec = importlib.util.spec_from_file_location(module_name, module_path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+# Source of the generated rate equation modules, see MassActionSystem for the layout of the arrays
+_MODULE_TEMPLATE = '''"""Mass action rate equations generated by bikipy.bikicore.solver, do not edit.
+
+Concentrations x and rate constants k are flat arrays in the species and reaction order of the network's ReactionTable.
+"""
+
+import numpy as np
+import scipy.sparse
+
+FINGERPRINT = {fingerprint!r}
+MODULE_VERSION = {version}
+NUMBER_OF_SPECIES = {number_of_species}
+NUMBER_OF_REACTIONS = {number_of_reactions}
+SPECIES_VARIABLES = {species_variables!r}
+
+# Reactant indices of each reaction, NUMBER_OF_SPECIES points at a constant 1
+FIRST_REACTANTS = np.array({first_reactants!r}, dtype = np.int64)
+SECOND_REACTANTS = np.array({second_reactants!r}, dtype = np.int64)
+
+# Stoichiometry matrix, species x reactions
+STOICHIOMETRY = scipy.sparse.csr_matrix((np.array({stoichiometry_data!r}, dtype = float), np.array({stoichiometry_indices!r}, dtype = np.int64),
+                                         np.array({stoichiometry_indptr!r}, dtype = np.int64)), shape = (NUMBER_OF_SPECIES, NUMBER_OF_REACTIONS))
+
+# Flux derivative entries, and the map from them to the values of the Jacobian's fixed sparsity pattern
+FIRST_ENTRIES = np.array({first_entries!r}, dtype = np.int64)
+SECOND_ENTRIES = np.array({second_entries!r}, dtype = np.int64)
+FIRST_PARTNERS = SECOND_REACTANTS[FIRST_ENTRIES]
+SECOND_PARTNERS = FIRST_REACTANTS[SECOND_ENTRIES]
+JACOBIAN_MAP = scipy.sparse.csr_matrix((np.array({jacobian_map_data!r}, dtype = float), np.array({jacobian_map_indices!r}, dtype = np.int64),
+                                        np.array({jacobian_map_indptr!r}, dtype = np.int64)), shape = {jacobian_map_shape!r})
+JACOBIAN_INDICES = np.array({jacobian_indices!r}, dtype = np.int64)
+JACOBIAN_INDPTR = np.array({jacobian_indptr!r}, dtype = np.int64)
+
+def rate_constants(values):
+    # Rate constants in reaction order from a dictionary of variable name -> value
+    return np.array([
+    {parameter_code}], dtype = float)
+
+def fluxes(x, k):
+    extended_x = np.append(x, 1.)
+    return k * extended_x[FIRST_REACTANTS] * extended_x[SECOND_REACTANTS]
+
+def rhs(t, x, k):
+    return STOICHIOMETRY @ fluxes(x, k)
+
+def jacobian(t, x, k):
+    extended_x = np.append(x, 1.)
+    flux_derivatives = np.concatenate([k[FIRST_ENTRIES] * extended_x[FIRST_PARTNERS], k[SECOND_ENTRIES] * extended_x[SECOND_PARTNERS]])
+    return scipy.sparse.csr_matrix((JACOBIAN_MAP @ flux_derivatives, JACOBIAN_INDICES, JACOBIAN_INDPTR), shape = (NUMBER_OF_SPECIES, NUMBER_OF_SPECIES))
+'''
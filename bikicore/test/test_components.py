@@ -2,8 +2,11 @@
 
 """
 import pytest
+import collections
+import numpy as np
 import sympy as sp
 import networkx as nx
+from traits.api import TraitError
 import bikipy.bikicore.components as bkcc
 import bikipy.bikicore.model as bkcm
 from bikipy.bikicore.exceptions import ComponentNotValidError, RuleNotValidError
@@ -287,6 +290,89 @@ def test_add_component_list(default_State_instance, default_Protein_instance, de
     assert dsi.required_protein_list == [dpi]
     assert dsi.req_protein_conf_lists == [[0,1]]
 
+# Test that from_lists makes the same state inside and outside of a bulk_build context
+def test_State_from_lists(default_Protein_instance, default_Drug_instance):
+    dpi = default_Protein_instance
+    ddi = default_Drug_instance # For typing convenience
+    test_comp = [ddi, dpi, dpi]
+    test_conf = [[None], [0], [1]]
+    test_links = [(0, 1), (1, 2)]
+    
+    # Normal construction
+    s1 = bkcc.State.from_lists(test_comp, test_conf, test_links)
+    
+    # Bulk construction, IDs should be cheap and increasing
+    with bkcc.bulk_build():
+        s2 = bkcc.State.from_lists(test_comp, test_conf, test_links)
+        s3 = bkcc.State.from_lists(test_comp, test_conf, test_links)
+        t1 = bkcc.Association()
+    assert s2.ID.int < s3.ID.int < t1.ID.int
+    for current_state in [s1, s2]:
+        assert current_state.required_drug_list == [ddi]
+        assert current_state.required_protein_list == [dpi, dpi]
+        assert current_state.req_protein_conf_lists == [[0], [1]]
+        assert current_state.internal_links == test_links
+    assert s1.generate_state_key() == s2.generate_state_key()
+    
+    # Outside the context, IDs are random again and the traits are validated as usual
+    assert bkcc.State().ID.version == 4
+    with pytest.raises(TraitError):
+        bkcc.State.from_lists(test_comp, test_conf, ['bad link'])
+
+# Test that cheap IDs from different processes don't repeat
+def test_bulk_build_IDs_in_processes():
+    import concurrent.futures
+    import multiprocessing
+    with bkcc.bulk_build():
+        parent_IDs = {bkcc.State().ID for repeat in range(3)}
+    with concurrent.futures.ProcessPoolExecutor(2, mp_context = multiprocessing.get_context('fork')) as executor:
+        child_IDs = [executor.submit(_bulk_build_IDs, 3).result() for repeat in range(2)]
+    all_IDs = parent_IDs.union(*child_IDs)
+    assert len(all_IDs) == 9
+    assert all(x.int >> 64 != 0 for x in all_IDs)
+
+# Test that invalid values stored during a bulk_build context are caught when the context closes
+def test_bulk_build_checks_values(default_Protein_instance, default_Drug_instance):
+    dpi = default_Protein_instance
+    ddi = default_Drug_instance # For typing convenience
+    with pytest.raises(TraitError):
+        with bkcc.bulk_build():
+            bkcc.State.from_lists([ddi, dpi], [[None], [0]], ['bad link'])
+    with pytest.raises(TraitError):
+        with bkcc.bulk_build():
+            bkcc.State.from_lists([ddi, dpi], [[None], ['bad conformation']], [])
+    
+    # Context should be closed after the error
+    assert bkcc.State().ID.version == 4
+
+# Test that states made in a bulk_build context have validated trait lists once it closes
+def test_bulk_build_trait_lists(default_Protein_instance, default_Drug_instance):
+    dpi = default_Protein_instance
+    ddi = default_Drug_instance # For typing convenience
+    with bkcc.bulk_build():
+        s1 = bkcc.State.from_lists([ddi, dpi], [[None], [0]], [(0, 1)])
+    with pytest.raises(TraitError):
+        s1.required_drug_list.append(dpi)
+    with pytest.raises(TraitError):
+        s1.req_protein_conf_lists[0].append('active')
+    s1.required_drug_list.append(ddi)
+    assert s1.required_drug_list == [ddi, ddi]
+
+# Test that state transitions made in a bulk_build context are validated once it closes
+def test_bulk_build_transitions():
+    with bkcc.bulk_build():
+        t1 = bkcc.Conversion(reference_direction = False)
+        t2 = bkcc.Dissociation()
+    assert t1.reference_direction == False and t1.ID.int < t2.ID.int
+    assert t1.trait_get('ID', 'reference_direction') == {'ID': t1.ID, 'reference_direction': False}
+    with pytest.raises(TraitError):
+        t1.reference_direction = 'backwards'
+    with pytest.raises(TraitError):
+        with bkcc.bulk_build():
+            bkcc.Conversion(reference_direction = 'backwards')
+    with pytest.raises(TraitError):
+        bkcc.Conversion(reference_direction = 'backwards')
+
 # Test if the state component generator is giving us the values back in correct order
 def test_enumerate_components(default_State_instance, default_Protein_instance, default_Drug_instance):
     dsi = default_State_instance
@@ -363,7 +449,54 @@ def test_get_component_by_number_with_conformation(default_State_instance, defau
     with pytest.raises(IndexError):
         dsi.get_component_by_number(-1, return_conformations = True)
         dsi.get_component_by_number(4, True)
-        
+
+# Test that equivalent states give the same canonical key, regardless of list order and link direction
+def test_State_generate_state_key_equivalent(default_Protein_instance, default_Drug_instance, modified_Protein_instance):
+    dpi = default_Protein_instance
+    ddi = default_Drug_instance
+    mpi = modified_Protein_instance # For typing convenience
+
+    # A-R(0)-M(1), with the proteins and the link in one order
+    s1 = bkcc.State()
+    s1.add_component_list([ddi, dpi, mpi], [None, [0], [1]])
+    s1.internal_links = [(0, 1), (1, 2)]
+
+    # Same complex built in the opposite order
+    s2 = bkcc.State()
+    s2.add_component_list([ddi, mpi, dpi], [None, [1], [0]])
+    s2.internal_links = [(2, 0), (1, 2)]
+
+    assert s1.generate_state_key() == s2.generate_state_key()
+    assert hash(s1.generate_state_key()) == hash(s2.generate_state_key())
+    assert bkcc.create_state_key([ddi, dpi, mpi], [None, [0], [1]], [(1, 0), (2, 1)]) == s1.generate_state_key()
+
+# Test that different conformations or link structures give different canonical keys
+def test_State_generate_state_key_different(default_Protein_instance, default_Drug_instance):
+    dpi = default_Protein_instance
+    ddi = default_Drug_instance # For typing convenience
+
+    # A bound to R(0) in a R(0)R(1) dimer
+    s1 = bkcc.State()
+    s1.add_component_list([ddi, dpi, dpi], [None, [0], [1]])
+    s1.internal_links = [(1, 2), (0, 1)]
+
+    # A bound to R(1) in a R(0)R(1) dimer
+    s2 = bkcc.State()
+    s2.add_component_list([ddi, dpi, dpi], [None, [0], [1]])
+    s2.internal_links = [(1, 2), (0, 2)]
+
+    # Unlinked A, R(0) and R(1)
+    s3 = bkcc.State()
+    s3.add_component_list([ddi, dpi, dpi], [None, [0], [1]])
+
+    # A bound to R(0) in a R(0)R(0) dimer
+    s4 = bkcc.State()
+    s4.add_component_list([ddi, dpi, dpi], [None, [0], [0]])
+    s4.internal_links = [(1, 2), (0, 1)]
+
+    keys = [s1.generate_state_key(), s2.generate_state_key(), s3.generate_state_key(), s4.generate_state_key()]
+    assert len(set(keys)) == 4
+
 # Test for autosymbol function with a drug
 def test_State_autosymbol_drug(default_State_instance, default_Drug_instance):
     dsi = default_State_instance
@@ -430,6 +563,22 @@ def test_State_autosymbol_complex_drug_and_protein(default_State_instance, defau
     # Test name
     assert dsi.symbol == 'ApR,*R*'
     
+# Test for autosymbol function with two copies of the same protein
+def test_State_autosymbol_repeated_protein(default_State_instance, default_Protein_instance):
+    dsi = default_State_instance
+    dpi = default_Protein_instance # For typing convenience
+    
+    # Create a dimer
+    dsi.required_protein_list = [dpi, dpi]
+    dsi.req_protein_conf_lists = [[0], [1]]
+    dsi.internal_links = [(0, 1)]
+    
+    # Call autosymbol
+    dsi.autosymbol()
+    
+    # Test name
+    assert dsi.symbol == 'RR*'
+    
     
 # -------Tests for State Transition objects-------
 
@@ -1001,6 +1150,53 @@ def test_generate_signature_list_any_to_conf_conversion(default_Model_irreversib
         sig_list[0].third_state_count[(dpi, (0,))]
         sig_list[0].third_state_count[(dpi, (1,))]
 
+# Test if the compiled rule holds the same lists and signatures as the rule
+def test_compile_rule(default_Model_irreversible_dissociation, default_Protein_instance, default_Drug_instance):
+    dmi = default_Model_irreversible_dissociation
+    dpi = default_Protein_instance
+    ddi = default_Drug_instance # For typing convenience
+    r1 = dmi.rule_list[0]
+
+    # We have A dissociates from AR([])
+    compiled_rule = r1.compile_rule()
+    assert r1.get_compiled_rule() is compiled_rule
+    assert compiled_rule.generate_component_list('subject') == ([ddi], [None])
+    assert compiled_rule.generate_component_list('object') == r1.generate_component_list('object')
+    assert compiled_rule.generate_component_list('difference') == ([dpi], [[]])
+    assert compiled_rule.object_conformation_combinations == [[None, (0,)], [None, (1,)]]
+    assert len(compiled_rule.signature_list) == len(r1.generate_signature_list())
+    with pytest.raises(ValueError):
+        compiled_rule.generate_component_list('something else')
+    
+    # The frozen signatures are made once for each alphabet
+    frozen_signatures = compiled_rule.get_frozen_signature_list(dmi.signature_alphabet)
+    assert frozen_signatures == [x.freeze(dmi.signature_alphabet) for x in compiled_rule.signature_list]
+    assert compiled_rule.get_frozen_signature_list(dmi.signature_alphabet) is frozen_signatures
+    new_alphabet = bkcc.SignatureAlphabet()
+    assert compiled_rule.get_frozen_signature_list(new_alphabet)[0].alphabet is new_alphabet
+
+# Test if editing a rule clears the compiled rule
+def test_compile_rule_cleared_by_edit(default_Model_irreversible_dissociation, default_Protein_instance):
+    dmi = default_Model_irreversible_dissociation
+    dpi = default_Protein_instance # For typing convenience
+    r1 = dmi.rule_list[0]
+
+    # Edit the object conformations, both by replacing and by changing items
+    compiled_rule = r1.compile_rule()
+    r1.object_conf = [None, [1]]
+    assert r1.compiled_rule == None
+    assert r1.get_compiled_rule().generate_component_list('difference') == ([dpi], [[1]])
+    r1.object_conf[1] = [0]
+    assert r1.compiled_rule == None
+    assert r1.get_compiled_rule().generate_component_list('difference') == ([dpi], [[0]])
+    assert r1.get_compiled_rule() is not compiled_rule
+    
+    # Edit one of the inner conformation lists in place
+    compiled_rule = r1.get_compiled_rule()
+    r1.object_conf[1].append(1)
+    assert r1.get_compiled_rule() is not compiled_rule
+    assert r1.get_compiled_rule().generate_component_list('difference') == ([dpi], [[0, 1]])
+    assert r1.get_compiled_rule() is r1.get_compiled_rule()
 
 # ------Tests for Network objects------
 
@@ -1010,6 +1206,64 @@ def test_Network_has_main_graph(default_Network_instance):
     assert hasattr(default_Network_instance, 'main_graph')
 def test_Network_has_main_blacklist(default_Network_instance):
     assert hasattr(default_Network_instance, 'main_graph_blacklist')
+def test_Network_has_state_key_index(default_Network_instance):
+    assert hasattr(default_Network_instance, 'state_key_index')
+
+# Test that the state key index finds states, including ones added or removed directly on the main graph
+def test_Network_find_state(default_Network_instance, default_Protein_instance, default_Drug_instance):
+    dni = default_Network_instance
+    dpi = default_Protein_instance
+    ddi = default_Drug_instance # For typing convenience
+
+    s1 = bkcc.State()
+    s1.add_component_list([ddi], [None])
+    s2 = bkcc.State()
+    s2.add_component_list([ddi, dpi], [None, [0]])
+    s2.internal_links = [(0, 1)]
+
+    # Add states by hand, without telling the index
+    dni.main_graph.add_node(s1)
+    dni.main_graph.add_node(s2)
+    assert dni.find_state(s1.generate_state_key()) is s1
+    assert dni.find_state(bkcc.create_state_key([dpi, ddi], [[0], None], [(1, 0)])) is s2
+    assert dni.find_state(bkcc.create_state_key([dpi], [[0]], [])) == None
+
+    # Removed states should not be found
+    dni.main_graph.remove_node(s2)
+    assert dni.find_state(s2.generate_state_key()) == None
+
+# Test that the component index gives back the states containing the requested components, in graph order
+def test_Network_find_states_with_components(default_Network_instance, default_Protein_instance, default_Drug_instance):
+    dni = default_Network_instance
+    dpi = default_Protein_instance
+    ddi = default_Drug_instance # For typing convenience
+
+    s1 = bkcc.State()
+    s1.add_component_list([ddi], [None])
+    s2 = bkcc.State()
+    s2.add_component_list([ddi, dpi], [None, [0]])
+    s2.internal_links = [(0, 1)]
+    s3 = bkcc.State()
+    s3.add_component_list([dpi], [[1]])
+    s4 = bkcc.State()
+    s4.add_component_list([ddi, dpi], [None, [1]])
+    s4.internal_links = [(0, 1)]
+    for current_state in [s1, s2, s3]:
+        dni.main_graph.add_node(current_state)
+
+    # States are indexed by component, and by component and conformation
+    assert dni.find_states_with_components([ddi], [None]) == [s1, s2]
+    assert dni.find_states_with_components([dpi], [[]]) == [s2, s3]
+    assert dni.find_states_with_components([dpi], [[1]]) == [s3]
+    assert dni.find_states_with_components([ddi, dpi], [None, []]) == [s2]
+
+    # Index is kept up to date when states are added and removed through the network
+    dni.main_graph.add_node(s4)
+    dni.index_state(s4)
+    dni.main_graph.remove_node(s2)
+    dni.unindex_state(s2)
+    assert dni.find_states_with_components([ddi, dpi], [None, []]) == [s4]
+    assert dni.find_states_with_components([dpi], [[1]]) == [s3, s4]
 
 # Test for autosymbol function on nodes
 def test_Network_autosymbol_node(default_two_state_antagonist_model_with_main_graph):
@@ -1090,6 +1344,20 @@ def test_Network_autonumber_edge(default_two_state_antagonist_model_with_main_gr
         acceptable_numbers.remove(testedge.number)
     assert len(acceptable_numbers) == 0
     
+# Test that autonumber keeps existing edge numbers and fills in the lowest unused numbers around them
+def test_Network_autonumber_edge_prenumbered(default_two_state_antagonist_model_with_main_graph):
+    dam = default_two_state_antagonist_model_with_main_graph
+    
+    # Give the last edge a number by hand
+    edge_list = [*dam.network.main_graph.edges.data('reaction_type')]
+    prenumbered_STobj = edge_list[-1][2]
+    prenumbered_STobj.number = -2
+    dam.network.autonumber()
+    
+    # The hand numbered edge is left alone, the rest still use 1 to 4
+    assert prenumbered_STobj.number == -2
+    assert sorted({abs(x.number) for u, v, x in edge_list}) == [1, 2, 3, 4]
+
 # Test for autovariable function on nodes
 def test_Network_autovariable_node(default_two_state_antagonist_model_with_main_graph):
     dam = default_two_state_antagonist_model_with_main_graph
@@ -1142,6 +1410,56 @@ def test_Network_autovariable_edge(default_two_state_antagonist_model_with_main_
         acceptable_vars.remove(testedge.variable)
     assert len(acceptable_vars) == 0
     
+# Test that indexed autovariable gives S[i] and k[j] entries in the species and reaction order of the reaction table
+def test_Network_autovariable_indexed(default_two_state_antagonist_model_with_main_graph):
+    dam = default_two_state_antagonist_model_with_main_graph
+    network = dam.network
+    network.autonumber()
+    network.autovariable(indexed = True)
+    S = network.state_variable_base
+    k = network.rate_constant_base
+    assert isinstance(S, sp.IndexedBase) and isinstance(k, sp.IndexedBase)
+    
+    table = network.get_reaction_table()
+    assert [x.variable for x in table.species] == [S[i] for i in range(5)]
+    assert table.get_parameters() == [k[j] for j in range(8)]
+    
+    # Back to one symbol per state and edge
+    network.autovariable()
+    assert network.state_variable_base == None
+    assert sorted(str(x.variable) for x in table.species) == ['S_1', 'S_2', 'S_3', 'S_4', 'S_5']
+
+# Test that the symbolic rate equations match in both variable modes and lambdify into array indexed code
+def test_ReactionTable_rate_equations(default_two_state_antagonist_model_with_main_graph):
+    dam = default_two_state_antagonist_model_with_main_graph
+    network = dam.network
+    network.autonumber()
+    network.autovariable()
+    table = network.get_reaction_table()
+    symbol_equations = table.rate_equations()
+    
+    # Every equation sums to zero over the A and R containing species, total drug and protein are conserved
+    for current_component in dam.drug_list + dam.protein_list:
+        total_change = sum(sp.Integer((x.required_drug_list + x.required_protein_list).count(current_component)) * y for x, y in zip(table.species, symbol_equations))
+        assert sp.expand(total_change) == 0
+    with pytest.raises(ValueError):
+        table.lambdify_rate_equations()
+    
+    # Indexed variables give the same equations with S[i] for S_(i + 1) and k[j] for the j-th rate constant
+    symbol_variables = [x.variable for x in table.species + table.reactions]
+    network.autovariable(indexed = True)
+    symbol_to_indexed = {x: y.variable for x, y in zip(symbol_variables, table.species + table.reactions)}
+    indexed_equations = table.rate_equations()
+    assert [sp.expand(x.xreplace(symbol_to_indexed) - y) for x, y in zip(symbol_equations, indexed_equations)] == [0] * 5
+    
+    # The lambdified function takes the two arrays
+    rate_equations_function = table.lambdify_rate_equations()
+    concentrations = np.arange(1., 6.)
+    rate_constants = np.arange(1., 9.) / 10
+    values = {**{network.state_variable_base[i]: concentrations[i] for i in range(5)}, **{network.rate_constant_base[j]: rate_constants[j] for j in range(8)}}
+    expected = [float(x.xreplace(values)) for x in indexed_equations]
+    assert np.allclose(rate_equations_function(concentrations, rate_constants), expected)
+
 # Test for autoname function on nodes
 def test_Network_autoname_node(default_two_state_antagonist_model_with_main_graph):
     dam = default_two_state_antagonist_model_with_main_graph
@@ -1223,6 +1541,45 @@ def test_Network_duplicate_correlates_from_other(default_two_state_antagonist_mo
     
     # Should test if correlate list goes back to main_graph, does not currently
 
+# Test that the duplicated graph is made of new objects that correlate with the source objects
+def test_Network_duplicate_graph_new_objects(default_two_state_antagonist_model_with_main_graph):
+    dam = default_two_state_antagonist_model_with_main_graph
+    main_graph = dam.network.main_graph
+    dam.network.autonumber()
+    dam.network.autosymbol()
+    
+    # Share a transition object between two edges, like an association does
+    shared_STobj = bkcc.Association()
+    edge_list = [*main_graph.edges()]
+    for u, v in edge_list[:2]:
+        main_graph.edges[u, v]['reaction_type'] = shared_STobj
+    dam.network.duplicate_graph('testgraph')
+    new_graph = dam.network.derived_graphs['testgraph']
+    
+    # None of the new graph's states or transitions are in the main graph
+    state_mapping = dict(dam.network.derived_graph_correlate_states['testgraph'])
+    STobj_mapping = dict(dam.network.derived_graph_correlate_STobjs['testgraph'])
+    assert [*state_mapping] == [*main_graph]
+    assert [*state_mapping.values()] == [*new_graph]
+    assert not any(x in main_graph for x in new_graph)
+    assert not any(x in STobj_mapping for u, v, x in new_graph.edges.data('reaction_type'))
+    
+    # The edges connect the correlated states with the correlated transitions, and shared transitions stay shared
+    for u, v, current_STobj in main_graph.edges.data('reaction_type'):
+        new_STobj = new_graph.edges[state_mapping[u], state_mapping[v]]['reaction_type']
+        assert new_STobj is STobj_mapping[current_STobj]
+        assert type(new_STobj) == type(current_STobj)
+        assert new_STobj.number == current_STobj.number
+        assert new_STobj.ID != current_STobj.ID
+    assert new_graph.edges[state_mapping[edge_list[0][0]], state_mapping[edge_list[0][1]]]['reaction_type'] is \
+        new_graph.edges[state_mapping[edge_list[1][0]], state_mapping[edge_list[1][1]]]['reaction_type']
+    
+    # States have the same information but a new ID
+    for current_state, new_state in state_mapping.items():
+        assert new_state.generate_state_key() == current_state.generate_state_key()
+        assert (new_state.number, new_state.symbol) == (current_state.number, current_state.symbol)
+        assert new_state.ID != current_state.ID
+
 # Test for graph reduction function
 def test_Network_reduce_graph_by_components(default_two_state_antagonist_model_with_main_graph):
     dam = default_two_state_antagonist_model_with_main_graph
@@ -1238,6 +1595,178 @@ def test_Network_reduce_graph_by_components(default_two_state_antagonist_model_w
         assert nx.algorithms.isomorphism.is_isomorphic(dam.network.main_graph, dam.network.derived_graphs['testgraph'])
     assert len(dam.network.derived_graphs['testgraph']) == 2
 
+# Test that derived networks are masked views of the main graph, and can be built on each other
+def test_Network_derive_network(default_two_state_antagonist_model_with_main_graph):
+    dam = default_two_state_antagonist_model_with_main_graph
+    network = dam.network
+    main_graph = network.main_graph
+    state_list = [*main_graph]
+    
+    # No masks keeps everything, the graph is a view of the main graph and not a copy
+    full_network = network.derive_network('full')
+    full_graph = full_network.get_graph()
+    assert [*full_graph] == state_list
+    assert [*full_graph.edges()] == [*main_graph.edges()]
+    assert network.derived_graphs['full'] is full_graph
+    assert full_network.nbytes() == len(main_graph) + main_graph.number_of_edges()
+    
+    # Drop a state with a node mask, its edges go with it
+    reduced_network = network.derive_network('reduced', node_mask = network.make_node_mask(state_list[1:]), parameter_overrides = {'k_1': 2.0})
+    reduced_graph = reduced_network.get_graph()
+    assert [*reduced_graph] == state_list[1:]
+    assert reduced_network.get_states() == state_list[1:]
+    assert all(state_list[0] not in x for x in reduced_graph.edges())
+    assert reduced_network.get_parameters({'k_1': 1.0, 'k_2': 1.0}) == {'k_1': 2.0, 'k_2': 1.0}
+    
+    # Drop an edge from the reduced network, masks and overrides combine
+    first_edge = [*reduced_graph.edges()][0]
+    edge_mask = np.array([x != first_edge for x in main_graph.edges()])
+    edge_network = network.derive_network('edge', edge_mask = edge_mask, parameter_overrides = {'k_2': 3.0}, source_network_name = 'reduced')
+    assert [*edge_network.get_graph().edges()] == [*reduced_graph.edges()][1:]
+    assert edge_network.parameter_overrides == {'k_1': 2.0, 'k_2': 3.0}
+    
+    # Bad masks and stale masks are caught
+    with pytest.raises(ValueError):
+        network.derive_network('bad', node_mask = [True])
+    with pytest.raises(ValueError):
+        network.derive_network('bad', source_network_name = 'not a network')
+    main_graph.add_node(bkcc.State())
+    edge_network.node_mask = edge_network.node_mask.copy()
+    with pytest.raises(ValueError):
+        edge_network.get_graph()
+
+# Test that the mask index and derived networks notice changes to the main graph that keep the number of nodes and edges
+def test_Network_derive_network_graph_version(default_two_state_antagonist_model_with_main_graph):
+    dam = default_two_state_antagonist_model_with_main_graph
+    network = dam.network
+    main_graph = network.main_graph
+    full_network = network.derive_network('full')
+    assert [*full_network.get_graph().edges()] == [*main_graph.edges()]
+    
+    # Add the first edge again, which moves it after the other edges from the same state, then replace a state with a new one
+    first_edge = [*main_graph.edges()][0]
+    edge_data = main_graph.edges[first_edge]
+    main_graph.remove_edge(*first_edge)
+    main_graph.add_edge(*first_edge, **edge_data)
+    assert network.get_mask_index()[3][first_edge] == [*main_graph.edges()].index(first_edge) > 0
+    with pytest.raises(ValueError):
+        full_network.get_graph()
+    old_state = bkcc.State()
+    main_graph.add_node(old_state)
+    state_network = network.derive_network('state', node_mask = network.make_node_mask([old_state]))
+    main_graph.remove_node(old_state)
+    new_state = bkcc.State()
+    main_graph.add_node(new_state)
+    assert network.make_node_mask([new_state])[-1]
+    with pytest.raises(ValueError):
+        state_network.get_graph()
+    
+    # Numbering the states and edges doesn't change the version
+    graph_version = network.get_graph_version()
+    network.autonumber()
+    assert network.get_graph_version() == graph_version
+
+# Test that the reaction table collects shared association/dissociation edges into single reactions
+def test_Network_get_reaction_table(default_two_state_antagonist_model_with_main_graph):
+    dam = default_two_state_antagonist_model_with_main_graph
+    network = dam.network
+    table = network.get_reaction_table()
+    
+    # A + R <-> AR, A + R* <-> AR*, R <-> R*, AR <-> AR*, with species and rate constants in number order
+    assert table.number_of_species == 5
+    assert table.number_of_reactions == 8
+    assert [*table.species_numbers] == [1, 2, 3, 4, 5]
+    assert [abs(x) for x in table.parameter_numbers] == [1, 1, 2, 2, 3, 3, 4, 4]
+    assert [x > 0 for x in table.parameter_numbers] == [True, False] * 4
+    assert table.get_parameters() == [x.variable for x in table.reactions]
+    reaction_sizes = collections.Counter((type(x).__name__, len(r), len(p)) for x, r, p in zip(table.reactions, table.reactants, table.products))
+    assert reaction_sizes == {('Association', 2, 1): 2, ('Dissociation', 1, 2): 2, ('Conversion', 1, 1): 4}
+    
+    # Matrices have the expected shapes, and the amount of each component is conserved by every reaction
+    stoichiometry = table.stoichiometry_matrix()
+    assert stoichiometry.shape == (5, 8)
+    assert table.reactant_order_matrix().shape == (8, 5)
+    assert (table.product_matrix() - table.reactant_order_matrix()).T.toarray().tolist() == stoichiometry.toarray().tolist()
+    for current_component in dam.drug_list + dam.protein_list:
+        component_counts = np.array([(x.required_drug_list + x.required_protein_list).count(current_component) for x in table.species])
+        assert not np.any(component_counts @ stoichiometry.toarray())
+    
+    # Rows give the reaction by symbols
+    rows = table.to_rows()
+    assert rows[0][0] == 1
+    assert [x[0] for x in rows] == [*table.parameter_numbers]
+
+# Test that a dimer of identical states gets a coefficient of 2, and that unnumbered graphs are refused
+def test_ReactionTable_dimer(default_Protein_instance):
+    dpi = default_Protein_instance
+    monomer = bkcc.State.from_lists([dpi], [[0]], [])
+    dimer = bkcc.State.from_lists([dpi, dpi], [[0], [0]], [(0, 1)])
+    graph = nx.DiGraph()
+    graph.add_edge(monomer, dimer, reaction_type = bkcc.Association())
+    graph.add_edge(dimer, monomer, reaction_type = bkcc.Dissociation())
+    with pytest.raises(ValueError):
+        bkcc.ReactionTable.from_graph(graph)
+    
+    # Number by hand
+    monomer.number, dimer.number = 1, 2
+    graph.edges[monomer, dimer]['reaction_type'].number = 1
+    graph.edges[dimer, monomer]['reaction_type'].number = -1
+    table = bkcc.ReactionTable.from_graph(graph)
+    assert table.reactants == [((0, 2),), ((1, 1),)]
+    assert table.products == [((1, 1),), ((0, 2),)]
+    assert table.stoichiometry_matrix().toarray().tolist() == [[-2, 2], [1, -1]]
+
+# ------Tests for CompactNetwork objects------
+
+# Test if a graph can be stored in a compact network and made into a graph again
+def test_CompactNetwork_graph_round_trip(default_two_state_antagonist_model_with_main_graph):
+    dmi = default_two_state_antagonist_model_with_main_graph
+    main_graph = dmi.network.main_graph
+    
+    # Store the main graph and make it back into a graph
+    compact_network = bkcc.CompactNetwork.from_graph(main_graph)
+    new_graph = compact_network.to_graph()
+    
+    # Check if we got the expected result
+    assert compact_network.number_of_states() == main_graph.number_of_nodes()
+    assert compact_network.number_of_edges() == main_graph.number_of_edges()
+    assert sorted((x.number, x.symbol, x.generate_state_key()) for x in new_graph) == sorted((x.number, x.symbol, x.generate_state_key()) for x in main_graph)
+    assert sorted((u.number, v.number, type(STobj), STobj.number) for u, v, STobj in new_graph.edges.data('reaction_type')) == \
+        sorted((u.number, v.number, type(STobj), STobj.number) for u, v, STobj in main_graph.edges.data('reaction_type'))
+
+# Test if states are stored as codes and given back on request
+def test_CompactNetwork_add_state(default_Protein_instance, default_Drug_instance):
+    dpi = default_Protein_instance
+    ddi = default_Drug_instance # For typing convenience
+    compact_network = bkcc.CompactNetwork()
+    
+    # Add a state for A bound to a dimer of R, twice, and a single R
+    index1 = compact_network.add_state([ddi, dpi, dpi], [None, [0], [0,1]], [(0,(1,2)), (1,2)], number = 4)
+    index2 = compact_network.add_state([ddi, dpi, dpi], [None, [0,1], [0]], [(0,(2,1)), (1,2)])
+    index3 = compact_network.add_state([dpi], [[0]], [])
+    
+    # Check if we got the expected result
+    assert index1 == index2 == 0
+    assert index3 == 1
+    assert compact_network.number_of_states() == 2
+    assert list(compact_network.element_offsets) == [0, 3, 4]
+    assert list(compact_network.link_offsets) == [0, 2, 2]
+    assert compact_network.element_components.dtype == np.int32
+    assert compact_network.get_component_list(0) == ([ddi, dpi, dpi], [None, [0], [0,1]])
+    assert compact_network.get_internal_links(0) == [(0,(1,2)), (1,2)]
+    assert compact_network.find_state([dpi], [[0]], []) == 1
+    assert compact_network.find_state([dpi], [[1]], []) == None
+    
+    # States are made on request, and the same object is given back while it is in use
+    state = compact_network.get_state(0)
+    assert state.number == 4
+    assert state.generate_component_list() == ([ddi, dpi, dpi], [None, [0], [0,1]])
+    assert compact_network.get_state(0) is state
+    with pytest.raises(IndexError):
+        compact_network.get_state(2)
+    with pytest.raises(ValueError):
+        compact_network.add_state([dpi, ddi], [[0], None], [])
+
 # ------Tests for CountingSignature objects------
 
 
@@ -1330,7 +1859,79 @@ def test_CountingSignature_direct_counts(default_Protein_instance, default_Drug_
     assert test_signature.third_state_count[(dpi, (0,1))] == 1
     assert test_signature.third_state_count[(dpi, (0))] == 0 # Check if a non-existing state is zero (actually returned as False, I think)
 
+# ------Tests for FrozenSignature objects------
 
+# Test if a frozen signature has count vectors that line up with the alphabet
+def test_FrozenSignature_vectors(default_Protein_instance, default_Drug_instance):
+    dpi = default_Protein_instance
+    ddi = default_Drug_instance # For typing convenience
+    alphabet = bkcc.SignatureAlphabet()
+    
+    # Freeze the signature for A + R(0,1) --> AR(0,1)
+    test_signature = bkcc.CountingSignature('conformations included')
+    test_signature.count_for_subject([ddi], [None])
+    test_signature.count_for_object([dpi], [[0,1]])
+    test_signature.count_for_third_state([ddi, dpi], [None, [0,1]])
+    frozen_signature = test_signature.freeze(alphabet)
+    
+    # Check if we got the expected result
+    assert len(alphabet) == 2
+    assert list(frozen_signature.subject_vector) == [1, 0]
+    assert list(frozen_signature.object_vector) == [0, 1]
+    assert list(frozen_signature.third_state_vector) == [1, 1]
+    
+    # Vectors are padded when the alphabet grows
+    alphabet.index((dpi, (0,)))
+    assert list(frozen_signature.get_vector('object', len(alphabet))) == [0, 1, 0]
+    with pytest.raises(ValueError):
+        frozen_signature.get_vector('something else')
+
+# Test if frozen signatures can't be changed and can be used as dictionary keys
+def test_FrozenSignature_immutable_and_hashable(default_Protein_instance, default_Drug_instance):
+    dpi = default_Protein_instance
+    ddi = default_Drug_instance # For typing convenience
+    alphabet = bkcc.SignatureAlphabet()
+    
+    # Make two signatures with the same counts, and grow the alphabet in between
+    frozen_signature1 = bkcc.FrozenSignature('components only', alphabet, collections.Counter([ddi]), collections.Counter([dpi]))
+    alphabet.index('something else')
+    frozen_signature2 = bkcc.FrozenSignature('components only', alphabet, collections.Counter([ddi]), collections.Counter([dpi]))
+    frozen_signature3 = bkcc.FrozenSignature('components only', alphabet, collections.Counter([dpi]), collections.Counter([ddi]))
+    
+    # Check if we got the expected result
+    assert frozen_signature1 == frozen_signature2
+    assert frozen_signature1 != frozen_signature3
+    assert len({frozen_signature1, frozen_signature2, frozen_signature3}) == 2
+    with pytest.raises(AttributeError):
+        frozen_signature1.subject_vector = None
+    with pytest.raises(ValueError):
+        frozen_signature1.subject_vector[0] = 2
+
+# Test subtraction and containment of frozen signatures
+def test_FrozenSignature_subtraction_and_containment(default_Protein_instance, default_Drug_instance):
+    dpi = default_Protein_instance
+    ddi = default_Drug_instance # For typing convenience
+    alphabet = bkcc.SignatureAlphabet()
+    
+    # Make signatures for AAR --> R and A --> R
+    frozen_signature1 = bkcc.FrozenSignature('components only', alphabet, collections.Counter([ddi, ddi, dpi]), collections.Counter([dpi]))
+    frozen_signature2 = bkcc.FrozenSignature('components only', alphabet, collections.Counter([ddi]), collections.Counter([dpi]))
+    
+    # Check if we got the expected result, subtraction should act like a Counter and never go negative
+    difference_signature = frozen_signature1 - frozen_signature2
+    assert list(difference_signature.subject_vector) == [1, 1]
+    assert list(difference_signature.object_vector) == [0, 0]
+    assert difference_signature.third_state_vector is None
+    assert list((frozen_signature2 - frozen_signature1).subject_vector) == [0, 0]
+    assert frozen_signature1.contains(frozen_signature2)
+    assert not frozen_signature2.contains(frozen_signature1)
+    
+    
 # ------Tests for  objects------
 
+#---------------------------- Helper functions --------------------------------
 
+def _bulk_build_IDs(number_of_IDs):
+    # Returns the IDs of new States made in a bulk_build context, run in worker processes
+    with bkcc.bulk_build():
+        return {bkcc.State().ID for repeat in range(number_of_IDs)}
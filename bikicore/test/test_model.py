@@ -3,6 +3,7 @@
 """
 import pytest
 import collections
+import itertools
 import networkx as nx
 import bikipy.bikicore.model as bkcm
 import bikipy.bikicore.components as bkcc
@@ -307,7 +308,68 @@ def test_Model_apply_rules_irr_association(model_for_matching_tests):
     
     # Compare shape of graph
     assert nx.algorithms.isomorphism.is_isomorphic(mmt.network.main_graph, testgraph)
-    
+
+# Test that rules are only applied to matches involving states that are new to the rule
+def test_Model_apply_rules_applied_states(model_for_matching_tests):
+    mmt = model_for_matching_tests
+
+    # Has rule for simple drug association - "A associates with R"
+
+    # Setup test network
+    s1 = bkcc.State()
+    s1.required_drug_list = [mmt.drug_list[0]]
+    mmt.network.main_graph.add_node(s1)
+
+    s2 = bkcc.State()
+    s2.required_protein_list = [mmt.protein_list[0]]
+    s2.req_protein_conf_lists = [[0]]
+    mmt.network.main_graph.add_node(s2)
+
+    # If the rule was already applied to both states, nothing should happen
+    applied_states = {mmt.rule_list[0]: {s1, s2}}
+    mmt.apply_rules_to_network(applied_states = applied_states)
+    assert mmt.network.main_graph.number_of_nodes() == 2
+
+    # A new R(1) state should only pair with A
+    s3 = bkcc.State()
+    s3.required_protein_list = [mmt.protein_list[0]]
+    s3.req_protein_conf_lists = [[1]]
+    mmt.network.main_graph.add_node(s3)
+    mmt.apply_rules_to_network(applied_states = applied_states)
+    assert mmt.network.main_graph.number_of_nodes() == 4
+    assert mmt.network.main_graph.number_of_edges() == 2
+    assert applied_states[mmt.rule_list[0]] == {s1, s2, s3}
+
+# Test that the graph changes made by the rules are counted
+def test_Model_apply_rules_graph_changes(model_for_matching_tests):
+    mmt = model_for_matching_tests
+
+    # Has rule for simple drug association - "A associates with R", change to reversible association
+    mmt.rule_list[0].rule = ' reversibly associates with '
+
+    # Setup test network
+    s1 = bkcc.State()
+    s1.required_drug_list = [mmt.drug_list[0]]
+    mmt.network.main_graph.add_node(s1)
+
+    s2 = bkcc.State()
+    s2.required_protein_list = [mmt.protein_list[0]]
+    s2.req_protein_conf_lists = [[0]]
+    mmt.network.main_graph.add_node(s2)
+
+    # AR is made with two association and two dissociation edges
+    graph_changes = mmt.apply_rules_to_network()
+    assert graph_changes == collections.Counter({'nodes_added': 1, 'edges_added': 4})
+
+    # Applying the rule again finds the same state and edges, so nothing changes
+    graph_changes = mmt.apply_rules_to_network()
+    assert sum(graph_changes.values()) == 0
+
+    # Removing AR takes all four edges with it
+    [s3] = [x for x in mmt.network.main_graph if len(x.required_drug_list) + len(x.required_protein_list) == 2]
+    graph_changes = mmt._remove_states(mmt.network.main_graph, mmt.network.main_graph_blacklist, [s3])
+    assert graph_changes == collections.Counter({'nodes_removed': 1, 'edges_removed': 4})
+
 # Test that the 'associates with' rule creates a valid shaped graph without unwanted dimerization
 def test_Model_apply_rules_irr_association_dimers(model_for_matching_tests):
     mmt = model_for_matching_tests
@@ -581,6 +643,93 @@ def test_Model_generate_network_four_rules_competitive(default_Model_four_rule_c
     # Compare shape of graph
     assert nx.algorithms.isomorphism.is_isomorphic(m4r.network.main_graph, testgraph)
 
+# Test that reduce_graph keeps the states made of the chosen components, and folds excess components into rate constants
+def test_Model_reduce_graph(default_Model_three_rule_antagonists):
+    m3r = default_Model_three_rule_antagonists
+    m3r.generate_network()
+    main_graph = m3r.network.main_graph
+    drug_A, drug_B = m3r.drug_list
+    
+    # Everything by default
+    all_network = m3r.reduce_graph('all')
+    assert [*all_network.get_graph()] == [*main_graph]
+    
+    # Exclusion and inclusion lists
+    no_B_graph = m3r.reduce_graph('no_B', excluded_components = [drug_B]).get_graph()
+    assert len(no_B_graph) == 5 # A, R, R*, AR, AR*
+    assert all(drug_B not in x.required_drug_list for x in no_B_graph)
+    assert m3r.network.derived_graphs['no_B'] is no_B_graph
+    assert len(m3r.reduce_graph('R_only', included_components = m3r.protein_list).get_graph()) == 2 
+    
+    # A in excess, free A is gone and the associations with A become first order
+    excess_network = m3r.reduce_graph('excess_A', excluded_components = [drug_B], pseudo_1st_order_components = [drug_A])
+    excess_graph = excess_network.get_graph()
+    free_A = [x for x in main_graph if x.required_drug_list == [drug_A] and x.required_protein_list == []][0]
+    assert len(excess_graph) == 4 # R, R*, AR, AR*
+    assert free_A not in excess_graph
+    association_STobjs = {x for u, v, x in main_graph.out_edges(free_A, 'reaction_type') if v in excess_graph}
+    assert len(association_STobjs) == 2
+    assert excess_network.parameter_overrides == {x.variable: x.variable * free_A.variable for x in association_STobjs}
+    assert all(x in association_STobjs for u, v, x in excess_graph.edges.data('reaction_type') if len(v.required_drug_list) > len(u.required_drug_list))
+    
+    # The reactions of the reduced network are first order in the protein states
+    table = m3r.network.get_reaction_table('excess_A')
+    for current_reaction, reaction_reactants in zip(table.reactions, table.reactants):
+        if current_reaction in association_STobjs:
+            assert len(reaction_reactants) == 1 and reaction_reactants[0][1] == 1
+
+# Test that generate_network records graph snapshots and only draws them after the network is finished
+def test_Model_generate_network_save_graphs(default_Model_two_rule_antagonist, tmp_path, monkeypatch):
+    m2r = default_Model_two_rule_antagonist
+    monkeypatch.chdir(tmp_path)
+    saved_files = m2r.generate_network(save_graphs = True, graph_format = 'svg')
+    
+    # Snapshots start with the singletons and end with the finished graph
+    snapshot_labels = [x.label for x in m2r.graph_snapshots]
+    assert snapshot_labels[0] == 'singleton_start_graph'
+    assert snapshot_labels[-1] == 'last_graph'
+    assert len(m2r.graph_snapshots[0].node_labels) == 3
+    assert len(m2r.graph_snapshots[-1].node_labels) == 5
+    assert len(m2r.graph_snapshots[-1].edges) == 12
+    assert saved_files == [x + '.svg' for x in snapshot_labels]
+    assert all((tmp_path / x).exists() for x in saved_files)
+    
+    # Drawing in a worker process writes the same files before returning, and passes on errors from the worker
+    for current_file in saved_files:
+        (tmp_path / current_file).unlink()
+    assert m2r.render_graph_snapshots('svg', in_worker = True) == saved_files
+    assert all((tmp_path / x).exists() for x in saved_files)
+    with pytest.raises(ValueError):
+        m2r.render_graph_snapshots('not_a_format', in_worker = True)
+    
+    # Nothing is recorded or drawn without save_graphs
+    assert m2r.generate_network() == []
+    assert m2r.graph_snapshots == []
+
+# Test that generate_network records statistics for each rule and cycle when asked to
+def test_Model_generate_network_stats(default_Model_four_rule_competitive_antagonists):
+    m4r = default_Model_four_rule_competitive_antagonists
+    stats = bkcm.GenerationStats()
+    callback_records = []
+    stats.callback = callback_records.append
+    m4r.generate_network(stats = stats)
+    
+    # One record for each rule in each cycle, in order
+    assert len(stats.records) % 4 == 0
+    assert [x.rule for x in stats.records[:4]] == m4r.rule_list
+    assert [x.cycle for x in stats.records] == [i // 4 for i in range(len(stats.records))]
+    assert callback_records == stats.records
+    
+    # Changes should add up to the final graph, starting from the 4 singleton states
+    totals = stats.totals_by_rule()
+    assert sum(x.nodes_added - x.nodes_removed for x in totals.values()) == 8 - 4
+    assert sum(x.edges_added - x.edges_removed for x in totals.values()) == 22
+    assert totals[m4r.rule_list[3]].nodes_removed > 0
+    assert all(x.signature_comparisons > 0 and x.wall_time > 0 for x in totals.values())
+    assert all(x.candidate_pairs >= x.valid_reactions for x in stats.records)
+    assert len(stats.report().splitlines()) == 5
+    assert sorted(stats.labeling_times) == ['autoname', 'autonumber', 'autosymbol', 'autovariable']
+
 # Test that the ' converts to ' rule creates a valid shaped graph 
 def test_Model_conversion(default_Model_conversion):
     dmc = default_Model_conversion
@@ -886,6 +1035,7 @@ def test_find_association_pairs(model_for_matching_tests, default_Protein_instan
     
     # We already have the rule A + R([]) --> AR([]), get the signature
     ref_sig = mmt.rule_list[0].generate_signature_list()
+    frozen_sig = [x.freeze(mmt.signature_alphabet) for x in ref_sig]
     
     # Make some states
     s1 = bkcc.State()
@@ -905,11 +1055,60 @@ def test_find_association_pairs(model_for_matching_tests, default_Protein_instan
     test_obj_list = [s2, s3]
     
     # Run function
-    valid_tuples = mmt._find_association_pairs(ref_sig, test_sub_list, test_obj_list)
+    valid_tuples = mmt._find_association_pairs(frozen_sig, test_sub_list, test_obj_list)
     
     # Check if we got the expected result
     assert valid_tuples == [(s1, s2)]
-    
+
+# Test that the bucketed pairing gives the same pairs in the same order as testing every combination
+def test_find_association_pairs_same_as_product(model_for_matching_tests, default_Protein_instance, default_Drug_instance):
+    mmt = model_for_matching_tests
+    dpi = default_Protein_instance
+    ddi = default_Drug_instance # For typing convenience
+
+    # Use a dimerization rule R([]) + R([]) --> RR([]) so states can be both subjects and objects
+    mmt.rule_list[0].rule_subject = [dpi]
+    mmt.rule_list[0].subject_conf = [[]]
+    ref_sig = mmt.rule_list[0].generate_signature_list()
+    frozen_sig = [x.freeze(mmt.signature_alphabet) for x in ref_sig]
+
+    # Make some states
+    s1 = bkcc.State()
+    s1.required_drug_list = [ddi]
+
+    s2 = bkcc.State()
+    s2.required_protein_list = [dpi]
+    s2.req_protein_conf_lists = [[0,1]]
+
+    s3 = bkcc.State()
+    s3.required_drug_list = [ddi]
+    s3.required_protein_list = [dpi]
+    s3.req_protein_conf_lists = [[0,1]]
+    s3.internal_links = [(0,1)]
+
+    s4 = bkcc.State()
+    s4.required_protein_list = [dpi, dpi]
+    s4.req_protein_conf_lists = [[0,1], [0,1]]
+    s4.internal_links = [(0,1)]
+
+    # Make some state lists
+    test_sub_list = [s1, s2, s3, s4]
+    test_obj_list = [s4, s3, s2, s1]
+
+    # Test every combination
+    expected_tuples = []
+    for current_tuple in itertools.product(test_sub_list, test_obj_list):
+        test_signature = bkcc.CountingSignature(ref_sig[0].count_type, *current_tuple)
+        sub_comp, sub_conf = current_tuple[0].generate_component_list()
+        obj_comp, obj_conf = current_tuple[1].generate_component_list()
+        test_signature.count_for_third_state(sub_comp + obj_comp, sub_conf + obj_conf)
+        if mmt._signature_match_association(test_signature, ref_sig):
+            expected_tuples.append(current_tuple)
+
+    # Check if we got the expected result, with and without a set of new states
+    assert mmt._find_association_pairs(frozen_sig, test_sub_list, test_obj_list) == expected_tuples
+    assert mmt._find_association_pairs(frozen_sig, test_sub_list, test_obj_list, {s3}) == [x for x in expected_tuples if s3 in x]
+
 # Test that we return valid state pairs with a conformation signature. NOTE Signature matching is not quite sufficient
 def test_find_association_pairs_with_conformation(model_for_matching_tests, default_Protein_instance, default_Drug_instance):
     mmt = model_for_matching_tests    
@@ -919,6 +1118,7 @@ def test_find_association_pairs_with_conformation(model_for_matching_tests, defa
     # Modify rule to give A + R([1]) --> AR([1]), get the signature
     mmt.rule_list[0].object_conf = [[1]]
     ref_sig = mmt.rule_list[0].generate_signature_list()
+    frozen_sig = [x.freeze(mmt.signature_alphabet) for x in ref_sig]
     
     # Make some states
     s1 = bkcc.State()
@@ -949,7 +1149,7 @@ def test_find_association_pairs_with_conformation(model_for_matching_tests, defa
     test_obj_list = [s1, s2, s3, s4, s5]
     
     # Run functions - need an additional internal link check to get the desired behavior
-    signature_valid_tuples = mmt._find_association_pairs(ref_sig, test_sub_list, test_obj_list)
+    signature_valid_tuples = mmt._find_association_pairs(frozen_sig, test_sub_list, test_obj_list)
     valid_tuples, link_list = mmt._find_association_internal_link(mmt.rule_list[0], signature_valid_tuples)
     
     # Check if we got the expected result
@@ -973,6 +1173,7 @@ def test_find_dissociation_pairs(default_Model_instance, default_Protein_instanc
     
     # Get the signature
     ref_sig = r1.generate_signature_list()
+    frozen_sig = [x.freeze(dmi.signature_alphabet) for x in ref_sig]
     
     # Make some states
     s1 = bkcc.State() # Doesn't work - no protein
@@ -986,17 +1187,19 @@ def test_find_dissociation_pairs(default_Model_instance, default_Protein_instanc
     s3.required_drug_list = [ddi]
     s3.required_protein_list = [dpi]
     s3.req_protein_conf_lists = [[0,1]]
+    s3.internal_links = [(0,1)]
     
     s4 = bkcc.State() # Should work, two different possible leaving drugs (need link analysis to find the correct one)
     s4.required_drug_list = [ddi, ddi]
     s4.required_protein_list = [dpi]
     s4.req_protein_conf_lists = [[0,1]]
+    s4.internal_links = [(0,2), (1,2)]
     
     # Make some state lists
     test_obj_list = [s1, s2, s3, s4]
     
     # Run function
-    valid_tuples = dmi._find_dissociation_pairs(ref_sig, test_obj_list)
+    valid_tuples = dmi._find_dissociation_pairs(frozen_sig, test_obj_list)
 
     # Check if we got the expected result
     assert valid_tuples == [(s3, (0,)), (s4, (0,)), (s4, (1,))]
@@ -1019,6 +1222,7 @@ def test_find_dissociation_pairs_with_conformations(default_Model_instance, defa
     
     # Get the signature
     ref_sig = r1.generate_signature_list()
+    frozen_sig = [x.freeze(dmi.signature_alphabet) for x in ref_sig]
     
     # Make some states
     s1 = bkcc.State() # Doesn't work - no protein
@@ -1032,35 +1236,77 @@ def test_find_dissociation_pairs_with_conformations(default_Model_instance, defa
     s3.required_drug_list = [ddi]
     s3.required_protein_list = [dpi]
     s3.req_protein_conf_lists = [[0]]
+    s3.internal_links = [(0,1)]
     
     s4 = bkcc.State() # Should work, two different possible leaving drugs (need link analysis to find the correct one)
     s4.required_drug_list = [ddi, ddi]
     s4.required_protein_list = [dpi]
     s4.req_protein_conf_lists = [[0]]
+    s4.internal_links = [(0,2), (1,2)]
     
     s5 = bkcc.State() # Doesn't work, wrong conformation
     s5.required_drug_list = [ddi] 
     s5.required_protein_list = [dpi]
     s5.req_protein_conf_lists = [[1]]
+    s5.internal_links = [(0,1)]
     
-    s6 = bkcc.State() # Should work, get one good split of just the drug, and one split of drug plus R(1), which we have to clean with link checking
+    s6 = bkcc.State() # Should work, get one good split of just the drug. Drug plus R(1) also fits the signature, but does not break a single link
     s6.required_drug_list = [ddi]
     s6.required_protein_list = [dpi, dpi]
     s6.req_protein_conf_lists = [[0], [1]]
+    s6.internal_links = [(0,1), (1,2)]
     
     s7 = bkcc.State() # Should work, get two good splits of the different drugs (need link analysis to find the correct ones)
     s7.required_drug_list = [ddi, ddi]
     s7.required_protein_list = [dpi, dpi]
     s7.req_protein_conf_lists = [[0], [0]]
+    s7.internal_links = [(0,2), (1,3), (2,3)]
     
     # Make some state lists
     test_obj_list = [s1, s2, s3, s4, s5, s6, s7]
     
     # Run function
-    valid_tuples = dmi._find_dissociation_pairs(ref_sig, test_obj_list)
+    valid_tuples = dmi._find_dissociation_pairs(frozen_sig, test_obj_list)
+    
+    # Check if we got the expected result
+    assert valid_tuples == [(s3, (0,)), (s4, (0,)), (s4, (1,)), (s6, (0,)), (s7, (0,)), (s7, (1,))]
+
+# Test that dissociation splits come from breaking single links
+def test_find_dissociation_splits(default_Model_instance, default_Protein_instance, default_Drug_instance):
+    dmi = default_Model_instance
+    dpi = default_Protein_instance
+    ddi = default_Drug_instance # For typing convenience
+    
+    # Make some states
+    s1 = bkcc.State() # A bound to a chain of three R
+    s1.required_drug_list = [ddi]
+    s1.required_protein_list = [dpi, dpi, dpi]
+    s1.req_protein_conf_lists = [[0], [0], [0]]
+    s1.internal_links = [(0,1), (1,2), (2,3)]
+    
+    s2 = bkcc.State() # A bound in a loop of R, only the drug link can break by itself
+    s2.required_drug_list = [ddi]
+    s2.required_protein_list = [dpi, dpi, dpi]
+    s2.req_protein_conf_lists = [[0], [0], [0]]
+    s2.internal_links = [(0,1), (1,2), (2,3), (1,3)]
+    
+    s3 = bkcc.State() # Unlinked drug can go with either side
+    s3.required_drug_list = [ddi]
+    s3.required_protein_list = [dpi, dpi]
+    s3.req_protein_conf_lists = [[0], [0]]
+    s3.internal_links = [(1,2)]
+    
+    s4 = bkcc.State() # Nested link, try all the splits
+    s4.required_drug_list = [ddi]
+    s4.required_protein_list = [dpi, dpi]
+    s4.req_protein_conf_lists = [[0], [0]]
+    s4.internal_links = [(0,(1,2)), (1,2)]
     
     # Check if we got the expected result
-    assert valid_tuples == [(s3, (0,)), (s4, (0,)), (s4, (1,)), (s6, (0,)), (s6, (0, 2)), (s7, (0,)), (s7, (1,))]
+    assert dmi._find_dissociation_splits(s1) == [(0,), (3,), (0, 1), (2, 3), (0, 1, 2), (1, 2, 3)]
+    assert dmi._find_dissociation_splits(s2) == [(0,), (1, 2, 3)]
+    assert dmi._find_dissociation_splits(s3) == [(1,), (2,), (0, 1), (0, 2)]
+    assert dmi._find_dissociation_splits(s4) == [(0,), (1,), (2,), (0, 1), (0, 2), (1, 2)]
 
 # Test for correct translation of link lists
 def test_combine_internal_link_lists(model_for_matching_tests, default_Protein_instance, default_Drug_instance):
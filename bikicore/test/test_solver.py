@@ -0,0 +1,489 @@
+"""Test suite for classes in solver.py
+
+"""
+import sys
+import json
+import subprocess
+import pytest
+import numpy as np
+import bikipy.bikicore.components as bkcc
+import bikipy.bikicore.model as bkcm
+import bikipy.bikicore.solver as bkcs
+from bikipy.bikicore.exceptions import SimulationError
+
+#---- Testing fixtures ----
+
+# Create a default Drug object for reuse in tests
+@pytest.fixture()
+def default_Drug_instance():
+    ddi = bkcc.Drug()
+    ddi.name = 'adrenaline'
+    ddi.symbol = 'A'
+    return ddi
+
+# Create a default Protein object for reuse in tests
+@pytest.fixture()
+def default_Protein_instance():
+    dpi = bkcc.Protein()
+    dpi.name = 'beta adrenergic receptor'
+    dpi.symbol = 'R'
+    dpi.conformation_names = ['inactive', 'active']
+    dpi.conformation_symbols = ['', '*']
+    return dpi
+
+# Create a Protein object with a single conformation for reuse in tests
+@pytest.fixture()
+def single_conformation_Protein_instance():
+    scpi = bkcc.Protein()
+    scpi.name = 'receptor'
+    scpi.symbol = 'R'
+    scpi.conformation_names = ['inactive']
+    scpi.conformation_symbols = ['']
+    return scpi
+
+# Model with "A reversibly associates with R([])", a protein with one conformation
+@pytest.fixture()
+def default_Model_association(default_Drug_instance, single_conformation_Protein_instance):
+    newmodel = bkcm.Model(1, 'Association Model', None)
+    newmodel.drug_list.append(default_Drug_instance)
+    newmodel.protein_list.append(single_conformation_Protein_instance)
+    
+    # Setup rule for the association
+    r0 = bkcc.Rule(newmodel)
+    r0.rule_subject = [default_Drug_instance]
+    r0.subject_conf = [None]
+    r0.rule = ' reversibly associates with '
+    r0.rule_object = [single_conformation_Protein_instance]
+    r0.object_conf = [[]]
+    r0.check_rule_traits()
+    newmodel.rule_list = [r0]
+    return newmodel
+
+# Model with "A reversibly associates with R([])" and "R(0) reversibly converts to R(1)"
+@pytest.fixture()
+def default_Model_two_rule_antagonist(default_Drug_instance, default_Protein_instance):
+    newmodel = bkcm.Model(1, 'Two Rule Model', None)
+    newmodel.drug_list.append(default_Drug_instance)
+    newmodel.protein_list.append(default_Protein_instance)
+    
+    # Setup rule for the association
+    r0 = bkcc.Rule(newmodel)
+    r0.rule_subject = [default_Drug_instance]
+    r0.subject_conf = [None]
+    r0.rule = ' reversibly associates with '
+    r0.rule_object = [default_Protein_instance]
+    r0.object_conf = [[]]
+    r0.check_rule_traits()
+    
+    # Setup rule for the conversion
+    r1 = bkcc.Rule(newmodel)
+    r1.rule_subject = [default_Protein_instance]
+    r1.subject_conf = [[0]]
+    r1.rule = ' reversibly converts to '
+    r1.rule_object = [default_Protein_instance]
+    r1.object_conf = [[1]]
+    r1.check_rule_traits()
+    newmodel.rule_list = [r0, r1]
+    return newmodel
+
+# Model with "R reversibly associates with R", a protein with one conformation
+@pytest.fixture()
+def default_Model_dimer(single_conformation_Protein_instance):
+    newmodel = bkcm.Model(1, 'Dimer Model', None)
+    newmodel.protein_list.append(single_conformation_Protein_instance)
+    
+    # Setup rule for the dimerization
+    r0 = bkcc.Rule(newmodel)
+    r0.rule_subject = [single_conformation_Protein_instance]
+    r0.subject_conf = [[]]
+    r0.rule = ' reversibly associates with '
+    r0.rule_object = [single_conformation_Protein_instance]
+    r0.object_conf = [[]]
+    r0.check_rule_traits()
+    newmodel.rule_list = [r0]
+    return newmodel
+
+# Helper function that finds the species index of the state with the given components
+def _species_index(system, n_drugs, n_proteins):
+    return [i for i, x in enumerate(system.species) if (len(x.required_drug_list), len(x.required_protein_list)) == (n_drugs, n_proteins)][0]
+
+#---- Tests ----
+
+# Test that the rate equations of A + R <-> AR match the hand written ones
+def test_MassActionSystem_rhs(default_Model_association):
+    dma = default_Model_association
+    dma.generate_network()
+    system = bkcs.Solver(dma).get_system()
+    A, R, AR = [_species_index(system, *x) for x in [(1, 0), (0, 1), (1, 1)]]
+    x = np.zeros(3)
+    x[[A, R, AR]] = [2., 3., 5.]
+    rate_constants = system.rate_constant_vector({'k_1': 7., 'k_-1': 11.})
+
+    # Net rate of forming AR
+    net_rate = 7. * 2. * 3. - 11. * 5.
+    expected = np.zeros(3)
+    expected[[A, R, AR]] = [-net_rate, -net_rate, net_rate]
+    assert np.allclose(system.rhs(0., x, rate_constants), expected)
+
+# Test that a homodimer uses both the monomer concentration squared and a coefficient of 2
+def test_MassActionSystem_rhs_dimer(default_Model_dimer):
+    dmd = default_Model_dimer
+    dmd.generate_network()
+    system = bkcs.Solver(dmd).get_system()
+    R, RR = [_species_index(system, 0, x) for x in [1, 2]]
+    x = np.zeros(2)
+    x[[R, RR]] = [3., 5.]
+    rate_constants = system.rate_constant_vector({x.variable: n for x, n in zip(system.reaction_table.reactions, [7., 11.])})
+    net_rate = 7. * 3.**2 - 11. * 5.
+    expected = np.zeros(2)
+    expected[[R, RR]] = [-2 * net_rate, net_rate]
+    assert np.allclose(system.rhs(0., x, rate_constants), expected)
+    assert np.allclose(system.jacobian(0., x, rate_constants).toarray()[R, R], -4 * 7. * 3.)
+    
+    # A negative dimerization rate constant makes the monomer blow up in finite time, which the integrator can't get past
+    with pytest.raises(SimulationError), np.errstate(invalid = 'ignore', over = 'ignore'):
+        bkcs.Solver(dmd).simulate({system.species[R]: 1.}, [-1., 0.], [0., 10.])
+
+# Test that deriving a graph again under the same name gives a new system instead of the cached one
+def test_Solver_get_system_rederived_graph(default_Model_association):
+    dma = default_Model_association
+    drug_B = bkcc.Drug()
+    drug_B.name = 'noradrenaline'
+    drug_B.symbol = 'B'
+    dma.drug_list.append(drug_B)
+    r1 = bkcc.Rule(dma)
+    r1.rule_subject = [drug_B]
+    r1.subject_conf = [None]
+    r1.rule = ' reversibly associates with '
+    r1.rule_object = [dma.protein_list[0]]
+    r1.object_conf = [[]]
+    r1.check_rule_traits()
+    dma.rule_list.append(r1)
+    dma.generate_network()
+    solver = bkcs.Solver(dma)
+    
+    # Only the complexes with the held drug are left in each condition, with that drug's concentration in the rate constants
+    systems = []
+    for current_drug in dma.drug_list:
+        dma.reduce_graph('condition', included_components = [current_drug] + dma.protein_list, pseudo_1st_order_components = [current_drug])
+        systems.append(solver.get_system('condition'))
+        assert solver.get_system('condition') is systems[-1]
+        assert all(x.required_drug_list in [[], [current_drug]] for x in systems[-1].species)
+        free_drug = [x for x in dma.network.main_graph if x.required_drug_list == [current_drug] and x.required_protein_list == []][0]
+        assert any(free_drug.variable in x.free_symbols for x in systems[-1].parameters)
+    assert systems[0] is not systems[1]
+    
+    # Giving the main graph new variables or numbers makes a new system with them
+    system = solver.get_system()
+    assert solver.get_system() is system
+    dma.network.autovariable(indexed = True)
+    indexed_system = solver.get_system()
+    assert indexed_system is not system
+    assert [x.variable for x in indexed_system.species] == [dma.network.state_variable_base[i] for i in range(len(indexed_system.species))]
+    assert all(str(x).startswith('k[') for x in indexed_system.parameters)
+    dma.network.autonumber()
+    assert solver.get_system() is not indexed_system
+
+# Test that the sparse Jacobian matches finite differences and keeps the same sparsity pattern
+def test_MassActionSystem_jacobian(default_Model_two_rule_antagonist):
+    dma = default_Model_two_rule_antagonist
+    dma.generate_network()
+    system = bkcs.Solver(dma).get_system()
+    random_generator = np.random.default_rng(0)
+    rate_constants = random_generator.uniform(0.5, 2., system.reaction_table.number_of_reactions)
+
+    jacobian_patterns = []
+    for repeat in range(3):
+        x = random_generator.uniform(0.1, 1., system.reaction_table.number_of_species)
+        jacobian = system.jacobian(0., x, rate_constants)
+        jacobian_patterns.append((jacobian.indices.tolist(), jacobian.indptr.tolist()))
+        step = 1e-7
+        finite_differences = np.column_stack([(system.rhs(0., x + step * e, rate_constants) - system.rhs(0., x - step * e, rate_constants)) / (2 * step)
+                                              for e in np.eye(len(x))])
+        assert np.allclose(jacobian.toarray(), finite_differences, atol = 1e-6)
+    assert jacobian_patterns[0] == jacobian_patterns[1] == jacobian_patterns[2]
+
+# Test that simulations reach the binding equilibrium and conserve the total drug and protein
+@pytest.mark.parametrize('method', ['BDF', 'LSODA', 'Radau'])
+def test_Solver_simulate(default_Model_association, method):
+    dma = default_Model_association
+    dma.generate_network()
+    solver = bkcs.Solver(dma)
+    system = solver.get_system()
+    free_A = system.species[_species_index(system, 1, 0)]
+    free_R = system.species[_species_index(system, 0, 1)]
+    time_points = np.linspace(0., 10., 11)
+
+    # Fast association, the equilibrium is [AR] / [A][R] = k_1 / k_-1
+    simulation = solver.simulate({free_A: 1., free_R.variable: 0.5}, {'k_1': 1e4, -1: 1.}, time_points, method = method)
+    A, R, AR = simulation.concentrations[[_species_index(system, *x) for x in [(1, 0), (0, 1), (1, 1)]], -1]
+    assert np.allclose(simulation.time_points, time_points)
+    assert simulation.species is system.species
+    assert np.isclose(AR / (A * R), 1e4, rtol = 1e-3)
+    assert np.isclose(A + AR, 1.) and np.isclose(R + AR, 0.5)
+    assert solver.get_system() is system
+
+    # Missing parameter values
+    with pytest.raises(ValueError):
+        solver.simulate({free_A: 1.}, {'k_1': 1.}, time_points, method = method)
+
+# Test that a reduced network uses the free drug concentration given with the parameter values
+def test_Solver_simulate_reduced_graph(default_Model_two_rule_antagonist):
+    dma = default_Model_two_rule_antagonist
+    dma.generate_network()
+    drug = dma.drug_list[0]
+    free_A = [x for x in dma.network.main_graph if x.required_protein_list == []][0]
+    dma.reduce_graph('excess_A', pseudo_1st_order_components = [drug])
+    solver = bkcs.Solver(dma)
+    system = solver.get_system('excess_A')
+    assert len(system.species) == 4 # R, R*, AR, AR*
+
+    # Everything starts as R, the fraction bound in the end is [A] / ([A] + K_d) with equal conformation constants
+    parameter_values = {x.variable: 1. for u, v, x in dma.network.main_graph.edges.data('reaction_type')}
+    parameter_values[free_A.variable] = 3.
+    free_R = [x for x in system.species if x.required_drug_list == [] and x.req_protein_conf_lists == [[0]]][0]
+    simulation = solver.simulate({free_R: 1.}, parameter_values, [0., 50.], graph_name = 'excess_A')
+    bound_fraction = sum(simulation.concentrations[i, -1] for i, x in enumerate(system.species) if x.required_drug_list != [])
+    assert np.isclose(bound_fraction, 0.75, rtol = 1e-4)
+
+    # Values must be finite numbers
+    with pytest.raises(ValueError):
+        solver.simulate({free_R: 1.}, dict(parameter_values, **{free_A.variable.name: np.nan}), [0., 50.], graph_name = 'excess_A')
+
+# Test that the generated rate equation module matches the in-memory system and is reused from the cache directory
+def test_load_compiled_system(default_Model_two_rule_antagonist, tmp_path, monkeypatch):
+    dma = default_Model_two_rule_antagonist
+    dma.generate_network()
+    dma.reduce_graph('excess_A', pseudo_1st_order_components = dma.drug_list)
+    free_A = [x for x in dma.network.main_graph if x.required_protein_list == []][0]
+    parameter_values = {x.variable: n + 1. for n, (u, v, x) in enumerate(dma.network.main_graph.edges.data('reaction_type'))}
+    parameter_values[free_A.variable] = 3.
+    random_generator = np.random.default_rng(0)
+    
+    for graph_name in [None, 'excess_A']:
+        system = bkcs.Solver(dma).get_system(graph_name)
+        compiled_system = bkcs.Solver(dma, cache_directory = str(tmp_path)).get_system(graph_name)
+        assert isinstance(compiled_system, bkcs.CompiledMassActionSystem)
+        rate_constants = system.rate_constant_vector(parameter_values)
+        x = random_generator.uniform(0.1, 1., len(system.species))
+        assert np.allclose(compiled_system.rate_constant_vector(parameter_values), rate_constants)
+        assert np.allclose(compiled_system.rhs(0., x, rate_constants), system.rhs(0., x, rate_constants))
+        assert np.allclose(compiled_system.jacobian(0., x, rate_constants).toarray(), system.jacobian(0., x, rate_constants).toarray())
+    module_files = sorted(tmp_path.glob('rhs_*.py'))
+    assert len(module_files) == 2
+    
+    # A new network with the same equations uses the module file that is already there
+    monkeypatch.setattr(bkcs, '_compiled_modules', {})
+    monkeypatch.setattr(bkcs.MassActionSystem, 'module_source', lambda self, fingerprint: pytest.fail('Module was generated again'))
+    dma.generate_network()
+    compiled_system = bkcs.load_compiled_system(dma.network.get_reaction_table(), cache_directory = str(tmp_path))
+    assert 'rhs_{}.py'.format(compiled_system.module.FINGERPRINT) in [x.name for x in module_files]
+    
+    # Missing values are reported like the in-memory system
+    with pytest.raises(ValueError):
+        compiled_system.rate_constant_vector({'k_1': 1.})
+
+# Test that a generated module can be used in a new process without sympy or bikipy
+def test_compiled_module_standalone(default_Model_association, tmp_path):
+    dma = default_Model_association
+    dma.generate_network()
+    compiled_system = bkcs.Solver(dma, cache_directory = str(tmp_path)).get_system()
+    script = ('import sys, json, runpy\n'
+              'module = runpy.run_path(sys.argv[1])\n'
+              'k = module["rate_constants"]({"k_1": 2., "k_-1": 1.})\n'
+              'print(json.dumps([module["rhs"](0., [1., 1., 1.], k).tolist(), "sympy" in sys.modules or "bikipy" in sys.modules]))')
+    output = subprocess.run([sys.executable, '-c', script, str(tmp_path / 'rhs_{}.py'.format(compiled_system.module.FINGERPRINT))],
+                            stdout = subprocess.PIPE, universal_newlines = True, check = True)
+    rhs, imported_sympy_or_bikipy = json.loads(output.stdout)
+    assert sorted(abs(x) for x in rhs) == [1., 1., 1.]
+    assert not imported_sympy_or_bikipy
+
+# Test that models with indexed variables simulate the same as with one symbol per state and rate constant
+def test_Solver_simulate_indexed_variables(default_Model_two_rule_antagonist, tmp_path):
+    dma = default_Model_two_rule_antagonist
+    simulations = []
+    for indexed_variables in [False, True]:
+        dma.indexed_variables = indexed_variables
+        dma.generate_network()
+        dma.reduce_graph('excess_A', pseudo_1st_order_components = dma.drug_list)
+        free_A = [x for x in dma.network.main_graph if x.required_protein_list == []][0]
+        parameter_values = {x.number: abs(x.number) for u, v, x in dma.network.main_graph.edges.data('reaction_type')}
+        parameter_values[free_A.variable] = 3.
+        for cache_directory in ['', str(tmp_path)]:
+            solver = bkcs.Solver(dma, cache_directory = cache_directory)
+            free_R = [x for x in solver.get_system('excess_A').species if x.required_drug_list == [] and x.req_protein_conf_lists == [[0]]][0]
+            simulations.append(solver.simulate({free_R: 1.}, parameter_values, np.linspace(0., 5., 6), graph_name = 'excess_A').concentrations)
+    assert str(free_A.variable) == 'S[0]'
+    assert all(np.allclose(x, simulations[0]) for x in simulations[1:])
+
+# Test that a batch of ligand concentrations gives the same curves as simulating each one
+def test_Solver_simulate_batch(default_Model_association):
+    dma = default_Model_association
+    dma.generate_network()
+    solver = bkcs.Solver(dma)
+    system = solver.get_system()
+    free_A, free_R, AR = [system.species[_species_index(system, *x)] for x in [(1, 0), (0, 1), (1, 1)]]
+    doses = np.logspace(-2, 1, 12)
+    initial_concentrations = [{free_A: x, free_R: 1.} for x in doses]
+    parameter_values = {'k_1': 10., 'k_-1': 1.}
+    time_points = np.linspace(0., 2., 5)
+    
+    # All species by default
+    batch = solver.simulate_batch(initial_concentrations, parameter_values, time_points)
+    assert batch.observations.shape == (12, 5, 3)
+    for condition_index, current_concentrations in enumerate(initial_concentrations):
+        simulation = solver.simulate(current_concentrations, parameter_values, time_points)
+        assert np.allclose(batch.observations[condition_index], simulation.concentrations.T, rtol = 1e-4, atol = 1e-8)
+    
+    # Observables can be a state, a sum of states, or species weights
+    weights = np.zeros(3)
+    weights[_species_index(system, 1, 1)] = 2.
+    observed = solver.simulate_batch(initial_concentrations, parameter_values, time_points, observables = [AR, [free_R, AR], weights]).observations
+    AR_index = _species_index(system, 1, 1)
+    assert observed.shape == (12, 5, 3)
+    assert np.allclose(observed[:, :, 0], batch.observations[:, :, AR_index])
+    assert np.allclose(observed[:, :, 1], 1.) # Total protein
+    assert np.allclose(observed[:, :, 2], 2 * batch.observations[:, :, AR_index])
+    
+    # A matrix of weights has an observable in each row
+    weight_matrix = np.array([weights, np.ones(3)])
+    observed = solver.simulate_batch(initial_concentrations, parameter_values, time_points, observables = weight_matrix).observations
+    assert np.allclose(observed[:, :, 0], 2 * batch.observations[:, :, AR_index])
+    assert np.allclose(observed[:, :, 1], batch.observations.sum(axis = 2))
+    observed = solver.simulate_ensemble([parameter_values] * 2, initial_concentrations[:2], time_points, observables = weight_matrix).observations
+    assert np.allclose(observed, batch.observations[:2] @ weight_matrix.T, rtol = 1e-4, atol = 1e-8)
+    
+    # Parameter values for each condition, and the worker processes give the same result
+    parameter_list = [dict(parameter_values, **{'k_-1': x}) for x in [1., 2.] * 6]
+    stacked = solver.simulate_batch(initial_concentrations, parameter_list, time_points, observables = [AR])
+    parallel = solver.simulate_batch(initial_concentrations, parameter_list, time_points, observables = [AR], mode = 'processes', max_workers = 2)
+    assert np.allclose(stacked.observations, parallel.observations, rtol = 1e-4, atol = 1e-8)
+    assert not np.allclose(stacked.observations[0], stacked.observations[1])
+    
+    # Mismatched lists and unknown modes
+    with pytest.raises(ValueError):
+        solver.simulate_batch(initial_concentrations, parameter_list[:3], time_points)
+    with pytest.raises(ValueError):
+        solver.simulate_batch(initial_concentrations, parameter_values, time_points, mode = 'threads')
+
+# Test a saturation curve of a reduced graph with the ligand concentration held in the parameter values, using a generated module
+def test_Solver_simulate_batch_held_ligand(default_Model_two_rule_antagonist, tmp_path):
+    dma = default_Model_two_rule_antagonist
+    dma.generate_network()
+    dma.reduce_graph('excess_A', pseudo_1st_order_components = dma.drug_list)
+    free_A = [x for x in dma.network.main_graph if x.required_protein_list == []][0]
+    solver = bkcs.Solver(dma, cache_directory = str(tmp_path))
+    system = solver.get_system('excess_A')
+    free_R = [x for x in system.species if x.required_drug_list == [] and x.req_protein_conf_lists == [[0]]][0]
+    bound_states = [x for x in system.species if x.required_drug_list != []]
+    
+    # With all rate constants 1 the bound fraction at equilibrium is [A] / ([A] + 1)
+    doses = np.array([0.1, 0.3, 1., 3., 10.])
+    parameter_list = [{**{x.variable: 1. for u, v, x in dma.network.main_graph.edges.data('reaction_type')}, free_A.variable: y} for y in doses]
+    for mode in ['stacked', 'processes']:
+        batch = solver.simulate_batch([{free_R: 1.}] * len(doses), parameter_list, [0., 50.], observables = [bound_states], graph_name = 'excess_A', mode = mode)
+        assert np.allclose(batch.observations[:, -1, 0], doses / (doses + 1.), rtol = 1e-4)
+
+# Test that both ensemble modes match single simulations for each set of rate constants
+@pytest.mark.parametrize('mode', ['lockstep', 'grouped'])
+def test_Solver_simulate_ensemble(default_Model_two_rule_antagonist, mode):
+    dma = default_Model_two_rule_antagonist
+    dma.generate_network()
+    solver = bkcs.Solver(dma)
+    system = solver.get_system()
+    start_concentrations = {x: 1. for x in system.species if len(x.required_drug_list) + len(x.required_protein_list) == 1}
+    random_generator = np.random.default_rng(0)
+    parameter_sets = 10**random_generator.uniform(-1., 3., (7, len(system.parameters)))
+    time_points = np.linspace(0., 5., 6)
+    
+    ensemble = solver.simulate_ensemble(parameter_sets, start_concentrations, time_points, mode = mode, group_size = 3)
+    assert ensemble.observations.shape == (7, 6, len(system.species))
+    assert ensemble.success.all()
+    for current_set, current_observations in zip(parameter_sets, ensemble.observations):
+        simulation = solver.simulate(start_concentrations, current_set, time_points, rtol = 1e-8, atol = 1e-14)
+        assert np.allclose(current_observations, simulation.concentrations.T, rtol = 1e-4, atol = 1e-8)
+    
+    # Observables and initial concentrations for each set
+    bound_states = [x for x in system.species if x.required_drug_list != [] and x.required_protein_list != []]
+    observed = solver.simulate_ensemble(parameter_sets[:2], [start_concentrations, {x: 2. for x in start_concentrations}], time_points, 
+                                        observables = [bound_states], mode = mode)
+    assert observed.observations.shape == (2, 6, 1)
+    assert np.allclose(observed.observations[0, :, 0], ensemble.observations[0][:, [system.species.index(x) for x in bound_states]].sum(axis = 1), rtol = 1e-4, atol = 1e-8)
+    with pytest.raises(ValueError):
+        solver.simulate_ensemble(parameter_sets, start_concentrations, time_points, mode = 'threads')
+
+# Test that a set whose integration fails is reported without stopping the other sets
+def test_integrate_ensemble_failed_set(default_Model_dimer):
+    dmd = default_Model_dimer
+    dmd.generate_network()
+    system = bkcs.Solver(dmd).get_system()
+    R = _species_index(system, 0, 1)
+    start_concentrations = np.zeros((3, 2))
+    start_concentrations[:, R] = 1.
+    
+    # The middle set has a rate constant that isn't a number, so none of its steps can pass the error test
+    rate_constants = np.array([[1., 1.], [np.nan, 1.], [2., 1.]])
+    with np.errstate(all = 'ignore'):
+        concentrations, success, steps = bkcs.integrate_ensemble(system, start_concentrations, rate_constants, np.array([0., 1., 2.]))
+    assert success.tolist() == [True, False, True]
+    assert np.isnan(concentrations[1, 1:]).all()
+    assert steps[1] == 0 and np.all(steps[[0, 2]] > 0)
+    assert np.allclose(concentrations[:, 0], start_concentrations)
+    
+    # The monomer and dimer concentrations of the others keep the total protein constant
+    RR = _species_index(system, 0, 2)
+    assert np.allclose(concentrations[[0, 2], :, R] + 2 * concentrations[[0, 2], :, RR], 1.)
+
+# Test the exact solutions of first order rate equations with and without a well conditioned eigendecomposition
+def test_LinearSolution():
+    time_points = np.linspace(0., 4., 9)
+    
+    # A <-> B with forward rate constant 2 and reverse rate constant 1
+    linear_solution = bkcs.LinearSolution([[-2., 1.], [2., -1.]])
+    assert linear_solution.eigenvalues is not None
+    concentrations = linear_solution.concentrations([[1., 0.], [0., 3.]], time_points)
+    assert concentrations.shape == (2, 9, 2)
+    assert np.allclose(concentrations[0, :, 1], 2 / 3 * (1 - np.exp(-3 * time_points)))
+    assert np.allclose(concentrations[1, :, 0], 1 - np.exp(-3 * time_points))
+    
+    # A -> B -> C with equal rate constants has only one eigenvector for its repeated eigenvalue
+    linear_solution = bkcs.LinearSolution([[-1., 0., 0.], [1., -1., 0.], [0., 1., 0.]])
+    assert linear_solution.eigenvalues is None
+    concentrations = linear_solution.concentrations([1., 0., 0.], time_points + 1.)
+    assert concentrations.shape == (9, 3)
+    assert np.allclose(concentrations[:, 1], time_points * np.exp(-time_points))
+    assert np.allclose(concentrations.sum(axis = 1), 1.)
+
+# Test that pseudo-first-order graphs are solved exactly and match the integrators
+def test_Solver_simulate_first_order(default_Model_two_rule_antagonist):
+    dma = default_Model_two_rule_antagonist
+    dma.generate_network()
+    dma.reduce_graph('excess_A', pseudo_1st_order_components = dma.drug_list)
+    free_A = [x for x in dma.network.main_graph if x.required_protein_list == []][0]
+    solver = bkcs.Solver(dma)
+    system = solver.get_system('excess_A')
+    assert system.is_first_order() and not solver.get_system().is_first_order()
+    free_R = [x for x in system.species if x.required_drug_list == [] and x.req_protein_conf_lists == [[0]]][0]
+    random_generator = np.random.default_rng(0)
+    parameter_values = {x.variable: random_generator.uniform(0.2, 5.) for u, v, x in dma.network.main_graph.edges.data('reaction_type')}
+    parameter_values[free_A.variable] = 0.3
+    time_points = np.linspace(0., 20., 41)
+    
+    exact = solver.simulate({free_R: 1.}, parameter_values, time_points, graph_name = 'excess_A')
+    integrated = solver.simulate({free_R: 1.}, parameter_values, time_points, graph_name = 'excess_A', method = 'LSODA', rtol = 1e-10, atol = 1e-14)
+    assert np.allclose(exact.concentrations, integrated.concentrations, rtol = 1e-6, atol = 1e-10)
+    assert np.allclose(exact.concentrations.sum(axis = 0), 1.)
+    
+    # The eigendecomposition is kept for the same rate constants
+    rate_constants = system.rate_constant_vector(parameter_values)
+    assert system.linear_solution(rate_constants) is system.linear_solution(rate_constants.copy())
+    assert np.allclose(system.rate_matrix(rate_constants), system.jacobian(0., np.ones(len(system.species)), rate_constants).toarray())
+    
+    # Batches and ensembles use the exact solution too
+    batch = solver.simulate_batch([{free_R: 1.}, {free_R: 2.}], parameter_values, time_points, graph_name = 'excess_A')
+    assert np.allclose(batch.observations[1], 2 * exact.concentrations.T)
+    ensemble = solver.simulate_ensemble([rate_constants, 2 * rate_constants], {free_R: 1.}, time_points, graph_name = 'excess_A')
+    lockstep = solver.simulate_ensemble([rate_constants, 2 * rate_constants], {free_R: 1.}, time_points, graph_name = 'excess_A', mode = 'lockstep')
+    assert np.allclose(ensemble.observations, lockstep.observations, rtol = 1e-4, atol = 1e-8)
+    with pytest.raises(ValueError):
+        solver.simulate({free_R: 1.}, parameter_values, time_points, method = 'exact')